@@ -11,10 +11,12 @@ import shutil
 import time
 import json
 import traceback
-import base64
 from datetime import datetime
 from flask_cors import CORS
-from backend import ingest_files, get_rag_chain, clear_index, get_indexed_files, get_index_stats, load_document_content, deep_search
+from backend import ingest_files, get_rag_chain, clear_index, get_indexed_files, get_index_stats, load_document_content, load_documents, deep_search, warm_index_cache, delete_collection, remove_documents, sync_directory, claim_files, release_files, record_upload, get_knowledge_graph, get_corpus_graph
+from collection_manager import create_collection, list_collections, collection_exists, resolve_collections
+from metadata_filter import normalize_filter
+from token_counter import get_token_counter, pack_documents
 from config_manager import load_config, save_config, update_config, DEFAULT_CONFIG, validate_config
 from database import (
     get_or_create_default_session, create_session, get_all_sessions,
@@ -23,7 +25,8 @@ from database import (
     toggle_pin_session, get_pinned_sessions,
     create_prompt, get_all_prompts, delete_prompt, search_chat_data,
     get_total_message_count,
-    get_all_file_tags, set_file_tags, get_file_tags
+    set_file_tags, get_file_tags,
+    SharedStateDict
 )
 
 from health_check import check_ollama_health, check_model_available, get_system_status
@@ -32,18 +35,33 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, ToolMessage
-from langchain_ollama import ChatOllama
 from PIL import Image
-import pytesseract
+from vision import describe_image, is_refusal, prepare_image
+from uploads import (
+    UploadError, base64_to_file, stream_to_file, save_upload, parse_content_range,
+    create_upload, get_upload, write_range, commit_upload, abort_upload
+)
+from parsed_cache import remember_digest
 from concurrent.futures import ThreadPoolExecutor
 import uuid
 import time
 from tools import TOOL_REGISTRY, TOOL_DEFINITIONS
 from security import analyze_tool_call, DESTRUCTIVE_ACTIONS, is_safe_path
-from logging_config import setup_logging
+from logging_config import setup_logging, log_payload
+from watcher import DirectoryWatcher, acquire_watch_lock
+from file_catalog import FileCatalog, SORT_KEYS, format_file_size
+import corpus_graph
+
+# Initialize Logger (non-blocking queue sink, per-module levels from config)
+_log_config = load_config()
+logger = setup_logging(
+    level=_log_config.get("log_level", "INFO"),
+    module_levels=_log_config.get("log_levels"),
+    payload_sample_every=_log_config.get("log_payload_sample_every"),
+)
 
-# Initialize Logger
-logger = setup_logging()
+# Load the index before the first /chat request needs it
+warm_index_cache()
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
@@ -51,34 +69,61 @@ APP_VERSION = "2.0.0.0"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploaded_files")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+# Chat attachments that are not added to the knowledge base (temp documents, images),
+# kept out of the watched upload dir
+CHAT_ATTACHMENTS_DIR = os.path.join(BASE_DIR, "chat_attachments")
+os.makedirs(CHAT_ATTACHMENTS_DIR, exist_ok=True)
+
+# Listing of the upload dir for /api/files, kept in memory (see file_catalog.py)
+FILE_CATALOG = FileCatalog(UPLOAD_DIR, rescan_seconds=_log_config.get("file_catalog_rescan_seconds", 60))
+
+
+def on_upload_dir_changes(names):
+    """Watcher callback: update the file catalog, then the index."""
+    FILE_CATALOG.refresh(names)
+    sync_directory(UPLOAD_DIR, names)
+
+
+# Keep the index in line with the upload dir, including files other processes put
+# there (one watching process across workers). Uploads that name a collection are
+# synced into it; files an upload or ingest request is ingesting are left to it.
+if _log_config.get("watch_uploads", True) and acquire_watch_lock(UPLOAD_DIR):
+    DirectoryWatcher(
+        UPLOAD_DIR, on_upload_dir_changes,
+        debounce=_log_config.get("watch_debounce_seconds", 2),
+        max_delay=_log_config.get("watch_max_delay_seconds", 30),
+        poll_interval=_log_config.get("watch_poll_seconds", 2),
+    ).start(initial_scan=_log_config.get("watch_initial_scan", False))
+# Text of a temp (not indexed) chat attachment included in the prompt
+TEMP_DOC_CHARS = 8000
 
 # Async Background Processing
 executor = ThreadPoolExecutor(max_workers=1)
-TASKS = {} # {task_id: {"status": "processing"|"completed"|"failed", "result": ...}}
+# Shared across server worker processes (see serve.py), backed by SQLite
+TASKS = SharedStateDict("tasks") # {task_id: {"status": "processing"|"completed"|"failed", "result": ...}}
 
-def run_ingest_task(task_id, file_paths):
-    """Background task wrapper for ingestion."""
-    TASKS[task_id] = {"status": "processing", "started_at": time.time()}
+def run_ingest_task(task_id, file_paths, collection=None):
+    """Background task wrapper for ingestion; releases the files' claim_files when done."""
+    task = {"status": "processing", "started_at": time.time()}
+    TASKS[task_id] = task
     try:
         from backend import ingest_files 
-        result = ingest_files(file_paths)
-        TASKS[task_id]["status"] = "completed"
-        TASKS[task_id]["result"] = result
-        TASKS[task_id]["completed_at"] = time.time()
+        result = ingest_files(file_paths, collection=collection)
+        task["status"] = "completed"
+        task["result"] = result
     except Exception as e:
-        TASKS[task_id]["status"] = "failed"
-        TASKS[task_id]["error"] = str(e)
-        TASKS[task_id]["completed_at"] = time.time()
+        task["status"] = "failed"
+        task["error"] = str(e)
+    release_files(file_paths)
+    task["completed_at"] = time.time()
+    TASKS[task_id] = task
 
 # Current active session (fallback only - refrain from updating globally)
 CURRENT_SESSION_ID = None
 
-# Shared memory for browser content (Chrome Extension sync)
-# ideally this should be user-specific, but keeping simple for now
 # Shared memory for browser content (Chrome Extension sync)
 # Now keyed by session_id to prevent leaks
-BROWSER_SESSIONS = {}
+BROWSER_SESSIONS = SharedStateDict("browser_sessions")
 
 # Pre-compile regex patterns for greeting detection (performance optimization)
 GREETING_PATTERNS = [
@@ -103,34 +148,19 @@ def get_current_session():
 
 @app.route("/api/files", methods=["GET"])
 def list_files():
-    """List uploaded files."""
-    files = []
-    if os.path.exists(UPLOAD_DIR):
-        for f in os.listdir(UPLOAD_DIR):
-            path = os.path.join(UPLOAD_DIR, f)
-            if os.path.isfile(path):
-                try:
-                    stats = os.stat(path)
-                    files.append({
-                        "name": f,
-                        "size": stats.st_size,
-                        "created": datetime.fromtimestamp(stats.st_ctime).strftime('%Y-%m-%d %H:%M:%S'),
-                         "modified": datetime.fromtimestamp(stats.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
-                    })
-                except Exception:
-                    continue
-    
-    # Get tags for all files
-    all_tags = get_all_file_tags()
-    
-    # Merge tags into file list
-    for file in files:
-        file['tags'] = all_tags.get(file['name'], [])
-    
-    # Sort by modified date descending (newest first)
-    files.sort(key=lambda x: x['modified'], reverse=True)
-    
-    return jsonify({"files": files})
+    """
+    List uploaded files with tags and indexed status, from the file catalog.
+    Query: sort (modified, name, size, type), order (asc, desc), offset, limit (default: all).
+    """
+    sort = request.args.get("sort", "modified")
+    if sort not in SORT_KEYS:
+        return jsonify({"error": f"sort must be one of {sorted(SORT_KEYS)}"}), 400
+    order = request.args.get("order", "desc" if sort in ("modified", "size") else "asc")
+    offset = max(0, request.args.get("offset", 0, type=int))
+    limit = request.args.get("limit", type=int)
+    files, total = FILE_CATALOG.list(get_indexed_files(), sort, order == "desc", offset,
+                                     None if limit is None else max(0, limit))
+    return jsonify({"files": files, "count": len(files), "total": total, "offset": offset})
 
 
 @app.route("/api/files/<path:filename>/tags", methods=["POST", "DELETE"])
@@ -159,6 +189,9 @@ def upload():
         return redirect(url_for("index", message="No file part", status="error"))
     
     files = request.files.getlist("files")
+    collection = request.form.get("collection")
+    if not collection_exists(collection):
+        return redirect(url_for("index", message=f"Unknown collection: {collection}", status="error"))
     paths = []
     
     for file in files:
@@ -167,16 +200,18 @@ def upload():
             
         # SECURITY: Check path
         if not is_safe_path(file.filename):
+             release_files(paths)
              return redirect(url_for("index", message=f"Invalid filename: {file.filename}", status="error"))
              
         path = os.path.join(UPLOAD_DIR, file.filename)
-        file.save(path)
+        claim_files([path], collection)  # Ingested below, not by the upload dir watcher
+        stream_to_file(file.stream, path)
         paths.append(path)
     
     if paths:
         # Offload to background thread
         task_id = str(uuid.uuid4())
-        executor.submit(run_ingest_task, task_id, paths)
+        executor.submit(run_ingest_task, task_id, paths, collection)
         
         msg = f"Ingestion started in background. (Task ID: {task_id[:8]})"
         return redirect(url_for("index", message=msg, status="info"))
@@ -345,13 +380,17 @@ def delete_document(filename):
     if not is_safe_path(filename):
         return jsonify({"error": "Invalid filename"}), 400
         
+    collection = request.args.get("collection")
+    if not collection_exists(collection):
+        return jsonify({"error": f"Unknown collection: {collection}"}), 404
+        
     # Delete the physical file if it exists in uploads
     filepath = os.path.join(UPLOAD_DIR, filename)
     if os.path.exists(filepath):
         try:
             os.remove(filepath)
-            # Note: File will still be in FAISS index until index is rebuilt
-            return jsonify({"status": "success", "message": f"Deleted {filename}. Rebuild index to fully remove."})
+            removed = remove_documents([os.path.basename(filename)], collection)
+            return jsonify({"status": "success", "message": f"Deleted {filename} ({removed} chunks removed from the index)."})
         except Exception as e:
             return jsonify({"error": str(e)}), 500
     
@@ -382,22 +421,14 @@ def api_upload_files():
                 failed.append({"name": filename, "error": "Invalid filename (Path traversal detected)"})
                 continue
             
-            filepath = os.path.join(UPLOAD_DIR, filename)
-            
-            # Handle duplicate filenames
-            counter = 1
-            base_name, ext = os.path.splitext(filename)
-            while os.path.exists(filepath):
-                filename = f"{base_name}_{counter}{ext}"
-                filepath = os.path.join(UPLOAD_DIR, filename)
-                counter += 1
-            
-            file.save(filepath)
+            # Duplicate names get a _1, _2, ... suffix
+            filename, size = save_upload(file.stream, UPLOAD_DIR, filename)
             uploaded.append({
                 "name": filename,
-                "path": filepath,
-                "size": os.path.getsize(filepath),
-                "size_formatted": format_file_size(os.path.getsize(filepath))
+                "file_id": filename,  # Attach to /chat without re-sending the bytes
+                "path": os.path.join(UPLOAD_DIR, filename),
+                "size": size,
+                "size_formatted": format_file_size(size)
             })
         except Exception as e:
             failed.append({"name": file.filename, "error": str(e)})
@@ -410,6 +441,88 @@ def api_upload_files():
     })
 
 
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify({"error": str(e)}), e.status
+
+
+@app.route("/api/uploads", methods=["POST"])
+def start_resumable_upload():
+    """
+    Start a resumable upload: {"filename", "size", "sha256" (optional),
+    "collection", "ingest"}. Send the bytes with PUT /api/uploads/<id> and a
+    Content-Range header, then POST /api/uploads/<id>/commit.
+    """
+    data = request.get_json(silent=True) or {}
+    filename = os.path.basename(str(data.get("filename", "")))
+    if not filename or not is_safe_path(filename):
+        return jsonify({"error": "Invalid filename"}), 400
+    if not isinstance(data.get("size"), int):
+        return jsonify({"error": "size (bytes) is required"}), 400
+    collection = data.get("collection")
+    if not collection_exists(collection):
+        return jsonify({"error": f"Unknown collection: {collection}"}), 404
+    config = load_config()
+    state = create_upload(filename, data["size"], config, sha256=data.get("sha256"),
+                          collection=collection, ingest=bool(data.get("ingest", False)))
+    state["chunk_size"] = config.get("upload_chunk_mb", 8) * 1024 * 1024  # Suggested range size
+    return jsonify(state), 201
+
+
+@app.route("/api/uploads/<upload_id>", methods=["GET"])
+def resumable_upload_status(upload_id):
+    """State of a resumable upload; "offset" is where to resume sending."""
+    return jsonify(get_upload(upload_id, load_config()))
+
+
+@app.route("/api/uploads/<upload_id>", methods=["PUT"])
+def upload_range(upload_id):
+    """Write the request body at the Content-Range of a resumable upload."""
+    config = load_config()
+    start = 0
+    if request.headers.get("Content-Range"):
+        start, _, total = parse_content_range(request.headers["Content-Range"])
+        size = get_upload(upload_id, config)["size"]
+        if total is not None and total != size:
+            return jsonify({"error": f"Content-Range total {total} does not match the upload size {size}"}), 400
+    offset = write_range(upload_id, request.stream, start, config)
+    return jsonify({"upload_id": upload_id, "offset": offset})
+
+
+@app.route("/api/uploads/<upload_id>/commit", methods=["POST"])
+def commit_resumable_upload(upload_id):
+    """Verify a completed upload, move it to the upload dir and optionally start its ingest."""
+    data = request.get_json(silent=True) or {}
+    state = commit_upload(upload_id, UPLOAD_DIR, load_config(), sha256=data.get("sha256"))
+    filepath = os.path.join(UPLOAD_DIR, state["name"])
+    remember_digest(filepath, state["sha256"])  # Ingest's parsed-text cache needn't hash it again
+    result = {
+        "name": state["name"],
+        "file_id": state["name"],
+        "path": filepath,
+        "size": state["size"],
+        "size_formatted": format_file_size(state["size"]),
+        "sha256": state["sha256"]
+    }
+    if state["ingest"]:
+        claim_files([filepath], state["collection"])
+        task_id = str(uuid.uuid4())
+        executor.submit(run_ingest_task, task_id, [filepath], state["collection"])
+        result["task_id"] = task_id
+    else:
+        record_upload(filepath, state["collection"])  # The upload dir watcher ingests it there
+    return jsonify(result)
+
+
+@app.route("/api/uploads/<upload_id>", methods=["DELETE"])
+def abort_resumable_upload(upload_id):
+    """Cancel a resumable upload and delete the bytes received."""
+    config = load_config()
+    get_upload(upload_id, config)  # 404 if unknown
+    abort_upload(upload_id, config)
+    return jsonify({"status": "success"})
+
+
 @app.route("/api/files/<path:filename>", methods=["DELETE"])
 def delete_file(filename):
     """Delete a specific file."""
@@ -434,9 +547,12 @@ def delete_multiple_files():
     """Delete multiple files at once."""
     data = request.json
     filenames = data.get("files", [])
+    collection = data.get("collection")
     
     if not filenames:
         return jsonify({"error": "No files specified"}), 400
+    if not collection_exists(collection):
+        return jsonify({"error": f"Unknown collection: {collection}"}), 404
     
     deleted = []
     failed = []
@@ -457,6 +573,9 @@ def delete_multiple_files():
         except Exception as e:
             failed.append({"name": filename, "error": str(e)})
     
+    if deleted:
+        remove_documents([os.path.basename(filename) for filename in deleted], collection)
+    
     return jsonify({
         "status": "success" if deleted else "error",
         "deleted": deleted,
@@ -488,6 +607,7 @@ def ingest_selected_files():
         return jsonify({"error": "No valid files found"}), 400
     
     # Offload to background thread
+    claim_files(paths)
     task_id = str(uuid.uuid4())
     executor.submit(run_ingest_task, task_id, paths)
     
@@ -504,8 +624,15 @@ def ingest_single_file(filename):
     filepath = os.path.join(UPLOAD_DIR, filename)
     if not os.path.exists(filepath):
         return jsonify({"error": "File not found"}), 404
+    collection = (request.get_json(silent=True) or {}).get("collection")
+    if not collection_exists(collection):
+        return jsonify({"error": f"Unknown collection: {collection}"}), 404
         
-    result = ingest_files([filepath])
+    claim_files([filepath], collection)
+    try:
+        result = ingest_files([filepath], collection=collection)
+    finally:
+        release_files([filepath])
     
     if result["success"] and result["processed_count"] > 0:
         return jsonify(result)
@@ -538,14 +665,15 @@ def preview_file(filename):
         
         elif ext == ".pdf":
             try:
-                from langchain_community.document_loaders import PyPDFLoader
-                loader = PyPDFLoader(filepath)
-                docs = loader.load()
-                if docs:
-                    content = docs[0].page_content[:3000]
-                    if len(docs) > 1:
-                        content += f"\n\n... ({len(docs)} pages total)"
-                    return jsonify({"type": "text", "content": content, "pages": len(docs)})
+                # ?page=N (from 1); read from the parsed-text cache once the file was parsed
+                number = max(1, request.args.get("page", 1, type=int))
+                page = next(load_documents(filepath, start=number - 1), None)
+                if page is not None:
+                    pages = page.metadata.get("total_pages", 1)
+                    content = page.page_content[:3000]
+                    if pages > 1:
+                        content += f"\n\n... (page {number} of {pages})"
+                    return jsonify({"type": "text", "content": content, "page": number, "pages": pages})
             except:
                 pass
             return jsonify({"type": "info", "content": "PDF preview not available"})
@@ -575,7 +703,7 @@ def format_docs(docs):
     """Format retrieved documents with source information."""
     formatted = []
     for doc in docs:
-        source = doc.metadata.get('source', 'Unknown')
+        source = ", ".join(doc.metadata.get('sources') or [doc.metadata.get('source', 'Unknown')])
         content = doc.page_content
         formatted.append(f"Source: {source}\nContent: {content}")
     return "\n\n".join(formatted)
@@ -599,15 +727,56 @@ def health():
     })
 
 
+def save_chat_attachment(attachment, default_name, directory=None):
+    """
+    Path of a /chat attachment. An attachment references a file uploaded
+    before ("file_id": a name returned by /api/files/upload, in the upload
+    dir), a multipart file part ("part"), or carries base64 "data" (JSON
+    requests). Parts and base64 data are streamed to disk in chunks, into
+    directory (default: the chat attachments dir).
+    """
+    file_id = attachment.get("file_id")
+    if file_id:
+        path = os.path.join(UPLOAD_DIR, file_id)
+        if not is_safe_path(file_id) or not os.path.isfile(path):
+            raise ValueError(f"Unknown file_id: {file_id}")
+        return path
+    
+    name = os.path.basename(attachment.get("name") or default_name)  # Simple sanitization
+    path = os.path.join(directory or CHAT_ATTACHMENTS_DIR, name)
+    part = attachment.get("part")
+    if part:
+        if part not in request.files:
+            raise ValueError(f"Missing file part: {part}")
+        stream_to_file(request.files[part].stream, path)
+    else:
+        base64_to_file(attachment.get("data", ""), path)
+    return path
+
+
 @app.route("/chat", methods=["POST"])
 def chat():
     """Handle chat messages with persistent history and streaming responses."""
     try:
-        data = request.json
-        print(f"[DEBUG] /chat request received. Files: {len(data.get('files', []))}", flush=True)
+        if request.mimetype == "multipart/form-data":
+            # Binary attachments: the JSON body is the "payload" field, files[].part names a file part
+            data = json.loads(request.form.get("payload") or "{}")
+        else:
+            data = request.json
+        logger.debug("/chat request received. Files: %d", len(data.get('files', [])))
         
         query = data.get("message", "").strip()
-        files = data.get("files", [])  # Unified: {type, name, data, addToRag}
+        files = data.get("files", [])  # Unified: {type, name, addToRag, and file_id, part or data} (see save_chat_attachment)
+        # Collection name or list of names to search (default collection if omitted)
+        collections = resolve_collections(data.get("collections") or data.get("collection"))
+        unknown = [name for name in collections if not collection_exists(name)]
+        if unknown:
+            return jsonify({"error": f"Unknown collection(s): {', '.join(unknown)}"}), 404
+        # Optional metadata filter: {tags, sources, file_types, ingested_after, ingested_before}
+        try:
+            metadata_filter = normalize_filter(data.get("filter"))
+        except ValueError as e:
+            return jsonify({"error": f"Invalid filter: {e}"}), 400
         
         # Separate files by type
         images = [f for f in files if f.get("type") == "image"]
@@ -635,46 +804,43 @@ def chat():
         temp_doc_content = []  # For docs not added to RAG (temp analysis)
         
         if documents:
-            print(f"[DEBUG] Processing {len(documents)} documents", flush=True)
+            logger.debug("Processing %d documents", len(documents))
             rag_paths = []  # Docs to ingest into RAG
             
             for doc in documents:
                 try:
-                    doc_name = doc.get("name", "uploaded_doc.txt")
-                    doc_data = doc.get("data", "")
                     add_to_rag = doc.get("addToRag", False)
-                    
-                    # Extract base64 data (remove header if present)
-                    if "," in doc_data:
-                        doc_data = doc_data.split(",")[1]
-                    
-                    # Decode and save
-                    file_bytes = base64.b64decode(doc_data)
-                    file_path = os.path.join(UPLOAD_DIR, doc_name)
-                    with open(file_path, "wb") as f:
-                        f.write(file_bytes)
+                    # Added documents join the upload dir (and the file list); temp ones don't
+                    file_path = save_chat_attachment(doc, "uploaded_doc.txt", UPLOAD_DIR if add_to_rag else CHAT_ATTACHMENTS_DIR)
+                    doc_name = os.path.basename(file_path)
                     
                     if add_to_rag:
+                        # Ingested below, not by the upload dir watcher (which waits for new files to settle)
+                        claim_files([file_path])
                         rag_paths.append(file_path)
                     else:
-                        # For temp analysis, use same loaders as RAG system
-                        content = load_document_content(file_path)
-                        print(f"[DEBUG] Loaded temp doc '{doc_name}': {len(content)} chars", flush=True)
-                        temp_doc_content.append(f"[Document: {doc_name}]\n{content[:8000]}")
+                        # For temp analysis, use same loaders as RAG system (reading only what the prompt uses)
+                        content = load_document_content(file_path, max_chars=TEMP_DOC_CHARS)
+                        logger.debug("Loaded temp doc '%s': %d chars", doc_name, len(content))
+                        temp_doc_content.append(f"[Document: {doc_name}]\n{content[:TEMP_DOC_CHARS]}")
                             
                 except Exception as e:
-                    print(f"Error processing document {doc.get('name')}: {e}")
+                    logger.error("Error processing document %s: %s", doc.get('name'), e)
             
             # Ingest RAG documents with embedding model
             if rag_paths:
-                success, msg = ingest_files(rag_paths)
-                if success:
+                try:
+                    result = ingest_files(rag_paths)
+                finally:
+                    release_files(rag_paths)
+                if result["success"]:
                     docs_ingested = True
-                    print(f"Chat documents ingested to RAG: {msg}")
+                    logger.info("Chat documents ingested to RAG: %d file(s)", result["processed_count"])
                 else:
-                    print(f"Failed to ingest chat documents: {msg}")
+                    logger.warning("Failed to ingest chat documents: %s",
+                                   "; ".join(r["message"] for r in result["results"] if r["status"] == "error"))
         
-        retriever, llm = get_rag_chain(model_name)
+        retriever, llm = get_rag_chain(model_name, collections=collections)
         
         # === VISION PATH (Two-Stage Pipeline) ===
         # 1. Internal Vision AI extracts context (Description)
@@ -682,81 +848,54 @@ def chat():
         vision_context = ""
         if images:
             try:
-                print("[DEBUG] Processing images with Vision AI (moondream)...", flush=True)
-                # Clean Base64 strings
-                cleaned_images = []
+                vision_model = config.get("vision_model", "moondream")
+                logger.debug("Processing images with Vision AI (%s)...", vision_model)
+                # Decode each image once: the original bytes are saved, a downscaled copy goes to the model
+                prepared_images = []  # (name, path, image)
+                rag_images = set()  # Paths of images whose description goes into the knowledge base
                 for img_file in images:
                     try:
-                        img_data = img_file.get("data", "")
-                        if "," in img_data:
-                            img_data = img_data.split(",")[1]
-                        
-                        # Save to disk for serving
-                        raw_name = img_file.get("name", f"image_{int(time.time())}.png")
-                        img_name = os.path.basename(raw_name)  # Simple sanitization
-                        img_path = os.path.join(UPLOAD_DIR, img_name)
+                        # Saved to disk for serving
+                        img_path = save_chat_attachment(img_file, f"image_{int(time.time())}.png")
+                        if img_file.get("addToRag", False) or config.get("index_image_descriptions", False):
+                            rag_images.add(img_path)
+                        img_name = os.path.basename(img_path)
+                        with open(img_path, "rb") as f:
+                            img_bytes = f.read()
                         
-                        with open(img_path, "wb") as f:
-                            f.write(base64.b64decode(img_data))
-                        
-                        cleaned_images.append(img_data)
+                        prepared_images.append((img_name, img_path, prepare_image(img_bytes, config)))
                     except Exception as e:
-                        print(f"[ERROR] Failed to save image {img_file.get('name')}: {e}", flush=True)
+                        logger.error("Failed to save image %s: %s", img_file.get('name'), e)
                         continue
+                if not prepared_images:
+                    raise ValueError("none of the images could be decoded")
                 
-                # Call Vision Model (moondream)
-                # We use a dedicated instance for vision to ensure capacity
-                vision_llm = ChatOllama(model="moondream", base_url=config.get("ollama_host", "http://localhost:11434"))
-                
-                # Construct Multimodal Message (Modern LangChain/Ollama Format)
-                content_parts = [
-                    {"type": "text", "text": "Describe this image. List prominent colors, objects, and any text visible."}
-                ]
-                
-                for img_file in images:
-                    # Use full data URL (with header) for LangChain
-                    # If data is raw base64 (no header), ad-hoc allow it, but frontend sends Data URL.
-                    img_data_full = img_file.get("data", "")
-                    content_parts.append({
-                        "type": "image_url",
-                        "image_url": {"url": img_data_full}
-                    })
-
-                vision_messages = [
-                    HumanMessage(content=content_parts)
-                ]
-                
-                # Get Description
-                vision_response = vision_llm.invoke(vision_messages)
-                description = vision_response.content
-                print(f"[DEBUG] Vision AI FULL Description: '{description}'", flush=True)
-                
-                # Detect if moondream refused to process the image
-                refusal_patterns = [
-                    "i don't have access",
-                    "i can't view",
-                    "i'm sorry, but i can't",
-                    "i cannot assist with that",
-                    "i'm unable to view",
-                    "i'm unable to see",
-                    "unfortunately, i don't have access"
-                ]
-                description_lower = description.lower().strip()
-                
-                # Check for empty or very short responses (also a sign of refusal)
-                is_empty_or_short = len(description.strip()) < 10
-                is_refusal = any(pattern in description_lower for pattern in refusal_patterns) or is_empty_or_short
+                # One vision call per image not described before (cached by image hash, model and prompt)
+                descriptions = []
+                for img_name, img_path, image in prepared_images:
+                    description = describe_image(image, config)
+                    log_payload(logger, f"Vision AI description of {img_name}", description)
+                    refused = is_refusal(description)
+                    logger.debug("Refusal detected for %s: %s (len=%d)", img_name, refused, len(description))
+                    if not refused:
+                        descriptions.append((img_name, img_path, description))
                 
-                print(f"[DEBUG] Refusal detected: {is_refusal} (empty={is_empty_or_short}, len={len(description)})", flush=True)
-                
-                if is_refusal:
-                    # moondream refused - provide helpful feedback
-                    vision_context = f"\n\n[VISION SYSTEM LIMITATION]\nThe vision model (moondream) was unable to process the uploaded image. This typically happens with:\n- Large images (>1MB)\n- High-resolution photos with complex scenes\n- Images with heavy compression artifacts\n\nSUGGESTIONS:\n1. Try resizing/compressing the image before upload\n2. Use a more capable vision model like 'llava:latest' or 'minicpm-v' (available via Settings > Model)\n3. Simplify the image (crop to focus on specific area)\n\nFor now, respond to the user's query acknowledging you cannot analyze this specific image, and ask them to try the suggestions above.\n"
+                if not descriptions:
+                    # Vision model refused - provide helpful feedback
+                    vision_context = f"\n\n[VISION SYSTEM LIMITATION]\nThe vision model ({vision_model}) was unable to process the uploaded image. This typically happens with:\n- High-resolution photos with complex scenes\n- Images with heavy compression artifacts\n\nSUGGESTIONS:\n1. Use a more capable vision model like 'llava:latest' or 'minicpm-v' (vision_model setting)\n2. Simplify the image (crop to focus on specific area)\n\nFor now, respond to the user's query acknowledging you cannot analyze this specific image, and ask them to try the suggestions above.\n"
                 else:
+                    if len(descriptions) == 1:
+                        description = descriptions[0][2]
+                    else:
+                        description = "\n\n".join(f"Image {name}: {text}" for name, _, text in descriptions)
                     vision_context = f"\n\n[HIDDEN CONTEXT FROM VISION AI]\nThe user has attached images. Here is the internal description of those images:\n{description}\n(The user cannot see this description directly. Use it to answer their questions about the image.)\n"
+                    indexed_images = [path for _, path, _ in descriptions if path in rag_images]
+                    if indexed_images:
+                        # Retrievable later; ingest reads the descriptions back from the cache
+                        executor.submit(run_ingest_task, str(uuid.uuid4()), indexed_images)
                 
             except Exception as e:
-                print(f"[ERROR] Vision processing failed: {e}", flush=True)
+                logger.error("Vision processing failed: %s", e)
                 vision_context = f"\n\n[SYSTEM ERROR] Failed to process attached images: {str(e)}"
 
         # === STANDARD TEXT/RAG PATH (Now includes Vision Context) ===
@@ -848,27 +987,32 @@ Conversation History:
             if retriever:
                  try:
                     if use_deep_search:
-                         print(f"PERFORMING DEEP SEARCH for: {query}")
-                         docs = deep_search(query, retriever, llm)
+                         logger.info("Performing deep search for: %s", query)
+                         docs = deep_search(query, retriever, llm, filter=metadata_filter)
                     else:
-                         docs = retriever.invoke(query)
+                         docs = retriever.invoke(query, filter=metadata_filter)
                          
                     if docs:
+                        # Fit the context to the token budget using the counts stored at ingest
+                        docs = pack_documents(docs, config.get("context_token_budget", 3000),
+                                              get_token_counter(config.get("tokenizer", "auto")))
                         context_str = format_docs(docs)
                         system_prompt += f"\n\nRELEVANT DOCUMENT CONTEXT:\n{context_str}\n"
                  except Exception as e:
-                     print(f"Retrieval warning: {e}")
+                     logger.warning("Retrieval warning: %s", e)
             
             # Add temp document content (for documents not added to RAG)
             if temp_doc_content:
                 temp_content_str = "\n\n".join(temp_doc_content)
                 system_prompt += f"\n\nUPLOADED DOCUMENT CONTENT (for this session only):\n{temp_content_str}\n"
-                print(f"[DEBUG] Added temp_doc_content to prompt: {len(temp_content_str)} chars", flush=True)
+                logger.debug("Added temp_doc_content to prompt: %d chars", len(temp_content_str))
 
             # Inject File Catalog (so model knows what it has without tools)
             try:
-                catalog_paths = get_indexed_files() # Returns list of source paths
-                print(f"[DEBUG] get_indexed_files returned: {len(catalog_paths)} files", flush=True)
+                catalog_paths = []
+                for name in collections:
+                    catalog_paths.extend(get_indexed_files(name)) # Returns list of source paths
+                logger.debug("get_indexed_files returned: %d files", len(catalog_paths))
                 if catalog_paths:
                     # Extract basenames for cleaner context
                     file_names = [os.path.basename(p) for p in catalog_paths]
@@ -879,17 +1023,17 @@ Conversation History:
                     
                     catalog_str = "\n".join(catalog_list)
                     system_prompt += f"\n\nAVAILABLE KNOWLEDGE BASE (Files in Database):\n{catalog_str}\n"
-                    print(f"[DEBUG] Injected catalog into system prompt. Catalog length: {len(catalog_str)}", flush=True)
+                    logger.debug("Injected catalog into system prompt. Catalog length: %d", len(catalog_str))
                 else:
-                    print("[DEBUG] No files found in index to inject.", flush=True)
+                    logger.debug("No files found in index to inject.")
             except Exception as e:
-                print(f"Catalog injection error: {e}", flush=True)
+                logger.warning("Catalog injection error: %s", e)
             
             # Append Vision Context (if any)
             if vision_context:
                  system_prompt += vision_context
                  
-            print(f"[DEBUG] FINAL SYSTEM PROMPT:\n{system_prompt}\n[END PROMPT]", flush=True)
+            log_payload(logger, "Final system prompt", system_prompt)
 
         # 3. Construct Message Chain
         # We need to rebuild the message list for the chat model
@@ -1002,19 +1146,12 @@ Conversation History:
 # ==========================================
 # AGENTIC APPROVAL ENDPOINT
 # ==========================================
-# Global store for pending actions
-PENDING_ACTIONS = {}
+# Global store for pending actions (shared across worker processes)
+PENDING_ACTIONS = SharedStateDict("pending_actions")
 
 def clean_pending_actions(ttl=300): # 5 minutes TTL
     """Remove stale pending actions."""
-    current_time = time.time()
-    to_remove = []
-    for sid, data in PENDING_ACTIONS.items():
-        if current_time - data.get("timestamp", 0) > ttl:
-            to_remove.append(sid)
-    
-    for sid in to_remove:
-        del PENDING_ACTIONS[sid]
+    PENDING_ACTIONS.purge_older_than(ttl)
 
 @app.route("/api/agent/allow", methods=["POST"])
 def allow_tool():
@@ -1035,8 +1172,9 @@ def allow_tool():
     if not pending or pending["id"] != action_id:
         return jsonify({"error": "No matching pending action found."}), 404
     
-    # Clear pending
-    del PENDING_ACTIONS[session_id]
+    # Clear pending (another worker may have handled the same confirmation)
+    if PENDING_ACTIONS.pop(session_id, None) is None:
+        return jsonify({"status": "handled", "message": "Action already handled."})
     
     if decision != "approve":
         return jsonify({"status": "denied", "message": "Action cancelled by user."})
@@ -1325,11 +1463,93 @@ def rename_chat_session(session_id):
 
 @app.route("/api/index/stats", methods=["GET"])
 def index_stats():
-    """Get statistics about the vector index."""
-    stats = get_index_stats()
+    """Get statistics about the vector index (?collection=name)."""
+    collection = request.args.get("collection")
+    if not collection_exists(collection):
+        return jsonify({"error": f"Unknown collection: {collection}"}), 404
+    stats = get_index_stats(collection)
     return jsonify(stats)
 
 
+@app.route("/api/graph", methods=["GET"])
+def knowledge_graph_api():
+    """
+    The collection's document-term graph, a page of documents at a time.
+    Query: collection, offset, limit (documents, default 50), terms_per_doc (5),
+    min_degree (terms linking fewer of the page's documents are left out, 1),
+    max_nodes (200; the least connected terms are left out beyond it).
+    """
+    collection = request.args.get("collection")
+    if not collection_exists(collection):
+        return jsonify({"error": f"Unknown collection: {collection}"}), 404
+    graph = get_knowledge_graph(
+        collection,
+        offset=max(0, request.args.get("offset", 0, type=int)),
+        limit=min(max(1, request.args.get("limit", 50, type=int)), 1000),
+        terms_per_doc=min(max(1, request.args.get("terms_per_doc", 5, type=int)), 50),
+        min_degree=max(1, request.args.get("min_degree", 1, type=int)),
+        max_nodes=max(1, request.args.get("max_nodes", 200, type=int)),
+    )
+    return jsonify(graph), 500 if "error" in graph else 200
+
+
+@app.route("/api/graph/clusters", methods=["GET"])
+def corpus_graph_clusters():
+    """
+    Topic clusters of the whole collection (?collection=name): per cluster its
+    label, top terms and top files, plus the links between clusters. 202 while
+    the first graph is built; later rebuilds return the previous graph, "stale".
+    """
+    collection = request.args.get("collection")
+    if not collection_exists(collection):
+        return jsonify({"error": f"Unknown collection: {collection}"}), 404
+    graph = corpus_graph.summary(get_corpus_graph(collection))
+    return jsonify(graph), 202 if graph["status"] == "building" and not graph["clusters"] else 200
+
+
+@app.route("/api/graph/clusters/<int:cluster_id>", methods=["GET"])
+def corpus_graph_cluster(cluster_id):
+    """One cluster's terms (nodes) and their co-occurrence edges (links, NPMI weighted)."""
+    collection = request.args.get("collection")
+    if not collection_exists(collection):
+        return jsonify({"error": f"Unknown collection: {collection}"}), 404
+    graph = get_corpus_graph(collection)
+    if not 0 <= cluster_id < len(graph["clusters"]):
+        return jsonify({"error": f"Unknown cluster: {cluster_id}", "status": graph["status"]}), 404
+    cluster = graph["clusters"][cluster_id]
+    return jsonify({
+        "cluster": {key: value for key, value in cluster.items() if key not in ("terms", "edges")},
+        "nodes": cluster["terms"],
+        "links": cluster["edges"],
+        "status": graph["status"],
+        "stale": graph["stale"],
+    })
+
+
+@app.route("/api/collections", methods=["GET", "POST"])
+def collections_api():
+    """List collections, or create one: {name, settings: {embed_model, chunk_size, ...}}."""
+    if request.method == "POST":
+        data = request.json or {}
+        try:
+            collection = create_collection(data.get("name", ""), data.get("settings"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"status": "success", "collection": collection}), 201
+    return jsonify({"collections": list_collections()})
+
+
+@app.route("/api/collections/<name>", methods=["DELETE"])
+def delete_collection_api(name):
+    """Delete a collection and its index."""
+    if not collection_exists(name):
+        return jsonify({"error": f"Unknown collection: {name}"}), 404
+    success, msg = delete_collection(name)
+    if success:
+        return jsonify({"status": "success", "message": msg})
+    return jsonify({"error": msg}), 400
+
+
 @app.route("/api/browser/sync", methods=["POST"])
 def sync_browser():
     """Endpoint for Chrome Extension to send active tab data."""
@@ -1346,7 +1566,7 @@ def sync_browser():
         }
         return jsonify({"status": "synced", "session_id": session_id})
     except Exception as e:
-        print(f"Error in browser sync: {e}")
+        logger.error("Error in browser sync: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -1361,8 +1581,7 @@ def get_browser_context():
 def clear_browser_context():
     """Clear the browser context."""
     session_id = request.headers.get('X-Session-ID', 'default')
-    if session_id in BROWSER_SESSIONS:
-        del BROWSER_SESSIONS[session_id]
+    BROWSER_SESSIONS.pop(session_id, None)
     return jsonify({"status": "cleared", "session_id": session_id})
 
 
@@ -1397,8 +1616,11 @@ def app_stats():
 
 @app.route("/api/index/clear", methods=["POST"])
 def clear_vector_index():
-    """Clear all indexed documents."""
-    success, msg = clear_index()
+    """Clear all indexed documents (?collection=name)."""
+    collection = request.args.get("collection") or (request.get_json(silent=True) or {}).get("collection")
+    if not collection_exists(collection):
+        return jsonify({"error": f"Unknown collection: {collection}"}), 404
+    success, msg = clear_index(collection)
     if success:
         return jsonify({"status": "success", "message": msg})
     return jsonify({"error": msg}), 500
@@ -1406,8 +1628,11 @@ def clear_vector_index():
 
 @app.route("/api/index/files", methods=["GET"])
 def list_indexed_files():
-    """Get list of indexed files."""
-    files = get_indexed_files()
+    """Get list of indexed files (?collection=name)."""
+    collection = request.args.get("collection")
+    if not collection_exists(collection):
+        return jsonify({"error": f"Unknown collection: {collection}"}), 404
+    files = get_indexed_files(collection)
     return jsonify({"files": files, "count": len(files)})
 
 
@@ -1417,73 +1642,14 @@ def list_indexed_files():
 
 # ============== FILE MANAGEMENT API ==============
 
-@app.route("/api/files", methods=["GET"])
-def list_uploaded_files():
-    """List all uploaded files with metadata."""
-    files = []
-    
-    if os.path.exists(UPLOAD_DIR):
-        # Get indexed files once at the beginning (cached already, but still avoid repeated calls)
-        indexed_files_set = set(get_indexed_files())
-        
-        for filename in os.listdir(UPLOAD_DIR):
-            filepath = os.path.join(UPLOAD_DIR, filename)
-            if os.path.isfile(filepath):
-                stat = os.stat(filepath)
-                ext = os.path.splitext(filename)[1].lower()
-                
-                # Determine file type icon
-                file_type = "document"
-                if ext == ".pdf":
-                    file_type = "pdf"
-                elif ext in [".doc", ".docx"]:
-                    file_type = "word"
-                elif ext in [".xls", ".xlsx"]:
-                    file_type = "excel"
-                elif ext in [".ppt", ".pptx"]:
-                    file_type = "powerpoint"
-                elif ext in [".txt", ".md"]:
-                    file_type = "text"
-                elif ext == ".csv":
-                    file_type = "csv"
-                elif ext in [".jpg", ".jpeg", ".png", ".gif", ".bmp"]:
-                    file_type = "image"
-                
-                files.append({
-                    "name": filename,
-                    "path": filepath,
-                    "size": stat.st_size,
-                    "size_formatted": format_file_size(stat.st_size),
-                    "modified": stat.st_mtime,
-                    "extension": ext,
-                    "type": file_type,
-                    "indexed": filename in indexed_files_set
-                })
-    
-    # Sort by modified time (newest first)
-    files.sort(key=lambda x: x["modified"], reverse=True)
-    return jsonify({"files": files, "count": len(files)})
-
-
-def format_file_size(size_bytes):
-    """Format file size in human-readable format."""
-    if size_bytes < 1024:
-        return f"{size_bytes} B"
-    elif size_bytes < 1024 * 1024:
-        return f"{size_bytes / 1024:.1f} KB"
-    elif size_bytes < 1024 * 1024 * 1024:
-        return f"{size_bytes / (1024 * 1024):.1f} MB"
-    else:
-        return f"{size_bytes / (1024 * 1024 * 1024):.1f} GB"
-
-
-
 # Serve uploaded files for preview
 from flask import send_from_directory
 
 @app.route("/uploaded_files/<path:filename>")
 def serve_uploaded_file(filename):
-    """Serve uploaded files for preview."""
+    """Serve uploaded files (and chat attachments, which chat history links here) for preview."""
+    if not os.path.isfile(os.path.join(UPLOAD_DIR, filename)):
+        return send_from_directory(CHAT_ATTACHMENTS_DIR, filename)
     return send_from_directory(UPLOAD_DIR, filename)
 
 
@@ -1758,5 +1924,6 @@ if __name__ == "__main__":
     logger.info(f"Hybrid Search: {'Enabled' if config.get('use_hybrid_search') else 'Disabled'}")
     logger.info(f"{'='*50}")
     
-    # Production run (default)
+    # Development server (reloader + debugger). For concurrent users run
+    # `python serve.py`, which starts a multi-worker production server.
     app.run(host='127.0.0.1', port=8501, debug=True)
@@ -2,16 +2,24 @@
 Enhanced RAG Backend with Hybrid Search, Configurable Settings, and Better Error Handling.
 """
 
+import hashlib
+import json
 import os
 import pickle
 import re
-import traceback
+import shutil
+import sys
+import threading
+import time
 import logging
-from typing import List, Tuple, Optional, Any
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Tuple, Optional, Any
 from collections import Counter
+from itertools import chain, islice
 import math
+import numpy as np
 
-logger = logging.getLogger("RAG_Agent")
+logger = logging.getLogger("RAG_Agent.backend")
 
 from langchain_community.document_loaders import (
     PyPDFLoader, TextLoader, Docx2txtLoader, 
@@ -19,10 +27,38 @@ from langchain_community.document_loaders import (
 )
 from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings, ChatOllama
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
 
 from config_manager import load_config, get_config_value
+from collection_manager import (
+    DEFAULT_COLLECTION, CollectionCache, get_collection_config, resolve_collections
+)
+import database
+import knowledge_graph
+from knowledge_graph import document_terms, top_terms
+from corpus_graph import build_corpus_graph, load_corpus_graph, save_corpus_graph
+from vector_index import (
+    RescoredIndex, VECTORS_FILE, ensure_index_type, apply_search_params, append_vectors, wrap_for_search,
+    describe_compression, index_memory_stats, load_ann_report, read_vectors
+)
+from metadata_filter import MetadataIndex, resolve_tag_sources
+from chunking import iter_chunks
+from loaders import TextStreamLoader, read_text
+from parsed_cache import file_digest, get_parsed_cache
+from ocr import OCRPDFLoader, ocr_available
+from vision import IMAGE_EXTENSIONS, ImageLoader
+from token_counter import count_tokens
+from dedup import (
+    EmbeddedChunks, SimHashIndex, append_aliases, apply_aliases, chunk_sources, deduplicate, load_aliases,
+    remove_aliases, simhash
+)
+from sharding import (
+    ShardedVectorStore, ShardedBM25, get_search_pool, get_shard_count, write_shard_count,
+    index_exists, shard_for_source, shard_path, store_shards, search_shards
+)
+from segments import (
+    delta_contents, delta_documents, list_delta_paths, needs_compaction, remove_deltas, write_delta
+)
 
 # BM25 index storage path
 # Cache for BM25 path to avoid recomputation
@@ -34,17 +70,102 @@ def get_bm25_path(db_path: str) -> str:
         _bm25_path_cache[db_path] = os.path.join(db_path, "bm25_index.pkl")
     return _bm25_path_cache[db_path]
 
+# Marker rewritten after every index write. Server workers compare its mtime
+# to notice that another process changed the index on disk.
+INDEX_GENERATION_FILE = ".generation"
+
+
+def get_index_generation(db_path: str) -> int:
+    """Return the on-disk index generation (marker mtime in ns), 0 if there is no index."""
+    try:
+        return os.stat(os.path.join(db_path, INDEX_GENERATION_FILE)).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _bump_index_generation(db_path: str):
+    """Publish a new index generation to every worker process."""
+    marker = os.path.join(db_path, INDEX_GENERATION_FILE)
+    tmp_marker = f"{marker}.{os.getpid()}.tmp"
+    with open(tmp_marker, "w") as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp_marker, marker)
+
+
+@contextmanager
+def index_write_lock(db_path: str):
+    """
+    Cross-process lock serializing index writers (ingest, clear).
+    Each production worker has its own ingest thread, so two uploads
+    handled by different workers must not rewrite the index concurrently.
+    """
+    lock_path = f"{os.path.abspath(db_path)}.lock"
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, "a+") as lock_file:
+        if sys.platform == "win32":
+            import msvcrt
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK gives up after ~10s; keep waiting
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def save_faiss_store(db: FAISS, db_path: str):
+    """
+    Save a FAISS store without rewriting files in place.
+    Workers may have index.faiss memory-mapped, so new files are written
+    beside it and renamed over the old ones.
+    """
+    tmp_path = f"{db_path}.{os.getpid()}.tmp"
+    db.save_local(tmp_path)
+    os.makedirs(db_path, exist_ok=True)
+    for name in ("index.faiss", "index.pkl"):
+        os.replace(os.path.join(tmp_path, name), os.path.join(db_path, name))
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_faiss_store(db_path: str, embeddings: OllamaEmbeddings, mmap: bool = False) -> FAISS:
+    """
+    Load a FAISS store saved with save_local.
+
+    With mmap=True the vectors are memory-mapped read-only instead of copied
+    onto the heap, so every worker process shares one copy through the OS page
+    cache. Such a store must not be written to (ingest loads its own copy).
+    """
+    if mmap:
+        try:
+            import faiss
+            index = faiss.read_index(
+                os.path.join(db_path, "index.faiss"),
+                faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+            )
+            with open(os.path.join(db_path, "index.pkl"), "rb") as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+            return FAISS(embeddings, index, docstore, index_to_docstore_id)
+        except Exception as e:
+            logger.warning("Memory-mapped FAISS load failed (%s), falling back to a full load", e)
+    return FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
+
+
 # Global cache variables for performance optimization
-_CACHED_DB = None
-_CACHED_BM25 = None
-_CACHED_RETRIEVER = None
 _CACHED_LLM = None
 _CACHED_MODEL_NAME = None
-_CACHED_CONFIG = None # To detect config changes (db_path, embed_model)
-
-# Cache for indexed files list (invalidated on index changes)
-_indexed_files_cache = None
-_indexed_files_cache_time = 0
+_llm_lock = threading.Lock()
 
 
 
@@ -60,80 +181,140 @@ class BM25Index:
         self.documents: List[Document] = []
         self.doc_lengths: List[int] = []
         self.avg_doc_length: float = 0
-        self.doc_freqs: Counter = Counter()
-        self.idf: dict = {}
         self.doc_term_freqs: List[Counter] = []
+        # Derived, not pickled: term -> (doc positions, term frequencies),
+        # per-document length normalization, and the BM25 weights of the
+        # terms queried so far (term -> weights aligned with the positions)
+        self._postings: dict = {}
+        self._norms = np.zeros(0)
+        self._weights: dict = {}
     
     def _tokenize(self, text: str) -> List[str]:
         """Simple tokenization: lowercase and split on non-alphanumeric."""
         return re.findall(r'\w+', text.lower())
     
+    @property
+    def doc_freqs(self) -> Counter:
+        """Number of documents containing each term."""
+        return Counter({term: len(ids) for term, (ids, _) in self._postings.items()})
+    
     def fit(self, documents: List[Document]):
         """Build the BM25 index from documents."""
         self.documents = documents
         self.doc_term_freqs = []
         self.doc_lengths = []
+        # Refitting must not double-count
+        self._postings = {}
+        self._append(documents)
+    
+    def extend(self, documents: List[Document]) -> 'BM25Index':
+        """
+        A new index over this index's documents followed by documents. Only
+        the new documents are tokenized; their postings are appended to the
+        existing ones. This index is left as it is (generations are immutable).
+        """
+        index = BM25Index(k1=self.k1, b=self.b)
+        index.documents = self.documents + list(documents)
+        index.doc_lengths = list(self.doc_lengths)
+        index.doc_term_freqs = list(self.doc_term_freqs)
+        index._postings = dict(self._postings)
+        index._append(index.documents[len(self.documents):])
+        return index
+    
+    def _append(self, documents: List[Document]):
+        """Tokenize documents and add them after the documents indexed so far."""
+        term_freqs = [Counter(self._tokenize(doc.page_content)) for doc in documents]
+        self.doc_lengths.extend(sum(term_freq.values()) for term_freq in term_freqs)
+        self._add_postings(term_freqs)
+    
+    def _add_postings(self, term_freqs: List[Counter]):
+        """
+        Append the postings of documents (given as their term frequencies),
+        then update the collection statistics. Queried BM25 weights are
+        recomputed lazily, since IDF and average length have changed.
+        """
+        start = len(self.doc_term_freqs)
+        self.doc_term_freqs.extend(term_freqs)
+        new_postings = {}
+        for i, term_freq in enumerate(term_freqs, start):
+            for term, tf in term_freq.items():
+                ids, tfs = new_postings.setdefault(term, ([], []))
+                ids.append(i)
+                tfs.append(tf)
+        for term, (ids, tfs) in new_postings.items():
+            ids, tfs = np.array(ids, dtype="int64"), np.array(tfs, dtype="float64")
+            existing = self._postings.get(term)
+            if existing is not None:
+                ids, tfs = np.concatenate([existing[0], ids]), np.concatenate([existing[1], tfs])
+            self._postings[term] = (ids, tfs)
         
-        # Calculate term frequencies for each document
-        for doc in documents:
-            tokens = self._tokenize(doc.page_content)
-            self.doc_lengths.append(len(tokens))
-            term_freq = Counter(tokens)
-            self.doc_term_freqs.append(term_freq)
-            
-            # Update document frequencies (how many docs contain each term)
-            for term in set(tokens):
-                self.doc_freqs[term] += 1
-        
-        self.avg_doc_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0
-        
-        # Calculate IDF for each term
-        n_docs = len(documents)
-        for term, df in self.doc_freqs.items():
-            self.idf[term] = math.log((n_docs - df + 0.5) / (df + 0.5) + 1)
+        lengths = np.asarray(self.doc_lengths, dtype="float64")
+        self.avg_doc_length = float(lengths.mean()) if len(lengths) else 0
+        self._norms = self.k1 * (1 - self.b + self.b * lengths / (self.avg_doc_length or 1))
+        self._weights = {}
+    
+    def _term_weights(self, term: str) -> Optional[np.ndarray]:
+        """
+        BM25 weight of a term in each document of its posting, computed on
+        first use and kept, so a query is a few vectorized adds (which
+        release the GIL) instead of a Python loop over every document.
+        """
+        weights = self._weights.get(term)
+        if weights is None:
+            posting = self._postings.get(term)
+            if posting is None:
+                return None
+            ids, tfs = posting
+            idf = math.log((len(self.doc_lengths) - len(ids) + 0.5) / (len(ids) + 0.5) + 1)
+            weights = self._weights[term] = idf * tfs * (self.k1 + 1) / (tfs + self._norms[ids])
+        return weights
+    
+    def term_postings(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """(document positions, BM25 weights) of the documents containing a term, None if none do."""
+        weights = self._term_weights(term)
+        return None if weights is None else (self._postings[term][0], weights)
     
-    def search(self, query: str, k: int = 5) -> List[Tuple[Document, float]]:
-        """Search for documents matching the query."""
+    def search(self, query: str, k: int = 5, candidates: Optional[Any] = None) -> List[Tuple[Document, float]]:
+        """
+        Search for documents matching the query.
+        candidates: optional document positions to rank (e.g. from a metadata filter); others are never returned.
+        """
         if not self.documents:
             return []
         
-        query_tokens = self._tokenize(query)
-        scores = []
+        scores = np.zeros(len(self.documents))
+        for token in self._tokenize(query):
+            weights = self._term_weights(token)
+            if weights is not None:
+                scores[self._postings[token][0]] += weights
         
-        for i, doc in enumerate(self.documents):
-            score = 0
-            doc_len = self.doc_lengths[i]
-            term_freqs = self.doc_term_freqs[i]
-            
-            for token in query_tokens:
-                if token in term_freqs:
-                    tf = term_freqs[token]
-                    idf = self.idf.get(token, 0)
-                    
-                    # BM25 formula
-                    numerator = tf * (self.k1 + 1)
-                    denominator = tf + self.k1 * (1 - self.b + self.b * (doc_len / self.avg_doc_length))
-                    score += idf * (numerator / denominator)
-            
-            scores.append((doc, score))
-        
-        # Sort by score and return top k
-        scores.sort(key=lambda x: x[1], reverse=True)
-        return scores[:k]
+        positions = np.arange(len(self.documents)) if candidates is None else np.asarray(candidates, dtype="int64")
+        candidate_scores = scores[positions]
+        if len(positions) > k:
+            # Everything above the k-th best score, then the earliest ties
+            kth_score = -np.partition(-candidate_scores, k - 1)[k - 1]
+            above = np.flatnonzero(candidate_scores > kth_score)
+            ties = np.flatnonzero(candidate_scores == kth_score)[:k - len(above)]
+            top = np.concatenate([above, ties])
+        else:
+            top = np.arange(len(positions))
+        # Sort by score, ties by position (same order as a stable full sort)
+        top = top[np.lexsort((positions[top], -candidate_scores[top]))]
+        return [(self.documents[positions[i]], float(candidate_scores[i])) for i in top]
     
     def save(self, path: str):
-        """Save the BM25 index to disk."""
-        with open(path, 'wb') as f:
+        """Save the BM25 index to disk (atomically, readers never see a partial file)."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
             pickle.dump({
                 'documents': self.documents,
                 'doc_lengths': self.doc_lengths,
                 'avg_doc_length': self.avg_doc_length,
-                'doc_freqs': self.doc_freqs,
-                'idf': self.idf,
                 'doc_term_freqs': self.doc_term_freqs,
                 'k1': self.k1,
                 'b': self.b
             }, f)
+        os.replace(tmp_path, path)
     
     @classmethod
     def load(cls, path: str) -> Optional['BM25Index']:
@@ -146,14 +327,16 @@ class BM25Index:
             
             index = cls(k1=data.get('k1', 1.5), b=data.get('b', 0.75))
             index.documents = data['documents']
-            index.doc_lengths = data['doc_lengths']
-            index.avg_doc_length = data['avg_doc_length']
-            index.doc_freqs = data['doc_freqs']
-            index.idf = data['idf']
-            index.doc_term_freqs = data.get('doc_term_freqs', [])
+            index.doc_lengths = list(data['doc_lengths'])
+            term_freqs = data.get('doc_term_freqs')
+            if term_freqs is None or len(term_freqs) != len(index.documents):
+                # Written without term frequencies: tokenize again
+                index.fit(index.documents)
+            else:
+                index._add_postings(term_freqs)
             return index
         except Exception as e:
-            print(f"Error loading BM25 index: {e}")
+            logger.error("Error loading BM25 index: %s", e)
             return None
 
 
@@ -162,24 +345,65 @@ class HybridRetriever:
     Combines vector search (FAISS) with keyword search (BM25) for better retrieval.
     """
     
-    def __init__(self, vector_store: FAISS, bm25_index: BM25Index, alpha: float = 0.5):
+    def __init__(self, vector_store: FAISS, bm25_index: Optional[BM25Index], alpha: float = 0.5, k: Optional[int] = None):
         """
         Args:
             vector_store: FAISS vector store for semantic search
-            bm25_index: BM25 index for keyword search
+            bm25_index: BM25 index for keyword search (None = vector search only)
             alpha: Weight for vector search (1-alpha for BM25). Default 0.5 = equal weight
+            k: Results per invoke (default: config retrieval_k)
         """
         self.vector_store = vector_store
         self.bm25_index = bm25_index
         self.alpha = alpha
+        self.k = k
+        # Built on the first filtered query (benign race: values are equivalent)
+        self._vector_metadata = None
+        self._bm25_metadata = None
+    
+    def _vector_metadata_indexes(self) -> List[MetadataIndex]:
+        """One MetadataIndex per FAISS shard (just one for an unsharded store), by vector id."""
+        if self._vector_metadata is None:
+            self._vector_metadata = [
+                MetadataIndex(shard.docstore.search(shard.index_to_docstore_id[i]) for i in range(shard.index.ntotal))
+                for shard in store_shards(self.vector_store)
+            ]
+        return self._vector_metadata
+    
+    def _bm25_metadata_index(self) -> MetadataIndex:
+        if self._bm25_metadata is None:
+            self._bm25_metadata = MetadataIndex(self.bm25_index.documents)
+        return self._bm25_metadata
+    
+    def _filtered_vector_search(self, query: str, k: int, metadata_filter: dict, tag_sources) -> List[Tuple[Document, float]]:
+        """Vector search restricted to the chunk ids matching the filter."""
+        ids_per_shard = [
+            metadata.matching_ids(metadata_filter, tag_sources) for metadata in self._vector_metadata_indexes()
+        ]
+        if not any(len(ids) for ids in ids_per_shard):
+            return []
+        query_vector = self.vector_store.embeddings.embed_query(query)
+        return search_shards(store_shards(self.vector_store), query_vector, k, ids_per_shard)
     
-    def get_relevant_documents(self, query: str, k: int = 5) -> List[Document]:
-        """Retrieve documents using hybrid search."""
+    def get_relevant_documents(self, query: str, k: int = 5, filter: Optional[dict] = None) -> List[Document]:
+        """
+        Retrieve documents using hybrid search.
+        filter: normalized metadata filter (see metadata_filter.normalize_filter);
+        only matching chunks are scored.
+        """
+        tag_sources = resolve_tag_sources(filter) if filter else None
+        
         # Get vector search results
-        vector_results = self.vector_store.similarity_search_with_score(query, k=k*2)
+        if filter:
+            vector_results = self._filtered_vector_search(query, k*2, filter, tag_sources)
+        else:
+            vector_results = self.vector_store.similarity_search_with_score(query, k=k*2)
         
         # Get BM25 results
-        bm25_results = self.bm25_index.search(query, k=k*2)
+        bm25_results = []
+        if self.bm25_index is not None:
+            candidates = self._bm25_metadata_index().matching_ids(filter, tag_sources) if filter else None
+            bm25_results = self.bm25_index.search(query, k=k*2, candidates=candidates)
         
         # Normalize and combine scores
         doc_scores = {}
@@ -222,11 +446,350 @@ class HybridRetriever:
         results.sort(key=lambda x: x[1], reverse=True)
         return [doc for doc, score in results[:k]]
     
-    def invoke(self, query: str) -> List[Document]:
+    def invoke(self, query: str, filter: Optional[dict] = None) -> List[Document]:
+        """LangChain-compatible invoke method."""
+        k = self.k or load_config().get('retrieval_k', 3)
+        return self.get_relevant_documents(query, k=k, filter=filter)
+
+
+class MultiCollectionRetriever:
+    """
+    Queries several collections and merges their ranked results with
+    reciprocal rank fusion. Scores from different collections (possibly
+    different embedding models) aren't comparable, but ranks are.
+    """
+    
+    RRF_K = 60  # Standard RRF damping constant
+    
+    def __init__(self, retrievers: dict, k: int = 5):
+        """
+        Args:
+            retrievers: {collection_name: retriever}
+            k: Number of merged results
+        """
+        self.retrievers = retrievers
+        self.k = k
+    
+    def get_relevant_documents(self, query: str, k: int = 5, filter: Optional[dict] = None) -> List[Document]:
+        fused = {}
+        for name, retriever in self.retrievers.items():
+            for rank, doc in enumerate(retriever.invoke(query, filter=filter)):
+                doc_id = (name, doc.page_content[:100])
+                entry = fused.setdefault(doc_id, [doc, 0.0])
+                entry[1] += 1.0 / (self.RRF_K + rank + 1)
+        ranked = sorted(fused.values(), key=lambda entry: entry[1], reverse=True)
+        return [doc for doc, _ in ranked[:k]]
+    
+    def invoke(self, query: str, filter: Optional[dict] = None) -> List[Document]:
         """LangChain-compatible invoke method."""
-        config = load_config()
-        k = config.get('retrieval_k', 3)
-        return self.get_relevant_documents(query, k=k)
+        return self.get_relevant_documents(query, k=self.k, filter=filter)
+
+
+class ReadWriteLock:
+    """
+    Many concurrent readers or one exclusive writer.
+    Writer-preferring: once a writer waits, new readers queue behind it so a
+    steady stream of queries cannot starve an index swap.
+    """
+    
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+    
+    @contextmanager
+    def read_lock(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+    
+    @contextmanager
+    def write_lock(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class IndexGeneration:
+    """
+    A fully loaded snapshot of the search indexes (FAISS + optional BM25).
+    Never modified after construction: new data means building a new
+    generation and swapping it in, so readers never see a half-loaded store.
+    """
+    
+    def __init__(self, config_key: tuple, disk_generation: int, db: FAISS, bm25: Optional[BM25Index] = None,
+                 stores: Optional[dict] = None, collection: str = DEFAULT_COLLECTION):
+        self.config_key = config_key
+        self.disk_generation = disk_generation
+        self.collection = collection
+        self.db = db
+        self.bm25 = bm25
+        # {shard: ([main, delta, ...], bm25)}, reused by the next ingest
+        self.stores = stores or {}
+        self.loaded_at = time.time()
+        self.stale = False
+        # Derived, lazily built caches (benign races: values are equivalent)
+        self._retrievers = {}
+        self._indexed_files = None
+        self._sources = None
+        self._simhash_index = None
+    
+    @classmethod
+    def from_stores(cls, config_key: tuple, disk_generation: int, stores: dict,
+                    collection: str = DEFAULT_COLLECTION) -> 'IndexGeneration':
+        """
+        Build a generation from per-store segments ({shard: ([main, delta, ...], bm25)};
+        shard 0 for an unsharded index). All segments are searched as one vector store.
+        """
+        segments = {
+            (shard, i): segment
+            for shard, (store_segments, _) in stores.items() for i, segment in enumerate(store_segments)
+        }
+        db = next(iter(segments.values())) if len(segments) == 1 else ShardedVectorStore(segments)
+        bm25_shards = {shard: bm25 for shard, (_, bm25) in stores.items() if bm25 is not None}
+        use_hybrid = config_key[3]
+        if not use_hybrid or not bm25_shards:
+            bm25 = None
+        elif len(stores) == 1:
+            bm25 = next(iter(bm25_shards.values()))
+        else:
+            bm25 = ShardedBM25(bm25_shards)
+        return cls(config_key, disk_generation, db, bm25, stores, collection)
+    
+    def matches(self, config_key: tuple, disk_generation: int) -> bool:
+        return not self.stale and self.config_key == config_key and self.disk_generation == disk_generation
+    
+    def get_retriever(self, use_hybrid: bool, alpha: float, k: int):
+        """Hybrid retriever if BM25 is loaded and enabled, else vector-only (both accept metadata filters)."""
+        hybrid = bool(use_hybrid and self.bm25 is not None)
+        key = (hybrid, alpha, k)
+        retriever = self._retrievers.get(key)
+        if retriever is None:
+            if hybrid:
+                retriever = HybridRetriever(self.db, self.bm25, alpha=alpha, k=k)
+            else:
+                retriever = HybridRetriever(self.db, None, alpha=1.0, k=k)
+            self._retrievers[key] = retriever
+        else:
+            logger.debug("Using cached retriever (cache hit)")
+        return retriever
+    
+    def get_indexed_files(self) -> List[str]:
+        """Names of the indexed files, sorted (one list object per generation)."""
+        if self._indexed_files is None:
+            self._indexed_files = [source["source"] for source in self.get_sources()]
+        return self._indexed_files
+    
+    def get_sources(self) -> List[dict]:
+        """
+        The indexed files [{source, full_path, chunks, bytes, ingested_at,
+        content_hash}], sorted by source. Read from the sources table, which
+        index writes keep current; the docstore is only scanned (and the
+        table rebuilt) when the table is behind, e.g. for an index built
+        before it existed.
+        """
+        if self._sources is None:
+            sources = None
+            try:
+                sources = database.get_sources(self.collection, self.disk_generation)
+            except Exception as e:
+                logger.warning("Could not read the sources table: %s", e)
+            if sources is None:
+                sources = self._scan_sources()
+                # An older generation than the one on disk must not overwrite newer rows
+                if self.disk_generation == get_index_generation(self.config_key[0]):
+                    try:
+                        database.set_sources(self.collection, self.disk_generation, sources)
+                        logger.info("Rebuilt the sources table of collection %s (%d files)",
+                                    self.collection, len(sources))
+                    except Exception as e:
+                        logger.warning("Could not rebuild the sources table: %s", e)
+                for source in sources:
+                    del source["terms"]  # Only stored, for the knowledge graph
+            self._sources = sources
+        return self._sources
+    
+    def _scan_sources(self) -> List[dict]:
+        """The sources listing (with "terms") from a scan of every chunk (content hashes unknown)."""
+        files = {}
+        for doc in self.db.docstore._dict.values():
+            primary = doc.metadata.get('source')
+            terms = document_terms(doc.page_content)
+            for source in chunk_sources(doc):
+                if not source:
+                    continue
+                entry = files.setdefault(source, {"source": source, "full_path": None, "chunks": 0, "bytes": None,
+                                                  "ingested_at": None, "content_hash": None, "terms": Counter()})
+                entry["chunks"] += 1
+                entry["terms"].update(terms)
+                ingested_at = doc.metadata.get('ingested_at', 0)
+                if source == primary and (entry["ingested_at"] is None or entry["ingested_at"] < ingested_at):
+                    entry["full_path"] = doc.metadata.get('full_path', source)
+                    entry["ingested_at"] = ingested_at
+        max_terms = get_config_value('graph_terms_per_file', 64)
+        for entry in files.values():
+            entry["terms"] = top_terms(entry["terms"], max_terms)
+            try:
+                entry["bytes"] = os.path.getsize(entry["full_path"])
+            except (OSError, TypeError):
+                pass
+        return [files[source] for source in sorted(files)]
+    
+    def get_simhash_index(self) -> SimHashIndex:
+        """SimHashes of the indexed chunks, keyed (shard, segment, vector id) (built once, for dedup)."""
+        if self._simhash_index is None:
+            index = SimHashIndex()
+            for shard, (segments, _) in self.stores.items():
+                for segment_number, segment in enumerate(segments):
+                    for i in range(segment.index.ntotal):
+                        value = segment.docstore.search(segment.index_to_docstore_id[i]).metadata.get('simhash')
+                        if value is not None:
+                            index.add(value, (shard, segment_number, i))
+            self._simhash_index = index
+        return self._simhash_index
+    
+    def chunk(self, key: tuple) -> Document:
+        shard, segment_number, i = key
+        segment = self.stores[shard][0][segment_number]
+        return segment.docstore.search(segment.index_to_docstore_id[i])
+    
+    def stored_vector(self, key: tuple) -> Optional[np.ndarray]:
+        """A chunk's vector: exact if the index keeps it, approximate if compressed, None if unavailable."""
+        shard, segment_number, i = key
+        index = self.stores[shard][0][segment_number].index
+        if isinstance(index, RescoredIndex):
+            return np.asarray(index.vectors[i])
+        try:
+            return index.reconstruct(i)
+        except RuntimeError:
+            return None  # e.g. IVF without a direct map
+
+
+class IndexHolder:
+    """
+    Thread-safe holder of the active IndexGeneration.
+    
+    Readers take the current generation under a read lock; a new generation
+    is loaded outside any lock and swapped in atomically under the write lock.
+    When the data changed but the config did not, the reload runs on a
+    background thread and requests keep answering from the old generation,
+    so only a cold start or a config change makes a request wait on disk.
+    """
+    
+    def __init__(self):
+        self._rw_lock = ReadWriteLock()
+        self._load_lock = threading.Lock()
+        self._current: Optional[IndexGeneration] = None
+    
+    def current(self) -> Optional[IndexGeneration]:
+        with self._rw_lock.read_lock():
+            return self._current
+    
+    def swap(self, generation: Optional[IndexGeneration]) -> Optional[IndexGeneration]:
+        """Atomically install a new generation; returns the previous one."""
+        with self._rw_lock.write_lock():
+            previous, self._current = self._current, generation
+        return previous
+    
+    def swap_unless_older(self, generation: Optional[IndexGeneration], config_key: tuple,
+                          disk_generation: int) -> bool:
+        """
+        Install a generation loaded for (config_key, disk_generation) unless a newer
+        one of the same config was swapped in meanwhile (an ingest published while
+        it loaded). Returns whether it was installed.
+        """
+        with self._rw_lock.write_lock():
+            current = self._current
+            if (current is not None and not current.stale and current.config_key == config_key
+                    and current.disk_generation > disk_generation):
+                return False
+            self._current = generation
+        return True
+    
+    def invalidate(self):
+        """Force the next get_or_load to build a new generation."""
+        current = self.current()
+        if current is not None:
+            current.stale = True
+    
+    def get_or_load(self, config_key: tuple, disk_generation: int, loader) -> Optional[IndexGeneration]:
+        current = self.current()
+        if current is not None and current.matches(config_key, disk_generation):
+            return current
+        
+        # Same config, just older data: keep serving it, reload in the background
+        if current is not None and current.config_key == config_key:
+            self.reload_in_background(config_key, disk_generation, loader)
+            return current
+        
+        # Cold start or config change: nothing valid to serve, load inline
+        with self._load_lock:
+            current = self.current()
+            if current is not None and current.matches(config_key, disk_generation):
+                return current
+            generation = loader()
+            if not self.swap_unless_older(generation, config_key, disk_generation):
+                return self.current()
+            return generation
+    
+    def reload_in_background(self, config_key: tuple, disk_generation: int, loader):
+        """Build the next generation on a daemon thread (no-op if a load is running)."""
+        if not self._load_lock.acquire(blocking=False):
+            return
+        
+        def _reload():
+            try:
+                current = self.current()
+                if current is not None and current.matches(config_key, disk_generation):
+                    return
+                generation = loader()
+                if generation is None and disk_generation:
+                    # Index still exists on disk, so this was a load error
+                    logger.warning("Background index reload failed; keeping previous generation")
+                    return
+                if self.swap_unless_older(generation, config_key, disk_generation):
+                    logger.info("Swapped in index generation %s", disk_generation)
+                else:
+                    logger.debug("Dropped reloaded index generation %s: a newer one is active", disk_generation)
+            except Exception as e:
+                logger.error("Background index reload failed: %s", e)
+            finally:
+                self._load_lock.release()
+        
+        threading.Thread(target=_reload, name="index-reload", daemon=True).start()
+
+
+# One IndexHolder per collection, shared by all request threads.
+# Idle collections are unloaded (see collection_manager.CollectionCache).
+_COLLECTIONS = CollectionCache(IndexHolder)
+
+
+def _index_holder(collection: Optional[str] = None, config: Optional[dict] = None) -> IndexHolder:
+    """Get (creating if needed) the IndexHolder of a collection."""
+    config = config or load_config()
+    return _COLLECTIONS.get(
+        collection or DEFAULT_COLLECTION,
+        max_loaded=config.get('max_loaded_collections', 4),
+        idle_seconds=config.get('collection_idle_seconds', 1800),
+    )
 
 
 def expand_query(original_query: str, llm: ChatOllama) -> List[str]:
@@ -241,17 +804,17 @@ def expand_query(original_query: str, llm: ChatOllama) -> List[str]:
         queries = [q.strip() for q in response.content.split('\n') if q.strip()]
         return queries[:3] # Limit to top 3 expansions
     except Exception as e:
-        print(f"Query expansion failed: {e}")
+        logger.warning("Query expansion failed: %s", e)
         return [original_query]
 
-def deep_search(query: str, retriever: Any, llm: ChatOllama) -> List[Document]:
+def deep_search(query: str, retriever: Any, llm: ChatOllama, filter: Optional[dict] = None) -> List[Document]:
     """
     Perform deep search by expanding queries and deduplicating results.
     """
     # 1. Expand Query
-    print(f"[Deep Search] Original: {query}")
+    logger.debug("[Deep Search] Original: %s", query)
     expanded_queries = expand_query(query, llm)
-    print(f"[Deep Search] Variations: {expanded_queries}")
+    logger.debug("[Deep Search] Variations: %s", expanded_queries)
     
     # 2. Retrieve for all queries (including original)
     all_queries = [query] + expanded_queries
@@ -259,7 +822,7 @@ def deep_search(query: str, retriever: Any, llm: ChatOllama) -> List[Document]:
     seen_sources = set()
     
     for q in all_queries:
-        docs = retriever.invoke(q)
+        docs = retriever.invoke(q, filter=filter)
         for doc in docs:
             # unique ID based on content hash or metadata source
             # Using content[:100] + source as rudimentary ID
@@ -273,21 +836,26 @@ def deep_search(query: str, retriever: Any, llm: ChatOllama) -> List[Document]:
     return combined_docs[:8] # Return top 8 unique documents
 
 
-def get_loader(file_path: str):
+def get_loader(file_path: str, config: Optional[dict] = None):
     """Factory to pick the right loader for the file type."""
+    config = config or load_config()
     ext = os.path.splitext(file_path)[1].lower()
+    # Scanned pages are OCR'd when tesseract is installed (see ocr.py)
+    use_ocr = config.get('ocr_enabled', True) and ocr_available()
     loaders = {
-        ".pdf": lambda: PyPDFLoader(file_path),
-        ".txt": lambda: TextLoader(file_path, encoding="utf-8"),
+        ".pdf": lambda: OCRPDFLoader(file_path, config) if use_ocr else PyPDFLoader(file_path),
+        ".txt": lambda: TextStreamLoader(file_path, encoding="utf-8"),
         ".md": lambda: TextLoader(file_path, encoding="utf-8"),
         ".docx": lambda: Docx2txtLoader(file_path),
         ".csv": lambda: CSVLoader(file_path),
         ".xlsx": lambda: UnstructuredExcelLoader(file_path, mode="elements"),
         ".xls": lambda: UnstructuredExcelLoader(file_path, mode="elements"),
-        ".pptx": lambda: UnstructuredPowerPointLoader(file_path),
-        ".ppt": lambda: UnstructuredPowerPointLoader(file_path),
-        ".xaml": lambda: TextLoader(file_path, encoding="utf-8"),
+        ".pptx": lambda: UnstructuredPowerPointLoader(file_path, mode="elements"),
+        ".ppt": lambda: UnstructuredPowerPointLoader(file_path, mode="elements"),
+        ".xaml": lambda: TextStreamLoader(file_path, encoding="utf-8"),
     }
+    # Images: vision model description (cached) plus OCR text
+    loaders.update({image_ext: lambda: ImageLoader(file_path, config) for image_ext in IMAGE_EXTENSIONS})
     
     if ext not in loaders:
         raise ValueError(f"Unsupported file type: {ext}. Supported: {', '.join(loaders.keys())}")
@@ -295,22 +863,37 @@ def get_loader(file_path: str):
     return loaders[ext]()
 
 
-def load_document_content(file_path: str) -> str:
+def load_documents(file_path: str, start: int = 0) -> Iterator[Document]:
+    """
+    A file's documents (pages, rows, elements) from index start on, lazily,
+    through the parsed-text cache: a file parsed before by a preview, chat
+    or ingest isn't parsed again.
+    """
+    config = load_config()
+    loader = get_loader(file_path, config)
+    cache = get_parsed_cache(config)
+    if cache is None:
+        return islice(loader.lazy_load(), start, None)
+    return cache.lazy_load(file_path, loader, start)
+
+
+def load_document_content(file_path: str, max_chars: Optional[int] = None) -> str:
     """
     Load document content as plain text using LangChain loaders.
     Same loaders used for RAG ingestion - ensures consistent parsing.
     
     Args:
         file_path: Path to the document file
+        max_chars: Stop reading the file once this much text is extracted
         
     Returns:
         Extracted text content from the document
     """
     try:
-        loader = get_loader(file_path)
-        docs = loader.load()
-        # Combine all pages/chunks into single text
-        content = "\n\n".join([doc.page_content for doc in docs if doc.page_content.strip()])
+        # Pages/rows are pulled lazily, so a short excerpt doesn't parse the whole file
+        content, truncated = read_text(load_documents(file_path), max_chars)
+        if truncated:
+            logger.debug("Read the first %d chars of %s", max_chars, os.path.basename(file_path))
         return content if content else "(Document appears to be empty)"
     except ValueError as e:
         # Unsupported file type
@@ -319,9 +902,19 @@ def load_document_content(file_path: str) -> str:
         return f"(Error reading document: {str(e)[:200]})"
 
 
-def ingest_files(file_paths: List[str]) -> dict:
+class _IndexingError(Exception):
+    """Embedding or writing a batch of chunks failed (as opposed to reading one file)."""
+
+
+def ingest_files(file_paths: List[str], collection: Optional[str] = None) -> dict:
     """
     Reads files, chunks them, and saves to Vector DB and BM25 index.
+    collection selects a named collection (default: config db_path).
+    Files are streamed page by page (or row by row) into batches of
+    ingest_batch_chunks chunks, each embedded as it fills up. Embedded chunks
+    are written to the index (and made searchable) once ingest_publish_chunks
+    have accumulated and at the end, so memory use doesn't grow with file
+    size and a large file isn't re-published batch after batch.
     Returns: {
         "success": bool,
         "processed_count": int,
@@ -329,430 +922,1009 @@ def ingest_files(file_paths: List[str]) -> dict:
         "results": [{"file": str, "status": "success"|"error", "message": str}]
     }
     """
-    config = load_config()
-    db_path = config.get('db_path', 'faiss_index')
+    collection = collection or DEFAULT_COLLECTION
+    config = get_collection_config(collection)
     embed_model = config.get('embed_model', 'nomic-embed-text')
-    chunk_size = config.get('chunk_size', 1000)
-    chunk_overlap = config.get('chunk_overlap', 200)
-    
-    bm25_path = get_bm25_path(db_path)
+    ollama_host = config.get('ollama_host', 'http://localhost:11434')
+    embeddings = OllamaEmbeddings(model=embed_model, base_url=ollama_host)
+    batch_size = max(1, config.get('ingest_batch_chunks', 2000))
+    publish_size = max(batch_size, config.get('ingest_publish_chunks', 20000))
     
-    all_docs = []
     results = []
     
-    # Track files to index
-    docs_to_index = []
+    # Chunks waiting to be embedded, from the current file and possibly earlier ones
+    pending = []
+    # Embedded chunks waiting to be written to the index, and extra sources of indexed chunks
+    embedded, aliases = EmbeddedChunks(), []
+    indexed_count = 0
+    ingested_at = time.time()
+    files = {os.path.basename(path): path for path in file_paths}
     
-    for path in file_paths:
-        filename = os.path.basename(path)
-        try:
-            loader = get_loader(path)
-            docs = loader.load()
-            
-            if not docs:
-                results.append({"file": filename, "status": "error", "message": "No content found"})
-                continue
-
-            # Add source metadata and prepend source to content for better retrieval
-            for doc in docs:
-                doc.metadata['source'] = filename
-                doc.metadata['full_path'] = path
-                # Prepend source to content so keyword search for filename matches the document
-                doc.page_content = f"Source: {filename}\n\n{doc.page_content}"
-            
-            docs_to_index.extend(docs)
-            results.append({"file": filename, "status": "success", "message": "Processed successfully"})
-            
-        except Exception as e:
-            results.append({"file": filename, "status": "error", "message": str(e)})
-
-    # Calculate stats
-    successful_files = [r for r in results if r["status"] == "success"]
-    failed_files = [r for r in results if r["status"] == "error"]
+    try:
+        for path in file_paths:
+            filename = os.path.basename(path)
+            file_start = len(pending)
+            file_chunks = 0
+            try:
+                docs = _tag_documents(load_documents(path), path, collection, ingested_at)
+                for chunk in iter_chunks(docs, path, config):
+                    # Hashed without the per-file prefix, so boilerplate matches across files
+                    chunk.metadata['simhash'] = simhash(chunk.page_content)
+                    # Prepend source to content so keyword search for filename matches the document
+                    chunk.page_content = f"Source: {filename}\n\n{chunk.page_content}"
+                    # Counted once here so prompts can be packed by tokens without re-tokenizing
+                    chunk.metadata['token_count'] = count_tokens(chunk.page_content, config)
+                    pending.append(chunk)
+                    file_chunks += 1
+                    if len(pending) >= batch_size:
+                        aliases += _embed_chunks(pending, collection, config, embeddings, embedded)
+                        indexed_count += len(pending)
+                        pending, file_start = [], 0
+                        if len(embedded) >= publish_size:
+                            _index_chunks(embedded, aliases, collection, config, embeddings, files, ingested_at)
+                            embedded, aliases = EmbeddedChunks(), []
+                
+                if not file_chunks:
+                    results.append({"file": filename, "status": "error", "message": "No content found"})
+                    continue
+                results.append({"file": filename, "status": "success", "message": "Processed successfully"})
+                
+            except _IndexingError:
+                raise
+            except Exception as e:
+                # Drop the file's chunks that are not embedded yet; full batches are indexed
+                flushed = file_chunks - (len(pending) - file_start)
+                del pending[file_start:]
+                message = str(e) if not flushed else f"{e} (after {flushed} chunks were indexed)"
+                results.append({"file": filename, "status": "error", "message": message})
+        
+        if pending:
+            aliases += _embed_chunks(pending, collection, config, embeddings, embedded)
+            indexed_count += len(pending)
+        if len(embedded) or aliases:
+            _index_chunks(embedded, aliases, collection, config, embeddings, files, ingested_at)
     
-    if not docs_to_index:
+    except _IndexingError as e:
+        # Batches indexed before the failure stay indexed; the rest of the files aren't
         return {
             "success": False,
             "processed_count": 0,
-            "failed_count": len(failed_files),
-            "results": results
+            "failed_count": len(file_paths),
+            "results": [{"file": "BATCH_INDEXING", "status": "error", "message": f"Global indexing failed: {str(e)}"}]
         }
 
-    # Split text for RAG using configured chunk size
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size, 
-        chunk_overlap=chunk_overlap,
-        separators=["\n\n", "\n", ". ", " ", ""]
-    )
-    splits = splitter.split_documents(docs_to_index)
+    # Calculate stats
+    successful_files = [r for r in results if r["status"] == "success"]
+    failed_files = [r for r in results if r["status"] == "error"]
+    
+    return {
+        "success": indexed_count > 0,
+        "processed_count": len(successful_files) if indexed_count else 0,
+        "failed_count": len(failed_files),
+        "results": results
+    }
+
+
+def _tag_documents(docs: Iterable[Document], path: str, collection: str, ingested_at: float) -> Iterator[Document]:
+    """Add source metadata to a file's documents as they are loaded."""
+    filename = os.path.basename(path)
+    for doc in docs:
+        doc.metadata['source'] = filename
+        doc.metadata['full_path'] = path
+        doc.metadata['collection'] = collection
+        doc.metadata['ingested_at'] = ingested_at
+        yield doc
 
+
+def _embed_chunks(chunks: List[Document], collection: str, config: dict, embeddings: OllamaEmbeddings,
+                  embedded: EmbeddedChunks) -> List[Tuple[Document, str]]:
+    """
+    Embed a batch of prepared chunks into embedded, to be indexed later by
+    _index_chunks. Returns the extra sources of indexed chunks that chunks of
+    the batch duplicate, as (indexed chunk, source).
+    Raises _IndexingError if embedding fails.
+    """
     try:
-        # Save to FAISS
-        embeddings = OllamaEmbeddings(model=embed_model)
-        
-        if os.path.exists(db_path):
-            db = FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
-            db.add_documents(splits)
+        # Embed explicitly: compressed indexes also need the exact vectors on disk
+        aliases = []
+        if config.get('dedup_chunks', True):
+            # Near-duplicates (within the batch, of embedded or of indexed chunks) are dropped before embedding where possible
+            existing = get_active_index(collection)
+            chunks, vectors, aliases = deduplicate(
+                chunks, embeddings.embed_documents, config,
+                existing.get_simhash_index() if existing else None,
+                existing.stored_vector if existing else None,
+                embedded,
+            )
+            aliases = [(existing.chunk(key), source) for key, source in aliases]
         else:
-            db = FAISS.from_documents(splits, embeddings)
+            vectors = embeddings.embed_documents([doc.page_content for doc in chunks])
+        embedded.add(chunks, vectors)
+        return aliases
+    except Exception as e:
+        raise _IndexingError(str(e)) from e
+
+
+def _index_chunks(embedded: EmbeddedChunks, aliases: List[Tuple[Document, str]], collection: str, config: dict,
+                  embeddings: OllamaEmbeddings, files: dict, ingested_at: float):
+    """
+    Add embedded chunks to the collection's index (one delta per store) and
+    the extra sources of duplicated indexed chunks, record them in the
+    sources table, then hand the new generation to the cache. files maps
+    the source names being ingested to their paths.
+    Raises _IndexingError if writing fails.
+    """
+    db_path = config.get('db_path', 'faiss_index')
+    try:
+        config_key = _index_config_key(config)
+        holder = _index_holder(collection, config)
         
-        db.save_local(db_path)
+        chunks = embedded.chunks
+        text_embeddings = list(zip([doc.page_content for doc in chunks], embedded.vectors))
+        metadatas = [doc.metadata for doc in chunks]
         
-        # Build/update BM25 index
-        bm25_index = BM25Index.load(bm25_path)
-        if bm25_index:
-            # Add new documents to existing index
-            all_bm25_docs = bm25_index.documents + splits
-            bm25_index.fit(all_bm25_docs)
-        else:
-            bm25_index = BM25Index()
-            bm25_index.fit(splits)
+        # Chunks per source, as a docstore scan would count them (aliased chunks included),
+        # and the terms of the chunks' text for the knowledge graph
+        counts = Counter(source for doc in chunks for source in chunk_sources(doc))
+        counts.update(alias for _, alias in {(id(doc), alias) for doc, alias in aliases
+                                             if alias not in chunk_sources(doc)})
+        terms = {}
+        for doc in chunks:
+            doc_terms = document_terms(doc.page_content)
+            for source in chunk_sources(doc):
+                terms.setdefault(source, Counter()).update(doc_terms)
+        max_terms = config.get('graph_terms_per_file', 64)
+        added_sources = [
+            _source_row(source, files.get(source), count, ingested_at,
+                        top_terms(terms[source], max_terms) if source in terms else None)
+            for source, count in counts.items()
+        ]
         
-        bm25_index.save(bm25_path)
+        with index_write_lock(db_path):
+            # An existing index keeps its layout; index_shards applies to new ones
+            if index_exists(db_path):
+                n_shards = get_shard_count(db_path)
+                if n_shards != max(1, config.get('index_shards', 1)):
+                    logger.warning("%s has %d shard(s), config index_shards=%s: clear and re-ingest to reshard",
+                                   db_path, n_shards, config.get('index_shards'))
+            else:
+                n_shards = max(1, config.get('index_shards', 1))
+            
+            # Segments of the cached generation are reused if it is still current
+            previous = holder.current()
+            previous_generation = get_index_generation(db_path)
+            if previous is not None and previous.matches(config_key, previous_generation):
+                previous_stores = previous.stores
+            else:
+                previous_stores = {}
+            
+            if n_shards > 1:
+                # Only the shards the new files hash to are written
+                write_shard_count(db_path, n_shards)
+            groups = {}
+            for item, metadata in zip(text_embeddings, metadatas):
+                shard = shard_for_source(metadata['source'], n_shards) if n_shards > 1 else 0
+                group = groups.setdefault(shard, ([], []))
+                group[0].append(item)
+                group[1].append(metadata)
+            updated = {
+                shard: _add_to_store(_store_path(db_path, shard, n_shards), items, shard_metadatas,
+                                     embeddings, config, previous_stores.get(shard))
+                for shard, (items, shard_metadatas) in sorted(groups.items())
+            }
+            _record_aliases(db_path, n_shards, aliases, {**previous_stores, **updated})
+            
+            _bump_index_generation(db_path)
+            disk_generation = get_index_generation(db_path)
+            _update_sources(collection, previous_generation, disk_generation, added=added_sources,
+                            max_terms=max_terms)
         
     except Exception as e:
-        # If indexing fails, mark all "successful" loads as verification errors
-        # Note: We can't easily rollback the successful file loads logic-wise, 
-        # but the DB write failed so they aren't indexed.
-        return {
-            "success": False,
-            "processed_count": 0,
-            "failed_count": len(file_paths),
-            "results": [{"file": "BATCH_INDEXING", "status": "error", "message": f"Global indexing failed: {str(e)}"}]
-        }
+        raise _IndexingError(str(e)) from e
     
-    # Clear cache to force reload with new documents
-    clear_rag_cache()
+    # Hand the freshly built in-memory index straight to the cache, so no
+    # request has to reload it from disk
+    generation = _load_index_generation(config, config_key, disk_generation, updated, previous_stores, collection)
+    if generation is not None:
+        holder.swap(generation)
     
-    return {
-        "success": True,
-        "processed_count": len(successful_files),
-        "failed_count": len(failed_files),
-        "results": results
-    }
+    due = [
+        shard for shard, (segments, _) in updated.items()
+        if needs_compaction(segments[0].index.ntotal, [delta.index.ntotal for delta in segments[1:]], config)
+    ]
+    if due:
+        _schedule_compaction(collection, due)
+
+
+def _source_row(source: str, path: Optional[str], chunks: int, ingested_at: float,
+                terms: Optional[dict]) -> dict:
+    """A sources table row for chunks of a file being ingested (size and hash of the file as it is now)."""
+    row = {"source": source, "full_path": path, "chunks": chunks, "bytes": None,
+           "ingested_at": ingested_at, "content_hash": None, "terms": terms}
+    if path is not None:
+        try:
+            # Memoized by path, size and mtime: the parsed-text cache already hashed the file
+            row["bytes"], row["content_hash"] = os.path.getsize(path), file_digest(path)
+        except OSError:
+            pass
+    return row
+
+
+def _update_sources(collection: Optional[str], previous_generation: int, disk_generation: int,
+                    added: Iterable[dict] = (), removed: Iterable[str] = (), max_terms: int = 64):
+    """
+    Apply an index write to the sources table (caller holds index_write_lock).
+    If the table was behind, or the update fails, it stays behind and the
+    next reader rebuilds it from the docstore.
+    """
+    collection = collection or DEFAULT_COLLECTION
+    try:
+        if not database.update_sources(collection, previous_generation, disk_generation, added, removed, max_terms):
+            logger.debug("Sources table of collection %s is behind the index; rebuilt on next read", collection)
+    except Exception as e:
+        logger.warning("Could not update the sources table of collection %s: %s", collection, e)
 
 
-def get_vector_store() -> Optional[FAISS]:
+def _record_aliases(db_path: str, n_shards: int, aliases: List[Tuple[Document, str]], stores: dict):
     """
-    Get the FAISS vector store, using cache if available.
-    Invalidates cache if configuration (path/model) changes.
+    Record the extra sources of indexed chunks whose near-duplicates were
+    dropped, in their store's aliases file (O(new) write, applied on load),
+    and apply them to the loaded chunks of stores ({shard: (segments, bm25)}).
+    Aliases only ever add sources, so generations sharing these chunks may see them early.
     """
-    global _CACHED_DB, _CACHED_CONFIG, _CACHED_RETRIEVER
+    per_store = {}
+    for doc, alias in aliases:
+        if alias in chunk_sources(doc):
+            continue  # Re-ingest of the same file
+        shard = shard_for_source(doc.metadata['source'], n_shards) if n_shards > 1 else 0
+        per_store.setdefault(shard, []).append((doc.metadata['simhash'], doc.metadata['source'], alias))
+    for shard, records in per_store.items():
+        append_aliases(_store_path(db_path, shard, n_shards), records)
+        if shard in stores:
+            segments, bm25 = stores[shard]
+            alias_map = {}
+            for value, source, alias in records:
+                alias_map.setdefault((value, source), []).append(alias)
+            apply_aliases(_store_documents(segments, bm25), alias_map)
+
+
+def _store_documents(segments: List[FAISS], bm25: Optional[BM25Index]):
+    """Every chunk object of a store: FAISS docstore entries and BM25 documents."""
+    docs = chain.from_iterable(segment.docstore._dict.values() for segment in segments)
+    return chain(docs, bm25.documents if bm25 is not None else ())
+
+
+def _store_path(db_path: str, shard: int, n_shards: int) -> str:
+    """Directory of one store: the index itself, or one of its shards."""
+    return shard_path(db_path, shard) if n_shards > 1 else db_path
+
+
+def _add_to_store(store_path: str, text_embeddings: list, metadatas: List[dict],
+                  embeddings: OllamaEmbeddings, config: dict,
+                  previous: Optional[tuple] = None) -> Tuple[List[FAISS], Optional[BM25Index]]:
+    """
+    Add embedded chunks to a store, as a delta segment once it has a main
+    index (only the new chunks are written). Caller holds index_write_lock.
+    previous: the store's (segments, bm25) from the current generation, reused
+    instead of reading the store back from disk.
+    Returns the store's searchable (segments, bm25).
+    """
+    # With deltas turned off (delta_compaction_segments 0) the main index is
+    # rewritten, unless deltas from before are still waiting for compaction
+    deltas_off = config.get('delta_compaction_segments', 8) < 1 and not list_delta_paths(store_path)
+    if deltas_off or not os.path.exists(os.path.join(store_path, "index.faiss")):
+        db, bm25_index = _update_store(store_path, text_embeddings, metadatas, embeddings, config)
+        return [db], bm25_index
     
-    config = load_config()
-    db_path = config.get('db_path', 'faiss_index')
-    embed_model = config.get('embed_model', 'nomic-embed-text')
-    ollama_host = config.get('ollama_host', 'http://localhost:11434')
+    delta = FAISS.from_embeddings(text_embeddings, embeddings, metadatas)
+    write_delta(delta, store_path)
+    if previous is None:
+        return _load_store(store_path, embeddings, config, bool(config.get('mmap_index', True)),
+                           bool(config.get('use_hybrid_search', True)))
     
-    current_config = {
-        "db_path": db_path, 
-        "embed_model": embed_model,
-        "ollama_host": ollama_host
-    }
+    segments, bm25_index = previous
+    if bm25_index is not None:
+        # Generations are immutable: a new index with the delta's postings appended
+        bm25_index = bm25_index.extend(delta_documents(delta))
+    return segments + [delta], bm25_index
+
+
+def _update_store(store_path: str, text_embeddings: list, metadatas: List[dict],
+                  embeddings: OllamaEmbeddings, config: dict, replace: bool = False) -> Tuple[FAISS, BM25Index]:
+    """
+    Append embedded chunks to the main FAISS + BM25 index of the store at
+    store_path and save it (first ingest and compaction), or with replace,
+    rebuild the main index from them alone (document removal). Caller holds
+    index_write_lock. Returns the store ready for search.
+    """
+    if not replace and os.path.exists(os.path.join(store_path, "index.faiss")):
+        db = FAISS.load_local(store_path, embeddings, allow_dangerous_deserialization=True)
+        first_new_id = db.index.ntotal
+        db.add_embeddings(text_embeddings, metadatas)
+    else:
+        first_new_id = 0
+        db = FAISS.from_embeddings(text_embeddings, embeddings, metadatas)
     
-    # Check cache validity
-    if _CACHED_DB is not None and _CACHED_CONFIG == current_config:
-        return _CACHED_DB
-        
-    if not os.path.exists(db_path):
+    # Train/convert to the configured ANN index once the corpus qualifies
+    index = db.index
+    db.index = ensure_index_type(index, config, store_path)
+    if db.index is index and describe_compression(index) != "none":
+        # Only the new rows are written, not the whole vectors file
+        append_vectors(store_path, [vector for _, vector in text_embeddings], first_new_id)
+    save_faiss_store(db, store_path)
+    db.index = wrap_for_search(db.index, store_path, config)
+    apply_search_params(db.index, config)
+    
+    # Build/update BM25 index
+    bm25_path = get_bm25_path(store_path)
+    new_docs = [Document(page_content=text, metadata=metadata)
+                for (text, _), metadata in zip(text_embeddings, metadatas)]
+    bm25_index = None if replace else BM25Index.load(bm25_path)
+    if bm25_index:
+        # Add new documents to existing index (only they are tokenized)
+        bm25_index = bm25_index.extend(new_docs)
+    else:
+        bm25_index = BM25Index()
+        bm25_index.fit(new_docs)
+    
+    bm25_index.save(bm25_path)
+    apply_aliases(_store_documents([db], bm25_index), load_aliases(store_path))
+    return db, bm25_index
+
+
+def _index_config_key(config: dict) -> tuple:
+    """
+    Settings an index generation depends on (besides the on-disk generation).
+    The query-time search knobs are included: they are set on the loaded
+    FAISS indexes once (apply_search_params), so a change loads new ones.
+    """
+    return (
+        config.get('db_path', 'faiss_index'),
+        config.get('embed_model', 'nomic-embed-text'),
+        config.get('ollama_host', 'http://localhost:11434'),
+        bool(config.get('use_hybrid_search', True)),
+        bool(config.get('mmap_index', True)),
+        (config.get('faiss_nprobe', 16), config.get('faiss_ef_search', 64), config.get('rerank_factor', 4)),
+    )
+
+
+def _load_store(store_path: str, embeddings: OllamaEmbeddings, config: dict,
+                mmap: bool, use_hybrid: bool) -> Tuple[List[FAISS], Optional[BM25Index]]:
+    """
+    Load one store (whole index or shard) ready for search: its main FAISS
+    index and delta segments, plus a BM25 index over all of their chunks.
+    """
+    db = load_faiss_store(store_path, embeddings, mmap=mmap)
+    db.index = wrap_for_search(db.index, store_path, config)
+    apply_search_params(db.index, config)
+    deltas = [load_faiss_store(path, embeddings) for path in list_delta_paths(store_path)]
+    bm25 = BM25Index.load(get_bm25_path(store_path)) if use_hybrid else None
+    if bm25 is not None and deltas:
+        bm25 = bm25.extend([doc for delta in deltas for doc in delta_documents(delta)])
+    apply_aliases(_store_documents([db] + deltas, bm25), load_aliases(store_path))
+    return [db] + deltas, bm25
+
+
+def _load_index_generation(config: dict, config_key: tuple, disk_generation: int,
+                           loaded_stores: Optional[dict] = None,
+                           previous_stores: Optional[dict] = None,
+                           collection: Optional[str] = None) -> Optional[IndexGeneration]:
+    """
+    Load FAISS (and BM25 if hybrid search is on) into a new, complete generation.
+    Stores in loaded_stores or previous_stores ({shard: (segments, bm25)}) are
+    reused instead of being read from disk.
+    """
+    db_path, embed_model, ollama_host, use_hybrid, mmap, _ = config_key
+    
+    if not index_exists(db_path):
         return None
-        
+    
     try:
-        if _CACHED_DB is not None:
-             print("> Configuration changed, reloading vector store...")
-             # Important: Invalidate derived objects too
-             _CACHED_RETRIEVER = None
-        else:
-             print("> Loading FAISS index from disk (cache miss)...")
-             
+        logger.info("Loading FAISS index from disk (generation %s)...", disk_generation)
         embeddings = OllamaEmbeddings(model=embed_model, base_url=ollama_host)
-        _CACHED_DB = FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
-        _CACHED_CONFIG = current_config # Update config cache
-        return _CACHED_DB
+        n_shards = get_shard_count(db_path)
+        get_search_pool(config.get('shard_search_threads', 8))
+        
+        stores = {}
+        for shard in range(n_shards):
+            path = _store_path(db_path, shard, n_shards)
+            if loaded_stores and shard in loaded_stores:
+                stores[shard] = loaded_stores[shard]
+            elif previous_stores and shard in previous_stores:
+                stores[shard] = previous_stores[shard]
+            elif os.path.exists(os.path.join(path, "index.faiss")):
+                stores[shard] = _load_store(path, embeddings, config, mmap, use_hybrid)
+            # else: no files hashed to this shard yet
+        
+        if not stores:
+            return None
+        return IndexGeneration.from_stores(config_key, disk_generation, stores, collection or DEFAULT_COLLECTION)
     except Exception as e:
-        print(f"Error loading vector store: {e}")
+        logger.error("Error loading vector store: %s", e)
         return None
 
 
-def get_rag_chain(model_name: str = None) -> Tuple[Optional[Any], ChatOllama]:
+_compacting = set()
+_compacting_lock = threading.Lock()
+
+
+def compact_index(collection: Optional[str] = None, shards: Optional[List[int]] = None) -> bool:
+    """
+    Merge the delta segments of a collection's stores (all, or the given
+    shards) into their main indexes. Returns True if anything was compacted.
+    """
+    config = get_collection_config(collection)
+    db_path = config.get('db_path', 'faiss_index')
+    embeddings = OllamaEmbeddings(model=config.get('embed_model', 'nomic-embed-text'),
+                                  base_url=config.get('ollama_host', 'http://localhost:11434'))
+    config_key = _index_config_key(config)
+    holder = _index_holder(collection, config)
+    
+    with index_write_lock(db_path):
+        if not index_exists(db_path):
+            return False
+        n_shards = get_shard_count(db_path)
+        previous = holder.current()
+        previous_generation = get_index_generation(db_path)
+        if previous is not None and previous.matches(config_key, previous_generation):
+            previous_stores = previous.stores
+        else:
+            previous_stores = {}
+        
+        compacted = {}
+        for shard in (range(n_shards) if shards is None else shards):
+            store_path = _store_path(db_path, shard, n_shards)
+            # Re-listed under the lock: another worker may have compacted already
+            delta_paths = list_delta_paths(store_path)
+            if not delta_paths:
+                continue
+            text_embeddings, metadatas = [], []
+            for path in delta_paths:
+                items, delta_metadatas = delta_contents(load_faiss_store(path, embeddings))
+                text_embeddings.extend(items)
+                metadatas.extend(delta_metadatas)
+            logger.info("Compacting %d delta segment(s) (%d chunks) into %s",
+                        len(delta_paths), len(text_embeddings), store_path)
+            db, bm25_index = _update_store(store_path, text_embeddings, metadatas, embeddings, config)
+            remove_deltas(delta_paths)
+            compacted[shard] = ([db], bm25_index)
+        
+        if not compacted:
+            return False
+        _bump_index_generation(db_path)
+        disk_generation = get_index_generation(db_path)
+        _update_sources(collection, previous_generation, disk_generation)  # Same files, new generation
+    
+    generation = _load_index_generation(config, config_key, disk_generation, compacted, previous_stores, collection)
+    if generation is not None:
+        holder.swap(generation)
+    return True
+
+
+def _schedule_compaction(collection: str, shards: List[int]):
+    """Compact a collection's deltas on a daemon thread (one compaction per collection at a time)."""
+    with _compacting_lock:
+        if collection in _compacting:
+            return
+        _compacting.add(collection)
+    
+    def _compact():
+        try:
+            compact_index(collection, shards)
+        except Exception as e:
+            logger.error("Delta compaction of collection %s failed: %s", collection, e)
+        finally:
+            with _compacting_lock:
+                _compacting.discard(collection)
+    
+    threading.Thread(target=_compact, name="index-compaction", daemon=True).start()
+
+
+def remove_documents(sources: Iterable[str], collection: Optional[str] = None) -> int:
+    """
+    Remove the chunks of source files (names as in the "source" metadata)
+    from a collection's index. Chunks that other files share (collapsed
+    near-duplicates, see dedup.py) stay, under their remaining sources.
+    Only stores holding such chunks are rewritten, their deltas merged in.
+    Returns the number of chunks removed.
+    """
+    removed = set(sources)
+    config = get_collection_config(collection)
+    db_path = config.get('db_path', 'faiss_index')
+    embeddings = OllamaEmbeddings(model=config.get('embed_model', 'nomic-embed-text'),
+                                  base_url=config.get('ollama_host', 'http://localhost:11434'))
+    config_key = _index_config_key(config)
+    holder = _index_holder(collection, config)
+    
+    with index_write_lock(db_path):
+        if not removed or not index_exists(db_path):
+            return 0
+        n_shards = get_shard_count(db_path)
+        previous = holder.current()
+        previous_generation = get_index_generation(db_path)
+        if previous is not None and previous.matches(config_key, previous_generation):
+            previous_stores = previous.stores
+        else:
+            previous_stores = {}
+        
+        rebuilt, changed, count = {}, set(), 0
+        for shard in range(n_shards):
+            store_path = _store_path(db_path, shard, n_shards)
+            if remove_aliases(store_path, removed):
+                changed.add(shard)  # Loaded chunks still list the removed files
+            if not os.path.exists(os.path.join(store_path, "index.faiss")):
+                continue
+            if shard in previous_stores:
+                segments, _ = previous_stores[shard]
+                docs = chain.from_iterable(segment.docstore._dict.values() for segment in segments)
+                if not any(removed.intersection(chunk_sources(doc)) for doc in docs):
+                    continue
+            store_removed, store = _remove_from_store(store_path, removed, embeddings, config)
+            if store_removed:
+                changed.add(shard)
+                count += store_removed
+                if store is not None:
+                    rebuilt[shard] = store
+        
+        if not changed:
+            return 0
+        _bump_index_generation(db_path)
+        disk_generation = get_index_generation(db_path)
+        _update_sources(collection, previous_generation, disk_generation, removed=removed)
+    
+    logger.info("Removed %d chunk(s) of %d file(s) from collection %s",
+                count, len(removed), collection or DEFAULT_COLLECTION)
+    reused = {shard: store for shard, store in previous_stores.items() if shard not in changed}
+    generation = _load_index_generation(config, config_key, disk_generation, rebuilt, reused, collection)
+    holder.swap(generation)
+    return count
+
+
+def _remove_from_store(store_path: str, removed: set, embeddings: OllamaEmbeddings,
+                       config: dict) -> Tuple[int, Optional[Tuple[List[FAISS], Optional[BM25Index]]]]:
+    """
+    Rewrite one store (main index and deltas) without the chunks of the
+    removed sources. Caller holds index_write_lock.
+    Returns (chunks removed, the rewritten store's searchable (segments, bm25),
+    None if it is now empty or nothing was removed).
+    """
+    # Not memory-mapped: the vectors are read back to rebuild the index
+    db = load_faiss_store(store_path, embeddings)
+    delta_paths = list_delta_paths(store_path)
+    segments = [db] + [load_faiss_store(path, embeddings) for path in delta_paths]
+    docs = [doc for segment in segments for doc in delta_documents(segment)]
+    vectors = [read_vectors(db.index, store_path)] + [
+        delta.index.reconstruct_n(0, delta.index.ntotal) for delta in segments[1:]]
+    apply_aliases(docs, load_aliases(store_path))
+    
+    text_embeddings, metadatas = [], []
+    for doc, vector in zip(docs, np.vstack(vectors)):
+        remaining = [source for source in chunk_sources(doc) if source not in removed]
+        if not remaining:
+            continue
+        if doc.metadata.get('sources'):
+            doc.metadata['sources'] = remaining
+            doc.metadata['source'] = remaining[0]
+        text_embeddings.append((doc.page_content, vector))
+        metadatas.append(doc.metadata)
+    removed_count = len(docs) - len(metadatas)
+    if not removed_count:
+        return 0, None
+    
+    # Readers may have the old vectors mapped: new rows go to a new file
+    paths = [os.path.join(store_path, VECTORS_FILE)]
+    if not metadatas:
+        paths += [os.path.join(store_path, name) for name in ("index.faiss", "index.pkl")] + [get_bm25_path(store_path)]
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    store = None
+    if metadatas:
+        db, bm25_index = _update_store(store_path, text_embeddings, metadatas, embeddings, config, replace=True)
+        store = ([db], bm25_index)
+    remove_deltas(delta_paths)
+    return removed_count, store
+
+
+# Files of watched directories that go to another collection than the default
+# or that an explicit ingest is working on, shared by the worker processes:
+# {path: {"collection": name or None, "claimed_at": time or None}}
+_upload_targets = database.SharedStateDict("upload_targets")
+# A claim older than this was left behind by an ingest that never finished
+INGEST_CLAIM_SECONDS = 6 * 3600
+
+
+def _set_upload_target(path: str, collection: Optional[str], claimed_at: Optional[float]):
+    path = os.path.abspath(path)
+    collection = None if collection == DEFAULT_COLLECTION else collection
+    if collection is None and claimed_at is None:
+        _upload_targets.pop(path, None)
+    else:
+        _upload_targets[path] = {"collection": collection, "claimed_at": claimed_at}
+
+
+def record_upload(path: str, collection: Optional[str] = None):
+    """Remember the collection a file put into a watched directory belongs to (see sync_directory)."""
+    _set_upload_target(path, collection, None)
+
+
+def claim_files(paths: Iterable[str], collection: Optional[str] = None):
+    """
+    Mark files an explicit ingest into collection is about to write or ingest:
+    sync_directory leaves them to it until release_files, and syncs them into
+    collection afterwards.
+    """
+    for path in paths:
+        _set_upload_target(path, collection, time.time())
+
+
+def release_files(paths: Iterable[str]):
+    """End the claim_files of an ingest that finished (or failed)."""
+    for path in paths:
+        target = _upload_targets.get(os.path.abspath(path))
+        if target is not None:
+            _set_upload_target(path, target["collection"], None)
+
+
+def sync_directory(directory: str, names: Optional[Iterable[str]] = None,
+                   collection: Optional[str] = None) -> dict:
+    """
+    Bring the index in line with the files of a directory: files added or
+    modified since they were indexed are (re-)ingested, indexed files deleted
+    from it are removed. A file goes to the collection recorded for it
+    (record_upload, claim_files), else to collection; files claimed by an
+    explicit ingest are left to it. names limits the check to those file
+    names (None: every file in the directory or indexed from it).
+    Returns {"ingested": [names], "removed": [names], "results": ingest results}.
+    """
+    directory = os.path.abspath(directory)
+    names = None if names is None else set(names)
+    targets = {}
+    for path in list(_upload_targets):
+        target = _upload_targets.get(path)
+        if target is not None and os.path.dirname(path) == directory:
+            targets[os.path.basename(path)] = target
+    now = time.time()
+    claimed = {name for name, target in targets.items()
+               if target["claimed_at"] and now - target["claimed_at"] < INGEST_CLAIM_SECONDS}
+    owners = {name: target["collection"] or collection for name, target in targets.items()}
+    
+    if names is None:
+        groups = dict.fromkeys({collection} | set(owners.values()))
+    else:
+        groups = {}
+        for name in names - claimed:
+            groups.setdefault(owners.get(name, collection), set()).add(name)
+    
+    result = {"ingested": [], "removed": [], "results": []}
+    for owner, owner_names in groups.items():
+        elsewhere = claimed | {name for name, other in owners.items() if other != owner}
+        synced = _sync_collection(directory, owner_names, owner, elsewhere)
+        for key in result:
+            result[key] += synced[key]
+    for name in targets.keys() - claimed:
+        if (names is None or name in names) and not os.path.exists(os.path.join(directory, name)):
+            _upload_targets.pop(os.path.join(directory, name), None)  # Deleted: forget where it went
+    return result
+
+
+def _sync_collection(directory: str, names: Optional[Iterable[str]], collection: Optional[str],
+                     elsewhere: Iterable[str]) -> dict:
+    """sync_directory for one collection; files named in elsewhere are not ingested into it."""
+    config = get_collection_config(collection)
+    generation = get_active_index(collection)
+    indexed = {
+        source["source"]: source["ingested_at"] or 0
+        for source in (generation.get_sources() if generation else ())
+        if source["full_path"] and os.path.dirname(os.path.abspath(source["full_path"])) == directory
+    }
+    if names is None:
+        names = set(os.listdir(directory)) | set(indexed)
+    elsewhere = set(elsewhere)
+    
+    to_ingest, deleted, modified_files = [], [], []
+    for name in sorted(set(names)):
+        path = os.path.join(directory, name)
+        try:
+            modified = os.path.getmtime(path) if os.path.isfile(path) else None
+        except OSError:
+            modified = None  # Deleted since
+        if modified is None:
+            if name in indexed:
+                deleted.append(name)
+            continue
+        if name in elsewhere or (name in indexed and modified <= indexed[name]):
+            continue  # Another collection's (or an explicit ingest's), or unchanged since it was ingested
+        try:
+            get_loader(path, config)
+        except ValueError:
+            continue  # Unsupported type (or a partial upload)
+        if name in indexed:
+            modified_files.append(name)  # Its old chunks go first
+        to_ingest.append(path)
+    
+    result = {"ingested": [os.path.basename(path) for path in to_ingest], "removed": deleted, "results": []}
+    if deleted or modified_files:
+        remove_documents(deleted + modified_files, collection)
+    if to_ingest:
+        result["results"] = ingest_files(to_ingest, collection)["results"]
+    return result
+
+
+def get_active_index(collection: Optional[str] = None) -> Optional[IndexGeneration]:
+    """
+    Get the current index generation of a collection, loading it if the config
+    or the on-disk index changed. Callers should keep the returned object for
+    the whole query: it stays valid even if a newer generation is swapped in.
+    """
+    config = get_collection_config(collection)
+    config_key = _index_config_key(config)
+    # Changes when any worker process rewrites the index
+    disk_generation = get_index_generation(config_key[0])
+    return _index_holder(collection, config).get_or_load(
+        config_key, disk_generation,
+        lambda: _load_index_generation(config, config_key, disk_generation, collection=collection)
+    )
+
+
+def get_vector_store(collection: Optional[str] = None) -> Optional[FAISS]:
+    """
+    Get the FAISS vector store of the active index generation.
+    Reloads if configuration (path/model) or the index on disk changes.
+    """
+    generation = get_active_index(collection)
+    return generation.db if generation else None
+
+
+def get_rag_chain(model_name: str = None, collections: Any = None) -> Tuple[Optional[Any], ChatOllama]:
     """
     Returns the Retrieval Chain with the selected model.
     Uses global caching to prevent disk I/O on every chat call.
     Supports hybrid search if enabled in config.
+    
+    collections: a collection name or list of names to search (default
+    collection if omitted). Several collections are merged by rank.
     """
-    global _CACHED_RETRIEVER, _CACHED_LLM, _CACHED_MODEL_NAME, _CACHED_BM25
+    global _CACHED_LLM, _CACHED_MODEL_NAME
     
     config = load_config()
-    db_path = config.get('db_path', 'faiss_index')
-    # Dynamic BM25 path
-    bm25_path = get_bm25_path(db_path)
     
     if model_name is None:
         model_name = config.get('model', 'gemma3:270m')
             
-    use_hybrid = config.get('use_hybrid_search', True)
-    hybrid_alpha = config.get('hybrid_alpha', 0.5)
     retrieval_k = config.get('retrieval_k', 3)
     ollama_host = config.get('ollama_host', 'http://localhost:11434')
     
     # Check if we need a new LLM (model changed)
-    if _CACHED_LLM is None or _CACHED_MODEL_NAME != model_name:
-        _CACHED_LLM = ChatOllama(model=model_name, base_url=ollama_host)
-        _CACHED_MODEL_NAME = model_name
-    
-    llm = _CACHED_LLM
-    
-    # Get vector store (handles config changes)
-    db = get_vector_store()
-    if db is None:
-        return None, llm
+    with _llm_lock:
+        if _CACHED_LLM is None or _CACHED_MODEL_NAME != model_name:
+            _CACHED_LLM = ChatOllama(model=model_name, base_url=ollama_host)
+            _CACHED_MODEL_NAME = model_name
+        llm = _CACHED_LLM
     
-    # Return cached retriever if available (and valid - ensured by get_vector_store clearing it)
-    if _CACHED_RETRIEVER is not None:
-        print(f"[CACHE] Using cached retriever (cache hit)")
-        return _CACHED_RETRIEVER, llm
+    retrievers = {}
+    for name in resolve_collections(collections):
+        try:
+            collection_config = get_collection_config(name)
+            # Get the active index generation (handles config and on-disk changes)
+            generation = get_active_index(name)
+            if generation is None:
+                continue
+            retrievers[name] = generation.get_retriever(
+                collection_config.get('use_hybrid_search', True),
+                collection_config.get('hybrid_alpha', 0.5),
+                collection_config.get('retrieval_k', 3),
+            )
+        except Exception as e:
+            logger.error("Error initializing retriever for collection %s: %s", name, e)
     
-    try:
-        if use_hybrid:
-            # Load BM25 index from dynamic path
-            if _CACHED_BM25 is None:
-                _CACHED_BM25 = BM25Index.load(bm25_path)
-            
-            if _CACHED_BM25:
-                _CACHED_RETRIEVER = HybridRetriever(db, _CACHED_BM25, alpha=hybrid_alpha)
-                return _CACHED_RETRIEVER, llm
-        
-        # Fall back to vector-only search
-        _CACHED_RETRIEVER = db.as_retriever(search_kwargs={"k": retrieval_k})
-        return _CACHED_RETRIEVER, llm
-        
-    except Exception as e:
-        print(f"Error initializing retriever: {e}")
+    if not retrievers:
         return None, llm
+    if len(retrievers) == 1:
+        return next(iter(retrievers.values())), llm
+    return MultiCollectionRetriever(retrievers, k=retrieval_k), llm
 
 
-def clear_rag_cache():
-    """Clear the RAG cache. Call after ingest_files or clear_index to force reload."""
-    global _CACHED_DB, _CACHED_BM25, _CACHED_RETRIEVER, _CACHED_CONFIG
-    global _indexed_files_cache, _indexed_files_cache_time
-    
-    _CACHED_DB = None
-    _CACHED_BM25 = None
-    _CACHED_RETRIEVER = None
-    _CACHED_CONFIG = None
-    
-    # Also clear indexed files cache
-    _indexed_files_cache = None
-    _indexed_files_cache_time = 0
+def clear_rag_cache(collection: Optional[str] = None):
+    """
+    Mark cached index generations stale (one collection, or all loaded) to force a reload.
+    Queries keep using the old generation until the background reload swaps in the new one.
+    """
+    names = [collection] if collection else _COLLECTIONS.loaded()
+    for name in names:
+        holder = _COLLECTIONS.peek(name)
+        if holder is not None:
+            holder.invalidate()
 
 
-def clear_index() -> Tuple[bool, str]:
-    """Clear all indexed documents."""
-    config = load_config()
+def warm_index_cache():
+    """Load the index on a background thread so the first request doesn't wait for it."""
+    threading.Thread(target=get_active_index, name="index-warmup", daemon=True).start()
+
+
+def clear_index(collection: Optional[str] = None) -> Tuple[bool, str]:
+    """Clear all indexed documents of a collection."""
+    config = get_collection_config(collection)
     db_path = config.get('db_path', 'faiss_index')
     bm25_path = get_bm25_path(db_path)
     
     try:
-        import shutil
-        if os.path.exists(db_path):
-            shutil.rmtree(db_path)
-        if os.path.exists(bm25_path):
-            os.remove(bm25_path)
-        # Clear cache to reflect cleared index
-        clear_rag_cache()
+        with index_write_lock(db_path):
+            if os.path.exists(db_path):
+                shutil.rmtree(db_path)
+            if os.path.exists(bm25_path):
+                os.remove(bm25_path)
+            database.clear_sources(collection or DEFAULT_COLLECTION)
+        # Drop the cached generation so the cleared index is reflected immediately
+        _index_holder(collection, config).swap(None)
         return True, "Index cleared successfully."
     except Exception as e:
         return False, f"Error clearing index: {str(e)}"
 
 
-def get_indexed_files() -> List[str]:
+def delete_collection(name: str) -> Tuple[bool, str]:
+    """Delete a named collection: its index files, registry entry and cache slot."""
+    if name in (None, DEFAULT_COLLECTION):
+        return False, "The default collection cannot be deleted; clear it instead."
+    success, msg = clear_index(name)
+    if not success:
+        return False, msg
+    database.delete_collection(name)
+    _COLLECTIONS.drop(name)
+    knowledge_graph.forget(name)
+    return True, f"Collection '{name}' deleted."
+
+
+def get_indexed_files(collection: Optional[str] = None) -> List[str]:
     """
-    Get list of files that have been indexed (with caching).
+    Get list of files that have been indexed.
     
-    Cache is automatically invalidated when:
-    - Index is cleared (via clear_rag_cache)
-    - Documents are ingested (via clear_rag_cache)
-    - 5 seconds have elapsed (TTL for responsive updates)
+    Read from the sources table once per index generation (see
+    IndexGeneration.get_sources), not by scanning every chunk.
     """
-    global _indexed_files_cache, _indexed_files_cache_time
-    import time
-    
-    # Cache for 5 seconds to reduce repeated docstore iterations
-    # Note: Cache is also invalidated immediately on index modifications
-    current_time = time.time()
-    if _indexed_files_cache is not None and (current_time - _indexed_files_cache_time) < 5:
-        return _indexed_files_cache
-    
-    db = get_vector_store()
+    generation = get_active_index(collection)
     
-    if not db:
+    if not generation:
         return []
     
     try:
-        # Get unique sources from docstore
-        sources = set()
-        for doc_id in db.docstore._dict:
-            doc = db.docstore._dict[doc_id]
-            if hasattr(doc, 'metadata') and 'source' in doc.metadata:
-                sources.add(doc.metadata['source'])
-        
-        result = sorted(list(sources))
-        
-        # Update cache
-        _indexed_files_cache = result
-        _indexed_files_cache_time = current_time
-        
-        return result
+        return generation.get_indexed_files()
     except Exception as e:
-        print(f"Error getting indexed files: {e}")
+        logger.error("Error getting indexed files: %s", e)
         return []
 
 
-def get_index_stats() -> dict:
-    """Get statistics about the current index."""
-    config = load_config()
+def get_index_stats(collection: Optional[str] = None) -> dict:
+    """Get statistics about the current index of a collection."""
+    config = get_collection_config(collection)
     db_path = config.get('db_path', 'faiss_index')
-    bm25_path = get_bm25_path(db_path)
     
     stats = {
+        "collection": collection or DEFAULT_COLLECTION,
         "total_chunks": 0,
         "total_files": 0,
         "files": [],
-        "bm25_available": False
+        "bm25_available": False,
+        "shards": 1,
+        "delta_segments": 0,
+        "delta_chunks": 0,
+        "index_type": None,
+        "memory": None,
+        "ann_report": None
     }
     
-    db = get_vector_store()
+    generation = get_active_index(collection)
     
-    if not db:
+    if not generation:
         return stats
     
     try:
+        db = generation.db
         stats["total_chunks"] = len(db.docstore._dict)
-        stats["files"] = get_indexed_files()
+        stats["files"] = generation.get_indexed_files()
         stats["total_files"] = len(stats["files"])
-        stats["bm25_available"] = os.path.exists(bm25_path)
+        stats["shards"] = get_shard_count(db_path)
+        shards = sorted(generation.stores)
+        paths = [_store_path(db_path, shard, stats["shards"]) for shard in shards]
+        deltas = [delta for shard in shards for delta in generation.stores[shard][0][1:]]
+        stats["delta_segments"] = len(deltas)
+        stats["delta_chunks"] = sum(delta.index.ntotal for delta in deltas)
+        stats["bm25_available"] = any(os.path.exists(get_bm25_path(path)) for path in paths)
+        memory = [index_memory_stats(generation.stores[shard][0][0].index, path) for shard, path in zip(shards, paths)]
+        reports = [load_ann_report(path) for path in paths]
+        if stats["shards"] == 1:
+            stats["memory"], stats["ann_report"] = memory[0], reports[0]
+        else:
+            totals = {key: sum(m[key] for m in memory)
+                      for key in ("vectors", "index_bytes", "float32_bytes", "exact_vectors_bytes")}
+            totals["compression_ratio"] = (round(totals["float32_bytes"] / totals["index_bytes"], 2)
+                                           if totals["index_bytes"] else None)
+            stats["memory"] = {**memory[0], **totals, "per_shard": memory}
+            stats["ann_report"] = [report for report in reports if report] or None
+        stats["index_type"] = stats["memory"]["index_type"]
         
     except Exception as e:
-        print(f"Error getting index stats: {e}")
+        logger.error("Error getting index stats: %s", e)
     
     return stats
 
 
-def get_knowledge_graph(max_docs: int = 50, top_terms_per_doc: int = 5) -> dict:
+def get_knowledge_graph(collection: Optional[str] = None, offset: int = 0, limit: int = 50,
+                        terms_per_doc: int = 5, min_degree: int = 1, max_nodes: int = 200) -> dict:
     """
-    Generates a knowledge graph structure (nodes, links) from the BM25 index.
-    Nodes: Documents and High-IDF Terms.
-    Links: Document <-> Term.
+    A page of a collection's knowledge graph (nodes, links): limit documents
+    from offset and their highest-weighted terms, from the term counts kept
+    in the sources table (see knowledge_graph.py), not the BM25 index.
+    Nodes: Documents and Terms. Links: Document <-> Term.
     """
     try:
-        config = load_config()
-        db_path = config.get('db_path', 'faiss_index')
-        bm25_path = get_bm25_path(db_path)
-        
-        graph = {"nodes": [], "links": []}
-        
-        if not os.path.exists(bm25_path):
-            return graph
+        generation = get_active_index(collection)
+        if generation is None:
+            return {"nodes": [], "links": [], "total_documents": 0, "offset": offset, "limit": limit}
+        return knowledge_graph.get_graph(collection or DEFAULT_COLLECTION, generation, offset, limit,
+                                         terms_per_doc, min_degree, max_nodes)
+    except Exception as e:
+        logger.exception("Error generating graph: %s", e)
+        return {"nodes": [], "links": [], "error": str(e)}
 
-        bm25 = BM25Index.load(bm25_path)
-        if not bm25 or not bm25.documents:
-            return graph
-            
-        docs_to_process = bm25.documents[:max_docs]
-        term_nodes = set()
-        
-        for i in range(min(len(bm25.documents), max_docs)):
-            doc = bm25.documents[i]
-            doc_name = doc.metadata.get('source', f"Doc {i}")
-            doc_name = os.path.basename(doc_name)
-            doc_id = f"doc_{i}"
-            
-            graph["nodes"].append({
-                "id": doc_id,
-                "label": doc_name,
-                "type": "document",
-                "group": 1,
-                "radius": 12 
-            })
-            
-            # Check safely for doc_term_freqs
-            if not hasattr(bm25, 'doc_term_freqs') or i >= len(bm25.doc_term_freqs):
-                continue
 
-            term_freqs = bm25.doc_term_freqs[i]
-            
-            scored_terms = []
-            for term, count in term_freqs.items():
-                if term in bm25.idf:
-                    score = count * bm25.idf[term]
-                    if bm25.idf[term] > 0.5: 
-                        scored_terms.append((term, score))
-            
-            scored_terms.sort(key=lambda x: x[1], reverse=True)
-            top_terms = scored_terms[:top_terms_per_doc]
-            
-            for term, score in top_terms:
-                term_id = f"term_{term}"
-                if term not in term_nodes:
-                    graph["nodes"].append({
-                        "id": term_id,
-                        "label": term,
-                        "type": "term",
-                        "group": 2,
-                        "radius": 6
-                    })
-                    term_nodes.add(term)
-                
-                graph["links"].append({
-                    "source": doc_id,
-                    "target": term_id,
-                    "value": score
-                })
-        # --- Post-processing: Filter by Degree Centrality ---
-        # 1. Calculate Degree for all nodes
-        node_degrees = Counter()
-        for link in graph["links"]:
-            node_degrees[link["source"]] += 1
-            node_degrees[link["target"]] += 1
-            
-        # 2. Assign centrality to nodes (for UI sizing) and Sort
-        # Keep ALL documents to ensure they appear
-        doc_nodes = [n for n in graph["nodes"] if n["type"] == "document"]
-        term_nodes = [n for n in graph["nodes"] if n["type"] == "term"]
-        
-        # Sort terms by degree (keep most connected keywords)
-        term_nodes.sort(key=lambda n: node_degrees[n["id"]], reverse=True)
-        
-        # Limit total nodes (keep all docs + top terms)
-        max_total_nodes = 200
-        allowed_terms_count = max(0, max_total_nodes - len(doc_nodes))
-        final_term_nodes = term_nodes[:allowed_terms_count]
-        
-        final_nodes = doc_nodes + final_term_nodes
-        final_node_ids = {n["id"] for n in final_nodes}
-        
-        # 3. Filter Links
-        final_links = [
-            l for l in graph["links"] 
-            if l["source"] in final_node_ids and l["target"] in final_node_ids
-        ]
-        
-        # 4. Remove valid nodes that became isolated after link filtering (Optional: or keep them as singletons)
-        # Let's keep docs even if isolated, but remove terms if isolated
-        active_node_ids = set()
-        for link in final_links:
-            active_node_ids.add(link["source"])
-            active_node_ids.add(link["target"])
-            
-        # Refine final nodes: Keep documents OR connected terms
-        final_nodes_cleaned = [
-            n for n in final_nodes 
-            if n["type"] == "document" or n["id"] in active_node_ids
-        ]
+_corpus_graph_builds = set()
+_corpus_graph_builds_lock = threading.Lock()
 
-        return {"nodes": final_nodes_cleaned, "links": final_links}
 
-    except Exception as e:
-        print(f"Error generating graph: {e}")
-        traceback.print_exc()
-        return {"nodes": [], "links": [], "error": str(e)}
+def _corpus_signature(generation: IndexGeneration) -> str:
+    """Changes with the indexed chunks (not with compactions, which only move them)."""
+    listing = [(source["source"], source["chunks"], source["ingested_at"]) for source in generation.get_sources()]
+    return hashlib.sha256(json.dumps(listing).encode("utf-8")).hexdigest()
+
+
+def get_corpus_graph(collection: Optional[str] = None) -> dict:
+    """
+    The corpus-wide term graph of a collection (see corpus_graph.py) with a
+    "status": "ready", "building" or "empty". When the saved graph doesn't
+    describe the indexed chunks, a build starts on a background thread and
+    the previous graph, if any, is returned meanwhile with "stale": True.
+    """
+    config = get_collection_config(collection)
+    db_path = config.get('db_path', 'faiss_index')
+    generation = get_active_index(collection)
+    if generation is None:
+        return {"status": "empty", "stale": False, "clusters": [], "links": []}
+    signature = _corpus_signature(generation)
+    graph = load_corpus_graph(db_path)
+    if graph is not None and graph.get("signature") == signature:
+        return {**graph, "status": "ready", "stale": False}
+    _schedule_corpus_graph(collection or DEFAULT_COLLECTION, generation, signature, config)
+    if graph is None:
+        return {"status": "building", "stale": False, "clusters": [], "links": []}
+    return {**graph, "status": "building", "stale": True}
+
+
+def _schedule_corpus_graph(collection: str, generation: IndexGeneration, signature: str, config: dict):
+    """Build a collection's corpus graph on a daemon thread (one build per collection at a time)."""
+    with _corpus_graph_builds_lock:
+        if collection in _corpus_graph_builds:
+            return
+        _corpus_graph_builds.add(collection)
+    
+    def _build():
+        try:
+            indexes = []
+            for _, (segments, bm25) in sorted(generation.stores.items()):
+                if bm25 is None:  # Hybrid search off: no BM25 postings in memory
+                    bm25 = BM25Index()
+                    bm25.fit([doc for segment in segments for doc in segment.docstore._dict.values()])
+                indexes.append(bm25)
+            sources = [doc.metadata.get('source', '') for index in indexes for doc in index.documents]
+            graph = build_corpus_graph(indexes, sources, config)
+            graph.update(signature=signature, index_generation=generation.disk_generation, built_at=time.time())
+            save_corpus_graph(config.get('db_path', 'faiss_index'), graph)
+        except Exception as e:
+            logger.error("Building the corpus graph of collection %s failed: %s", collection, e)
+        finally:
+            with _corpus_graph_builds_lock:
+                _corpus_graph_builds.discard(collection)
+    
+    threading.Thread(target=_build, name="corpus-graph", daemon=True).start()
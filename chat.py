@@ -8,6 +8,7 @@ import time
 import sys
 from backend import get_rag_chain
 from config_manager import load_config
+from token_counter import get_token_counter, pack_documents
 from database import (
     get_or_create_default_session, add_message, 
     format_history_for_prompt, create_session,
@@ -290,6 +291,8 @@ Provide a helpful response based on the documents."""
 
                 def get_context(q):
                     docs = retriever.invoke(q) if hasattr(retriever, 'invoke') else retriever.get_relevant_documents(q)
+                    docs = pack_documents(docs, config.get("context_token_budget", 3000),
+                                          get_token_counter(config.get("tokenizer", "auto")))
                     return format_docs(docs)
 
                 chain = (
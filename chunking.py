@@ -0,0 +1,301 @@
+"""
+Structure-aware chunking: one splitting strategy per file type.
+
+A single character splitter cuts every format the same way. These
+strategies use the structure the loaders already expose instead:
+
+    .md           sections split at headings; the heading path is kept in
+                  metadata ("section") and repeated in continuation chunks
+    .pdf          chunks never cross pages; pages are split at detected
+                  section headings, which carry over to following pages
+    .csv          rows batched into chunks, each starting with the header
+    .xlsx / .xls  table rows batched per sheet, each chunk with the header row
+    .pptx / .ppt  one chunk per slide (long slides are split further)
+    other         recursive character splitting (previous behaviour)
+
+Sizes come from "chunk_size" / "chunk_overlap", optionally overridden per
+file type with "chunk_size_overrides" (e.g. {"csv": 2000}), measured in
+characters or, with "chunk_size_unit": "tokens", in tokens. Setting
+"chunking_strategy" to "recursive" uses the plain splitter for every format.
+
+Strategies consume documents as a stream (a loader's lazy_load()) and yield
+chunks as they go, so a large file is never held in memory whole.
+"""
+
+import csv
+import html
+import logging
+import os
+import re
+from itertools import chain, groupby
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
+
+from token_counter import get_token_counter
+
+logger = logging.getLogger("RAG_Agent.chunking")
+
+SEPARATORS = ["\n\n", "\n", ". ", " ", ""]
+
+# Per-element metadata from unstructured that means nothing for a merged slide chunk
+_ELEMENT_KEYS = ("category", "element_id", "parent_id", "text_as_html", "category_depth",
+                 "emphasized_text_contents", "emphasized_text_tags")
+
+_MARKDOWN_HEADERS = [("#", "h1"), ("##", "h2"), ("###", "h3")]
+
+# "2.1 Results", "IV. Methods", "APPENDIX A": short lines that look like headings
+_PDF_HEADING = re.compile(
+    r"^(?:\d+(?:\.\d+)*\.?|[IVXLC]+\.)\s+[A-Z][^\n]{0,80}$|^[A-Z][A-Z0-9 ,&:()/-]{3,60}$"
+)
+
+
+class ChunkSizer:
+    """Chunk size, overlap and length function for one file type."""
+
+    def __init__(self, chunk_size: int, chunk_overlap: int, length_function: Callable[[str], int] = len):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = min(chunk_overlap, chunk_size // 2)
+        self.length_function = length_function
+
+    def splitter(self) -> RecursiveCharacterTextSplitter:
+        return RecursiveCharacterTextSplitter(
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            length_function=self.length_function,
+            separators=SEPARATORS,
+        )
+
+    def fits(self, text: str) -> bool:
+        return self.length_function(text) <= self.chunk_size
+
+
+def get_sizer(config: dict, ext: str) -> ChunkSizer:
+    """Sizing for a file type (extension with or without the dot), in characters or tokens ("chunk_size_unit")."""
+    overrides = config.get("chunk_size_overrides") or {}
+    ext = ext.lower().lstrip(".")
+    chunk_size = overrides.get(ext, config.get("chunk_size", 1000))
+    length_function = len
+    if config.get("chunk_size_unit", "chars") == "tokens":
+        length_function = get_token_counter(config.get("tokenizer", "auto"))
+    return ChunkSizer(chunk_size, config.get("chunk_overlap", 200), length_function)
+
+
+def _with_metadata(doc: Document, text: str, **metadata) -> Document:
+    return Document(page_content=text, metadata={**doc.metadata, **metadata})
+
+
+def _split_text(sizer: ChunkSizer, doc: Document, text: str, prefix: str = "", **metadata) -> List[Document]:
+    """
+    Chunk text, starting every chunk with prefix (e.g. its heading path) so
+    each chunk still says where it came from. The prefix counts toward the size.
+    """
+    if prefix:
+        budget = sizer.chunk_size - sizer.length_function(prefix + "\n")
+        sizer = ChunkSizer(max(budget, sizer.chunk_size // 2), sizer.chunk_overlap, sizer.length_function)
+    parts = [text] if sizer.fits(text) else sizer.splitter().split_text(text)
+    return [_with_metadata(doc, "\n".join(filter(None, (prefix, part))), **metadata) for part in parts]
+
+
+def _batch_rows(sizer: ChunkSizer, doc: Document, header: str, rows: Iterable[Tuple[int, str]],
+                chunk_type: str, **metadata) -> Iterator[Document]:
+    """
+    Pack (row number, text) rows into chunks that each start with the header line.
+    The size of a batch is kept as a running total: each row is measured once
+    (with its line break), not the whole growing batch on every row.
+    """
+    batch: List[Tuple[int, str]] = []
+    header_size = sizer.length_function(header)
+    size = header_size
+
+    def flush() -> Document:
+        text = "\n".join([header] + [row for _, row in batch])
+        chunk = _with_metadata(doc, text, chunk_type=chunk_type, rows=f"{batch[0][0]}-{batch[-1][0]}", **metadata)
+        batch.clear()
+        return chunk
+
+    for number, row in rows:
+        row_size = sizer.length_function("\n" + row)
+        if batch and size + row_size > sizer.chunk_size:
+            yield flush()
+            size = header_size
+        if not batch and header_size + row_size > sizer.chunk_size:
+            # A single oversized row: split it, repeating the header in every piece
+            yield from _split_text(sizer, doc, row, prefix=header, chunk_type=chunk_type,
+                                   rows=f"{number}-{number}", **metadata)
+            continue
+        batch.append((number, row))
+        size += row_size
+    if batch:
+        yield flush()
+
+
+def split_markdown(docs: Iterable[Document], sizer: ChunkSizer) -> Iterator[Document]:
+    header_splitter = MarkdownHeaderTextSplitter(_MARKDOWN_HEADERS, strip_headers=True)
+    for doc in docs:
+        for section in header_splitter.split_text(doc.page_content):
+            path = " > ".join(section.metadata[key] for _, key in _MARKDOWN_HEADERS if key in section.metadata)
+            yield from _split_text(sizer, doc, section.page_content, prefix=path,
+                                   chunk_type="markdown_section", section=path)
+
+
+def split_pdf(docs: Iterable[Document], sizer: ChunkSizer) -> Iterator[Document]:
+    section = ""
+    for doc in docs:  # one Document per page
+        blocks: List[Tuple[str, List[str]]] = [(section, [])]
+        for line in doc.page_content.splitlines():
+            stripped = line.strip()
+            if _PDF_HEADING.match(stripped):
+                section = stripped
+                blocks.append((section, []))
+            else:
+                blocks[-1][1].append(line)
+        for block_section, lines in blocks:
+            text = "\n".join(lines).strip()
+            if text:
+                yield from _split_text(sizer, doc, text, prefix=block_section,
+                                       chunk_type="pdf_page", section=block_section)
+
+
+def _csv_header(doc: Document) -> Optional[List[str]]:
+    """Column names from the CSV file itself (row documents don't carry them separately)."""
+    path = doc.metadata.get("full_path") or doc.metadata.get("source")
+    try:
+        with open(path, newline="", encoding="utf-8") as f:
+            return [column.strip() for column in next(csv.reader(f))]
+    except (OSError, StopIteration, UnicodeDecodeError, csv.Error):
+        return None
+
+
+def _csv_values(text: str, columns: List[str]) -> List[str]:
+    """Values of a CSVLoader row ("column: value" lines, in column order; values may span lines)."""
+    values: List[str] = []
+    for line in text.split("\n"):
+        if len(values) < len(columns) and line.startswith(f"{columns[len(values)]}: "):
+            values.append(line[len(columns[len(values)]) + 2:])
+        elif len(values) < len(columns) and line == f"{columns[len(values)]}:":
+            values.append("")
+        elif values:
+            values[-1] += f" {line}"
+    return values
+
+
+def split_csv(docs: Iterable[Document], sizer: ChunkSizer) -> Iterator[Document]:
+    docs = iter(docs)
+    first = next(docs, None)
+    if first is None:
+        return
+    docs = chain([first], docs)
+    columns = _csv_header(first)
+    if not columns:
+        yield from split_recursive(docs, sizer)
+        return
+    header = " | ".join(columns)
+    rows = (
+        (doc.metadata.get("row", i), " | ".join(_csv_values(doc.page_content, columns)))
+        for i, doc in enumerate(docs)
+    )
+    base = Document(page_content="", metadata={k: v for k, v in first.metadata.items() if k != "row"})
+    yield from _batch_rows(sizer, base, header, rows, "csv_rows")
+
+
+def _html_table_rows(table_html: str) -> List[str]:
+    rows = []
+    for row in re.findall(r"<tr[^>]*>(.*?)</tr>", table_html, flags=re.S | re.I):
+        cells = re.findall(r"<t[dh][^>]*>(.*?)</t[dh]>", row, flags=re.S | re.I)
+        rows.append(" | ".join(html.unescape(re.sub(r"<[^>]+>", "", cell)).strip() for cell in cells))
+    return [row for row in rows if row.strip(" |")]
+
+
+def split_excel(docs: Iterable[Document], sizer: ChunkSizer) -> Iterator[Document]:
+    for doc in docs:  # "elements" mode: tables (one or more per sheet) and stray text
+        sheet = doc.metadata.get("page_name", "")
+        table_html = doc.metadata.get("text_as_html")
+        rows = _html_table_rows(table_html) if table_html else [
+            line for line in doc.page_content.splitlines() if line.strip()
+        ]
+        if len(rows) < 2:
+            yield from _split_text(sizer, doc, doc.page_content, chunk_type="sheet_text", sheet=sheet)
+            continue
+        header = f"Sheet: {sheet}\n{rows[0]}" if sheet else rows[0]
+        metadata = {k: v for k, v in doc.metadata.items() if k != "text_as_html"}
+        base = Document(page_content="", metadata=metadata)
+        yield from _batch_rows(sizer, base, header, enumerate(rows[1:], start=1), "sheet_rows", sheet=sheet)
+
+
+def split_slides(docs: Iterable[Document], sizer: ChunkSizer) -> Iterator[Document]:
+    # "elements" mode: a slide's elements arrive one after another
+    for number, elements in groupby(docs, key=lambda doc: doc.metadata.get("page_number")):
+        if number is None:
+            yield from split_recursive(elements, sizer)
+            continue
+        elements = [e for e in elements if e.page_content.strip()]
+        if not elements:
+            continue
+        # The slide title heads every piece of a long slide
+        title = next((e for e in elements if e.metadata.get("category") == "Title"), None)
+        text = "\n".join(e.page_content for e in elements if e is not title)
+        metadata = {k: v for k, v in elements[0].metadata.items() if k not in _ELEMENT_KEYS}
+        base = Document(page_content="", metadata=metadata)
+        yield from _split_text(sizer, base, text, prefix=title.page_content if title else "",
+                               chunk_type="slide", slide=number)
+
+
+def split_recursive(docs: Iterable[Document], sizer: ChunkSizer) -> Iterator[Document]:
+    splitter = sizer.splitter()
+    for doc in docs:
+        yield from splitter.split_documents([doc])
+
+
+STRATEGIES: Dict[str, Callable[[Iterable[Document], ChunkSizer], Iterator[Document]]] = {
+    ".md": split_markdown,
+    ".pdf": split_pdf,
+    ".csv": split_csv,
+    ".xlsx": split_excel,
+    ".xls": split_excel,
+    ".pptx": split_slides,
+    ".ppt": split_slides,
+}
+
+
+def iter_chunks(docs: Iterable[Document], file_path: str, config: dict) -> Iterator[Document]:
+    """
+    Chunk one file's documents with the strategy for its type, lazily:
+    documents are pulled from docs (e.g. loader.lazy_load()) only as chunks are consumed.
+    If the strategy fails, the rest of the file is split recursively instead.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    sizer = get_sizer(config, ext)
+    strategy = STRATEGIES.get(ext, split_recursive)
+    if config.get("chunking_strategy", "structured") != "structured":
+        strategy = split_recursive
+    if strategy is not split_recursive:
+        docs = _with_fallback(strategy, docs, sizer, file_path)
+    else:
+        docs = strategy(docs, sizer)
+    return (chunk for chunk in docs if chunk.page_content.strip())
+
+
+def _with_fallback(strategy, docs: Iterable[Document], sizer: ChunkSizer, file_path: str) -> Iterator[Document]:
+    """
+    Run a structured strategy over a document stream; on failure, split recursively
+    the documents it had not finished (those pulled since its last chunk, plus the one
+    that chunk came from) and the rest of the stream.
+    """
+    docs = iter(docs)
+    pending: List[Document] = []
+
+    def pull() -> Iterator[Document]:
+        for doc in docs:
+            pending.append(doc)
+            yield doc
+
+    try:
+        for chunk in strategy(pull(), sizer):
+            del pending[:-1]
+            yield chunk
+    except Exception as e:
+        logger.warning("Structured chunking failed for %s (%s); using recursive splitting",
+                       os.path.basename(file_path), e)
+        yield from split_recursive(chain(pending, docs), sizer)
@@ -0,0 +1,141 @@
+"""
+Named collections: independent FAISS/BM25 indexes with their own settings.
+
+The "default" collection is the index at config "db_path", so existing
+installs keep working unchanged. Other collections live under
+"collections_dir"/<name> and are registered in SQLite with per-collection
+overrides (embed model, chunk size, ...) on top of the global config.
+
+Loaded collections are kept in an LRU: idle ones are unloaded so many
+collections can exist on disk while only the active ones use RAM.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+from config_manager import load_config
+import database
+
+logger = logging.getLogger("RAG_Agent.collections")
+
+DEFAULT_COLLECTION = "default"
+
+# Settings a collection may override; everything else comes from the global config
+COLLECTION_SETTINGS = (
+    "embed_model", "chunk_size", "chunk_overlap", "chunking_strategy", "chunk_size_overrides", "chunk_size_unit",
+    "retrieval_k", "use_hybrid_search", "hybrid_alpha", "faiss_index_type", "vector_compression", "index_shards",
+)
+
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def is_valid_collection_name(name: str) -> bool:
+    """Names become directory names, so only allow a safe character set."""
+    return bool(name) and bool(_NAME_PATTERN.match(name))
+
+
+def collection_exists(name: Optional[str]) -> bool:
+    return name in (None, DEFAULT_COLLECTION) or database.get_collection(name) is not None
+
+
+def get_collection_config(name: Optional[str] = None) -> dict:
+    """
+    Effective config for a collection: the global config with the collection's
+    overrides and its own db_path. Raises KeyError for unknown collections.
+    """
+    config = load_config()
+    if name in (None, DEFAULT_COLLECTION):
+        return config
+
+    collection = database.get_collection(name)
+    if collection is None:
+        raise KeyError(f"Unknown collection: {name}")
+    merged = dict(config)
+    merged.update({k: v for k, v in collection["settings"].items() if k in COLLECTION_SETTINGS})
+    merged["db_path"] = os.path.join(config.get("collections_dir", "collections"), name)
+    return merged
+
+
+def create_collection(name: str, settings: Optional[dict] = None) -> dict:
+    """Register a collection. Raises ValueError for bad or duplicate names."""
+    if not is_valid_collection_name(name) or name == DEFAULT_COLLECTION:
+        raise ValueError("Collection names may only contain letters, digits, '_' and '-'")
+    settings = {k: v for k, v in (settings or {}).items() if k in COLLECTION_SETTINGS}
+    if not database.create_collection(name, settings):
+        raise ValueError(f"Collection already exists: {name}")
+    logger.info("Created collection %s %s", name, settings)
+    return {"name": name, "settings": settings}
+
+
+def list_collections() -> List[dict]:
+    """All collections, the implicit default first."""
+    config = load_config()
+    collections = [{"name": DEFAULT_COLLECTION, "settings": {}, "db_path": config.get("db_path", "faiss_index")}]
+    for collection in database.get_all_collections():
+        collection["db_path"] = os.path.join(config.get("collections_dir", "collections"), collection["name"])
+        collections.append(collection)
+    return collections
+
+
+def resolve_collections(value: Any) -> List[str]:
+    """Normalize a request's collection(s) argument (None, "name" or ["a", "b"]) to a list of names."""
+    if not value:
+        return [DEFAULT_COLLECTION]
+    if isinstance(value, str):
+        value = [value]
+    names = []
+    for name in value:
+        if name not in names:
+            names.append(name)
+    return names
+
+
+class CollectionCache:
+    """
+    LRU of per-collection objects (index holders), created on first use.
+    Entries beyond max_loaded, or unused for idle_seconds, are dropped;
+    queries that already hold a loaded index keep it until they finish.
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._entries = OrderedDict()  # name -> (entry, last_used)
+        self._lock = threading.Lock()
+
+    def get(self, name: str, max_loaded: int = 4, idle_seconds: float = 1800) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            if name in self._entries:
+                entry, _ = self._entries.pop(name)
+            else:
+                entry = self._factory()
+            self._entries[name] = (entry, now)
+
+            # Oldest first: evict idle entries and anything over the limit
+            for other in list(self._entries):
+                if other == name:
+                    break
+                _, last_used = self._entries[other]
+                if len(self._entries) > max(1, max_loaded) or now - last_used >= idle_seconds:
+                    del self._entries[other]
+                    logger.info("Unloaded idle collection %s", other)
+            return entry
+
+    def peek(self, name: str) -> Optional[Any]:
+        """Return a loaded entry without creating it or touching its LRU position."""
+        with self._lock:
+            item = self._entries.get(name)
+            return item[0] if item else None
+
+    def drop(self, name: str):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._entries)
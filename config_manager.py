@@ -4,9 +4,12 @@ Provides default settings and validation with caching.
 """
 
 import json
+import logging
 import os
 from typing import Any, Dict
 
+logger = logging.getLogger("RAG_Agent.config")
+
 CONFIG_FILE = "config.json"
 
 # Cache for configuration to reduce file I/O
@@ -24,6 +27,20 @@ DEFAULT_CONFIG = {
     # RAG Settings
     "chunk_size": 1000,
     "chunk_overlap": 200,
+    "chunking_strategy": "structured",  # Per-file-type chunking (see chunking.py); "recursive" = one splitter for all
+    "chunk_size_overrides": {},  # Per file type chunk_size, e.g. {"csv": 2000, "pptx": 1500}
+    "chunk_size_unit": "chars",  # Unit of chunk_size/chunk_overlap: "chars" or "tokens"
+    "tokenizer": "auto",  # Token counting: "auto" (tiktoken; approximate counts if it can't load its encoding), "approximate", or a tiktoken encoding
+    "context_token_budget": 3000,  # Max tokens of retrieved context in a chat prompt (0 = no limit)
+    "dedup_chunks": True,  # Drop near-duplicate chunks at ingest (SimHash + embedding check), keeping all sources
+    "dedup_max_distance": 3,  # SimHash bits (of 64) two chunks may differ in to be compared (0-3)
+    "dedup_min_similarity": 0.95,  # Embedding cosine similarity confirming a near-duplicate
+    "ingest_batch_chunks": 2000,  # Files are streamed; chunks are embedded in batches of this size
+    "ingest_publish_chunks": 20000,  # Embedded chunks written to the index (and searchable) at once
+    "graph_terms_per_file": 64,  # Most frequent content terms kept per file for the knowledge graph (see knowledge_graph.py)
+    "corpus_graph_vocabulary": 5000,  # Terms in the corpus-wide co-occurrence graph (see corpus_graph.py)
+    "corpus_graph_terms_per_chunk": 16,  # Highest-weighted terms per chunk counted as co-occurring
+    "corpus_graph_min_cooccurrence": 3,  # Chunks two terms must share to be linked
     "retrieval_k": 3,  # Number of documents to retrieve
     "use_hybrid_search": True,  # Enable BM25 + Vector hybrid search
     "hybrid_alpha": 0.5,  # Weight for vector search (1-alpha for BM25)
@@ -41,10 +58,69 @@ DEFAULT_CONFIG = {
     "ollama_host": "http://localhost:11434",
     "upload_dir": "./uploaded_files",
     "db_path": "faiss_index",
+    "mmap_index": True,  # Memory-map the FAISS index read-only (shared by server workers)
+    "collections_dir": "collections",  # Indexes of named collections ("default" uses db_path)
+    "max_loaded_collections": 4,  # Collections kept in memory; least recently used are unloaded
+    "collection_idle_seconds": 1800,  # Unload collections not queried for this long
+    "parsed_cache_dir": "parsed_cache",  # Extracted text of parsed files by content hash (preview, chat, ingest)
+    "parsed_cache_max_mb": 2048,  # Least recently used parsed files are evicted beyond this (0 = no cache)
+    "upload_sessions_dir": "upload_sessions",  # Partial resumable uploads (see uploads.py)
+    "upload_chunk_mb": 8,  # Byte range size suggested to resumable upload clients
+    "upload_session_ttl_hours": 24,  # Resumable uploads idle this long are deleted
+    "watch_uploads": True,  # Auto-ingest files added to / changed in the upload dir, remove deleted ones
+    "watch_debounce_seconds": 2,  # Changes are ingested once the upload dir was quiet this long...
+    "watch_max_delay_seconds": 30,  # ...or at the latest this long after the first change
+    "watch_poll_seconds": 2,  # Upload dir listing interval where inotify is unavailable
+    "watch_initial_scan": False,  # On startup, also sync changes made to the upload dir while the server was down
+    "file_catalog_rescan_seconds": 60,  # /api/files re-stats every upload this often (changes in between are tracked)
+    
+    # OCR Settings (see ocr.py; needs the tesseract binary)
+    "ocr_enabled": True,  # OCR scanned PDF pages and make images ingestible
+    "ocr_languages": "eng",  # Tesseract languages, e.g. "eng+deu"
+    "ocr_min_chars": 20,  # PDF pages with less extracted text than this are OCR'd
+    "ocr_workers": 0,  # OCR processes (0 = one per CPU)
+    "ocr_cache_dir": "ocr_cache",  # OCR text by page image hash
+    
+    # Vision Settings (see vision.py)
+    "vision_model": "moondream",  # Describes chat image attachments
+    "vision_image_size": 378,  # Images are downscaled to this longest side (moondream's input size)
+    "vision_image_quality": 85,  # JPEG quality of downscaled images
+    "image_cache_dir": "image_cache",  # Downscaled images by content hash
+    "vision_cache_max_entries": 1000,  # Cached image descriptions (SQLite); least recently used evicted
+    "index_image_descriptions": False,  # Ingest every described chat image (else only those sent with addToRag)
+    
+    # Vector Index Settings (see vector_index.py)
+    "faiss_index_type": "auto",  # 'auto', 'flat', 'ivf_flat', 'hnsw' or 'ivf_pq'
+    "ann_index_type": "ivf_flat",  # Type 'auto' promotes to once the corpus is large
+    "ann_promotion_threshold": 100000,  # Chunks before 'auto' leaves exact (flat) search
+    "faiss_nlist": 0,  # IVF cells (0 = ~4*sqrt(chunks))
+    "faiss_nprobe": 16,  # IVF cells searched per query (higher = better recall, slower)
+    "faiss_ef_search": 64,  # HNSW candidate list size per query
+    "faiss_pq_m": 16,  # PQ sub-quantizers (bytes per vector) for ivf_pq
+    "faiss_max_train_points": 0,  # Vectors sampled to train IVF/PQ (0 = 256 per cell or PQ centroid)
+    "hnsw_m": 32,  # HNSW neighbours per node (higher = better recall, more RAM)
+    "hnsw_ef_construction": 200,  # HNSW candidate list size while building
+    "vector_compression": "none",  # 'none', 'sq8' (int8, 4x smaller) or 'pq' (faiss_pq_m bytes/vector)
+    "rerank_factor": 4,  # Compressed search: candidates per result re-scored with exact vectors (0 = off)
+    "index_shards": 1,  # Split new indexes into N shards (by source file) searched in parallel
+    "shard_search_threads": 8,  # Thread pool size for parallel shard search
+    "delta_compaction_segments": 8,  # Ingests append delta segments; merge after this many (0 = rewrite the index each ingest)
+    "delta_compaction_ratio": 0.1,  # ...or once deltas hold this fraction of the main index's chunks
+    
+    # Production Server Settings (serve.py)
+    "server_host": "127.0.0.1",
+    "server_port": 8501,
+    "server_workers": 2,  # Worker processes (gunicorn only)
+    "server_threads": 8,  # Request threads per worker
     
     # UI Settings
     "theme": "dark",
     "show_sources": True,  # Show source documents in responses
+
+    # Logging Settings
+    "log_level": "INFO",
+    "log_levels": {},  # Per-module overrides, e.g. {"RAG_Agent.backend": "DEBUG"}
+    "log_payload_sample_every": 20,  # Log full prompts/vision output on 1 in N requests (DEBUG only)
 }
 
 
@@ -64,7 +140,7 @@ def load_config() -> Dict[str, Any]:
                 return _config_cache.copy()
             
             # Load from file
-            print(f"[DEBUG] Loading config from {CONFIG_FILE}...", flush=True)
+            logger.debug("Loading config from %s", CONFIG_FILE)
             with open(CONFIG_FILE, "r") as f:
                 saved_config = json.load(f)
                 # Merge saved config with defaults (saved values take precedence)
@@ -75,9 +151,9 @@ def load_config() -> Dict[str, Any]:
             _config_mtime = current_mtime
             
         except (json.JSONDecodeError, IOError) as e:
-            print(f"Warning: Could not load config file: {e}")
+            logger.warning("Could not load config file: %s", e)
     else:
-        print(f"[DEBUG] Config file {CONFIG_FILE} not found. Using defaults.", flush=True)
+        logger.debug("Config file %s not found. Using defaults.", CONFIG_FILE)
     
     return config
 
@@ -87,7 +163,7 @@ def save_config(config: Dict[str, Any]) -> bool:
     global _config_cache, _config_mtime
     
     try:
-        print(f"[DEBUG] Saving config to {CONFIG_FILE}...", flush=True)
+        logger.debug("Saving config to %s", CONFIG_FILE)
         with open(CONFIG_FILE, "w") as f:
             json.dump(config, f, indent=2)
         
@@ -97,13 +173,13 @@ def save_config(config: Dict[str, Any]) -> bool:
         
         return True
     except IOError as e:
-        print(f"Error saving config: {e}")
+        logger.error("Error saving config: %s", e)
         return False
 
 
 def update_config(updates: Dict[str, Any]) -> Dict[str, Any]:
     """Update specific configuration values and save."""
-    print(f"[DEBUG] Updating config with: {updates}", flush=True)
+    logger.debug("Updating config with: %s", updates)
     config = load_config()
     config.update(updates)
     save_config(config)
@@ -148,12 +224,24 @@ def validate_config(config: Dict[str, Any]) -> tuple[bool, list[str]]:
         config['hybrid_alpha'] = safe_float(config['hybrid_alpha'], DEFAULT_CONFIG['hybrid_alpha'])
     if 'max_history_context' in config:
         config['max_history_context'] = safe_int(config['max_history_context'], DEFAULT_CONFIG['max_history_context'])
+    for key in ('ann_promotion_threshold', 'faiss_nlist', 'faiss_nprobe', 'faiss_ef_search', 'faiss_pq_m',
+                'faiss_max_train_points', 'hnsw_m', 'hnsw_ef_construction', 'rerank_factor', 'index_shards',
+                'shard_search_threads', 'delta_compaction_segments', 'context_token_budget', 'dedup_max_distance',
+                'ingest_batch_chunks', 'ingest_publish_chunks', 'parsed_cache_max_mb', 'ocr_min_chars', 'ocr_workers',
+                'vision_image_size', 'vision_image_quality', 'vision_cache_max_entries', 'upload_chunk_mb',
+                'upload_session_ttl_hours', 'watch_debounce_seconds', 'watch_max_delay_seconds', 'watch_poll_seconds',
+                'file_catalog_rescan_seconds', 'graph_terms_per_file', 'corpus_graph_vocabulary',
+                'corpus_graph_terms_per_chunk', 'corpus_graph_min_cooccurrence'):
+        if key in config:
+            config[key] = safe_int(config[key], DEFAULT_CONFIG[key])
     
     # 2. logical/Boundary Checks
     
     # Validate chunk_size
-    if config['chunk_size'] < 100:
-        errors.append("chunk_size must be >= 100")
+    # Token-sized chunks are ~4x smaller numbers than character-sized ones
+    min_chunk_size = 25 if config.get("chunk_size_unit") == "tokens" else 100
+    if config['chunk_size'] < min_chunk_size:
+        errors.append(f"chunk_size must be >= {min_chunk_size}")
     
     # Validate chunk_overlap
     if config['chunk_overlap'] < 0:
@@ -174,6 +262,79 @@ def validate_config(config: Dict[str, Any]) -> tuple[bool, list[str]]:
     if config['max_history_context'] < 0:
         errors.append("max_history_context must be non-negative")
 
+    # Validate vector index settings
+    valid_index_types = ["auto", "flat", "ivf_flat", "hnsw", "ivf_pq"]
+    if config.get("faiss_index_type", "auto") not in valid_index_types:
+        errors.append(f"faiss_index_type must be one of {valid_index_types}")
+    valid_compression = ["none", "sq8", "pq"]
+    if config.get("vector_compression", "none") not in valid_compression:
+        errors.append(f"vector_compression must be one of {valid_compression}")
+    if config.get("faiss_nprobe", 1) < 1 or config.get("faiss_ef_search", 1) < 1:
+        errors.append("faiss_nprobe and faiss_ef_search must be positive integers")
+    if config.get("hnsw_m", 2) < 2 or config.get("hnsw_ef_construction", 1) < 1:
+        errors.append("hnsw_m must be >= 2 and hnsw_ef_construction positive")
+    if config.get("faiss_max_train_points", 0) < 0:
+        errors.append("faiss_max_train_points must be non-negative")
+    if 'delta_compaction_ratio' in config:
+        config['delta_compaction_ratio'] = safe_float(config['delta_compaction_ratio'], DEFAULT_CONFIG['delta_compaction_ratio'])
+        if config['delta_compaction_ratio'] <= 0:
+            errors.append("delta_compaction_ratio must be positive")
+
+    # Validate chunking
+    if config.get("chunking_strategy", "structured") not in ("structured", "recursive"):
+        errors.append("chunking_strategy must be 'structured' or 'recursive'")
+    overrides = config.get("chunk_size_overrides", {})
+    if not isinstance(overrides, dict) or not all(
+            isinstance(v, int) and not isinstance(v, bool) and v >= min_chunk_size for v in overrides.values()):
+        errors.append(f"chunk_size_overrides must map file types to chunk sizes >= {min_chunk_size}")
+
+    # Validate token sizing
+    if config.get("chunk_size_unit", "chars") not in ("chars", "tokens"):
+        errors.append("chunk_size_unit must be 'chars' or 'tokens'")
+    budget = config.get("context_token_budget", 0)
+    if budget < 0:
+        errors.append("context_token_budget must be non-negative")
+    elif budget and config.get("chunk_size_unit") == "tokens" and config['chunk_size'] > budget:
+        errors.append("chunk_size (tokens) must not exceed context_token_budget")
+
+    # Validate near-duplicate detection
+    if not 0 <= config.get("dedup_max_distance", 3) <= 3:
+        errors.append("dedup_max_distance must be between 0 and 3")
+    if 'dedup_min_similarity' in config:
+        config['dedup_min_similarity'] = safe_float(config['dedup_min_similarity'], DEFAULT_CONFIG['dedup_min_similarity'])
+        if not 0 < config['dedup_min_similarity'] <= 1:
+            errors.append("dedup_min_similarity must be between 0 and 1")
+
+    # Validate streaming ingest
+    if config.get("ingest_batch_chunks", 1) < 1:
+        errors.append("ingest_batch_chunks must be a positive integer")
+    if config.get("ingest_publish_chunks", 1) < 1:
+        errors.append("ingest_publish_chunks must be a positive integer")
+    if config.get("parsed_cache_max_mb", 0) < 0:
+        errors.append("parsed_cache_max_mb must be non-negative")
+    if config.get("ocr_min_chars", 0) < 0 or config.get("ocr_workers", 0) < 0:
+        errors.append("ocr_min_chars and ocr_workers must be non-negative")
+    if config.get("upload_chunk_mb", 1) < 1 or config.get("upload_session_ttl_hours", 1) < 1:
+        errors.append("upload_chunk_mb and upload_session_ttl_hours must be positive integers")
+    if min(config.get(key, 1) for key in ("watch_debounce_seconds", "watch_max_delay_seconds", "watch_poll_seconds")) < 1:
+        errors.append("watch_debounce_seconds, watch_max_delay_seconds and watch_poll_seconds must be positive integers")
+    if config.get("file_catalog_rescan_seconds", 1) < 1:
+        errors.append("file_catalog_rescan_seconds must be a positive integer")
+    if config.get("graph_terms_per_file", 1) < 1:
+        errors.append("graph_terms_per_file must be a positive integer")
+    if config.get("corpus_graph_vocabulary", 2) < 2 or config.get("corpus_graph_terms_per_chunk", 2) < 2:
+        errors.append("corpus_graph_vocabulary and corpus_graph_terms_per_chunk must be at least 2")
+    if config.get("corpus_graph_min_cooccurrence", 1) < 1:
+        errors.append("corpus_graph_min_cooccurrence must be a positive integer")
+
+    # Validate vision image preparation
+    if config.get("vision_image_size", 378) < 64:
+        errors.append("vision_image_size must be >= 64")
+    if not 1 <= config.get("vision_image_quality", 85) <= 95:
+        errors.append("vision_image_quality must be between 1 and 95")
+    if config.get("vision_cache_max_entries", 1) < 1:
+        errors.append("vision_cache_max_entries must be a positive integer")
+
     # Validate Mode
     valid_modes = ["cli", "browser"]
     if config.get("mode") not in valid_modes:
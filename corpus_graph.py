@@ -0,0 +1,267 @@
+"""
+Corpus-scale term graph: term co-occurrence, PMI edges and communities.
+
+knowledge_graph.py links files to their own top terms, a page at a time.
+This builds a graph over every chunk of a collection, for an overview the
+UI can drill into: the topics of the corpus (clusters of terms that occur
+together), the terms that make them up, and the files they are in.
+
+- Vocabulary: the "corpus_graph_vocabulary" content terms in the most
+  chunks, leaving out terms in more than half of them
+- Chunk x term matrix: each chunk's "corpus_graph_terms_per_chunk"
+  vocabulary terms with the highest BM25 weight, read from the postings of
+  the BM25 indexes already in memory, so no text is tokenized again
+- Co-occurrence: X^T X of that binary matrix, counted as term pairs per
+  chunk with numpy (vectorized per chunk length; scipy is not a dependency)
+- Edges: normalized PMI of the pairs in at least
+  "corpus_graph_min_cooccurrence" chunks; every term keeps its
+  EDGES_PER_TERM strongest
+- Communities: weighted label propagation over the edges
+
+The result is built on a background thread (see backend.get_corpus_graph)
+and saved next to the index with the index generation it describes, so
+every worker process and restart reuses it until the index changes.
+"""
+
+import heapq
+import json
+import logging
+import os
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from knowledge_graph import is_content_term
+
+logger = logging.getLogger("RAG_Agent.corpus_graph")
+
+CORPUS_GRAPH_FILE = "corpus_graph.json"
+
+EDGES_PER_TERM = 10
+MIN_NPMI = 0.1  # Pairs barely more frequent than chance are not edges
+MAX_CHUNK_SHARE = 0.5  # Terms in more chunks than this share are too common to be topics
+TOP_TERMS = 10  # Per cluster summary
+TOP_FILES = 5
+MAX_CLUSTER_EDGES = 1000  # Per cluster drill-down
+
+
+def _vocabulary(indexes: Sequence, size: int) -> List[str]:
+    """The size content terms in the most chunks (but not in too many)."""
+    chunk_counts = Counter()
+    for index in indexes:
+        chunk_counts.update(index.doc_freqs)
+    n_chunks = sum(len(index.documents) for index in indexes)
+    max_count = max(2, MAX_CHUNK_SHARE * n_chunks)
+    candidates = ((count, term) for term, count in chunk_counts.items()
+                  if 2 <= count <= max_count and is_content_term(term))
+    return sorted(term for _, term in heapq.nlargest(size, candidates))
+
+
+def _chunk_terms(indexes: Sequence, vocabulary: List[str], per_chunk: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(chunk, term) entries of the matrix: each chunk's per_chunk highest-weighted vocabulary terms."""
+    rows, cols, weights = [], [], []
+    offset = 0
+    for index in indexes:
+        for term_id, term in enumerate(vocabulary):
+            posting = index.term_postings(term)
+            if posting is not None:
+                rows.append(posting[0] + offset)
+                cols.append(np.full(len(posting[0]), term_id, dtype=np.int64))
+                weights.append(posting[1])
+        offset += len(index.documents)
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+    order = np.lexsort((-weights, rows))
+    rows, cols = rows[order], cols[order]
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    rank = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+    keep = rank < per_chunk
+    return rows[keep], cols[keep]
+
+
+def _cooccurrence(rows: np.ndarray, cols: np.ndarray, n_terms: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(term a, term b, chunks having both) for a < b: the upper triangle of X^T X."""
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    lengths = np.diff(np.r_[starts, len(rows)])
+    codes = []
+    # Chunks with the same number of terms form a matrix: all their pairs at once
+    for length in np.unique(lengths):
+        if length < 2:
+            continue
+        terms = cols[starts[lengths == length][:, None] + np.arange(length)]
+        a, b = np.triu_indices(length, 1)
+        codes.append(terms[:, a] * n_terms + terms[:, b])
+    if not codes:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    pairs, counts = np.unique(np.concatenate([code.ravel() for code in codes]), return_counts=True)
+    return pairs // n_terms, pairs % n_terms, counts
+
+
+def _strongest_edges(a: np.ndarray, b: np.ndarray, weight: np.ndarray, per_node: int) -> np.ndarray:
+    """Mask of the edges among the per_node strongest of either of their terms."""
+    edge = np.r_[np.arange(len(a)), np.arange(len(a))]
+    node = np.r_[a, b]
+    order = np.lexsort((-np.r_[weight, weight], node))
+    node, edge = node[order], edge[order]
+    starts = np.flatnonzero(np.r_[True, node[1:] != node[:-1]])
+    rank = np.arange(len(node)) - np.repeat(starts, np.diff(np.r_[starts, len(node)]))
+    keep = np.zeros(len(a), dtype=bool)
+    keep[edge[rank < per_node]] = True
+    return keep
+
+
+def _communities(n_nodes: int, a: np.ndarray, b: np.ndarray, weight: np.ndarray,
+                 max_iterations: int = 50) -> np.ndarray:
+    """
+    Community label of every node by weighted label propagation: each node
+    takes the label with the largest total edge weight among its neighbours.
+    Half of the nodes (at random, seeded) move per round, so labels don't
+    oscillate between two partitions.
+    """
+    labels = np.arange(n_nodes)
+    if not len(a):
+        return labels
+    source, target, edge_weight = np.r_[a, b], np.r_[b, a], np.r_[weight, weight]
+    rng = np.random.default_rng(0)
+    for _ in range(max_iterations):
+        codes, inverse = np.unique(source * n_nodes + labels[target], return_inverse=True)
+        totals = np.bincount(inverse, weights=edge_weight)
+        nodes, candidates = codes // n_nodes, codes % n_nodes
+        order = np.lexsort((candidates, -totals, nodes))  # Ties go to the smallest label
+        best_rows = order[np.r_[True, nodes[order][1:] != nodes[order][:-1]]]
+        best = labels.copy()
+        best[nodes[best_rows]] = candidates[best_rows]
+        if np.array_equal(best, labels):
+            break
+        labels = np.where(rng.random(n_nodes) < 0.5, best, labels)
+    return labels
+
+
+def build_corpus_graph(indexes: Sequence, sources: Sequence[str], config: dict) -> dict:
+    """
+    The term graph of the chunks of indexes (BM25Index objects, chunk
+    positions numbered across them in order); sources[i] is the file of
+    chunk i. Returns the clusters with their summaries, the links between
+    clusters, and per cluster its terms and edges for drilling down.
+    """
+    started = time.perf_counter()
+    n_chunks = len(sources)
+    vocabulary = _vocabulary(indexes, config.get("corpus_graph_vocabulary", 5000))
+    rows, cols = _chunk_terms(indexes, vocabulary, config.get("corpus_graph_terms_per_chunk", 16))
+    a, b, together = _cooccurrence(rows, cols, len(vocabulary))
+
+    # Normalized PMI: log(p(a,b) / p(a)p(b)) / -log p(a,b), in [-1, 1]
+    term_chunks = np.bincount(cols, minlength=len(vocabulary))
+    keep = together >= config.get("corpus_graph_min_cooccurrence", 3)
+    a, b, together = a[keep], b[keep], together[keep]
+    joint = together / n_chunks if n_chunks else together.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pmi = np.log(joint / (term_chunks[a] / n_chunks * term_chunks[b] / n_chunks))
+        npmi = np.where(joint < 1, pmi / -np.log(joint), 1.0)
+    keep = npmi > MIN_NPMI
+    a, b, together, npmi = a[keep], b[keep], together[keep], npmi[keep]
+    keep = _strongest_edges(a, b, npmi, EDGES_PER_TERM)
+    a, b, together, npmi = a[keep], b[keep], together[keep], npmi[keep]
+
+    labels = _communities(len(vocabulary), a, b, npmi)
+    # Clusters of connected terms only, numbered by size
+    connected = np.zeros(len(vocabulary), dtype=bool)
+    connected[a] = connected[b] = True
+    sizes = Counter(labels[connected].tolist())
+    cluster_of = {label: number for number, (label, size) in
+                  enumerate(sorted(sizes.items(), key=lambda item: (-item[1], item[0]))) if size > 1}
+    cluster = np.array([cluster_of.get(label, -1) for label in labels.tolist()], dtype=np.int64)
+    base = max(1, len(cluster_of))  # For (x, cluster) pair codes
+
+    # Weighted degree within the cluster ranks its terms
+    inside = (cluster[a] == cluster[b]) & (cluster[a] >= 0)
+    strength = np.bincount(np.r_[a[inside], b[inside]], weights=np.r_[npmi[inside], npmi[inside]],
+                           minlength=len(vocabulary))
+
+    # Chunks and files touching each cluster (a chunk counts once per cluster)
+    entry_cluster = cluster[cols]
+    valid = entry_cluster >= 0
+    chunk_codes = np.unique(rows[valid] * base + entry_cluster[valid])
+    chunk_ids, chunk_clusters = chunk_codes // base, chunk_codes % base
+    cluster_chunks = np.bincount(chunk_clusters, minlength=len(cluster_of))
+    file_names = sorted(set(sources))
+    file_position = {name: i for i, name in enumerate(file_names)}
+    file_of_chunk = np.array([file_position[source] for source in sources], dtype=np.int64)
+    file_codes, file_counts = np.unique(file_of_chunk[chunk_ids] * base + chunk_clusters, return_counts=True)
+
+    clusters = []
+    for number in range(len(cluster_of)):
+        members = np.flatnonzero(cluster == number)
+        members = members[np.lexsort((members, -strength[members]))]
+        in_cluster = file_codes % base == number
+        top_files = heapq.nlargest(TOP_FILES, zip(file_counts[in_cluster].tolist(),
+                                                  (file_codes[in_cluster] // base).tolist()))
+        edges = np.flatnonzero(inside & (cluster[a] == number))
+        edges = edges[np.argsort(-npmi[edges], kind="stable")][:MAX_CLUSTER_EDGES]
+        clusters.append({
+            "id": number,
+            "label": " / ".join(vocabulary[i] for i in members[:3]),
+            "size": len(members),
+            "chunks": int(cluster_chunks[number]),
+            "top_terms": [vocabulary[i] for i in members[:TOP_TERMS]],
+            "files": [{"source": file_names[file], "chunks": count} for count, file in top_files],
+            "terms": [{"term": vocabulary[i], "chunks": int(term_chunks[i]), "strength": round(float(strength[i]), 4)}
+                      for i in members],
+            "edges": [{"source": vocabulary[a[i]], "target": vocabulary[b[i]], "npmi": round(float(npmi[i]), 4),
+                       "chunks": int(together[i])} for i in edges],
+        })
+
+    # Links between clusters: the summed NPMI of the edges across them
+    across = (cluster[a] != cluster[b]) & (cluster[a] >= 0) & (cluster[b] >= 0)
+    low, high = np.minimum(cluster[a][across], cluster[b][across]), np.maximum(cluster[a][across], cluster[b][across])
+    pair_codes, pair_index = np.unique(low * base + high, return_inverse=True)
+    pair_weights = np.bincount(pair_index, weights=npmi[across], minlength=len(pair_codes))
+    links = [{"source": int(code // base), "target": int(code % base), "value": round(float(weight), 4)}
+             for code, weight in zip(pair_codes, pair_weights)]
+
+    logger.info("Corpus graph: %d chunks, %d terms, %d edges, %d clusters in %.1fs",
+                n_chunks, len(vocabulary), len(a), len(clusters), time.perf_counter() - started)
+    return {"chunks": n_chunks, "terms": len(vocabulary), "edges": int(len(a)), "clusters": clusters, "links": links}
+
+
+def summary(graph: dict) -> dict:
+    """The graph without the per-cluster terms and edges (the overview)."""
+    return {**graph, "clusters": [{key: value for key, value in cluster.items() if key not in ("terms", "edges")}
+                                  for cluster in graph["clusters"]]}
+
+
+def save_corpus_graph(db_path: str, graph: dict):
+    path = os.path.join(db_path, CORPUS_GRAPH_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(graph, f)
+    os.replace(tmp_path, path)
+
+
+_loaded: Dict[str, Tuple[int, dict]] = {}  # db_path -> (file mtime, graph)
+
+
+def load_corpus_graph(db_path: str) -> Optional[dict]:
+    """The saved graph of an index (whatever generation it describes), None if there is none."""
+    path = os.path.join(db_path, CORPUS_GRAPH_FILE)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _loaded.get(db_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path, encoding="utf-8") as f:
+            graph = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not read %s: %s", path, e)
+        return None
+    _loaded[db_path] = (mtime, graph)
+    return graph
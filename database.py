@@ -5,6 +5,9 @@ Thread-safe database operations for storing chat history and sessions.
 
 import sqlite3
 import threading
+import time
+from collections import Counter
+from collections.abc import MutableMapping
 from datetime import datetime
 from contextlib import contextmanager
 import json
@@ -20,8 +23,10 @@ _lock = threading.Lock()
 def get_connection():
     """Get a thread-local database connection."""
     if not hasattr(_local, 'connection'):
-        _local.connection = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _local.connection = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10)
         _local.connection.row_factory = sqlite3.Row
+        # WAL lets several server worker processes read while one writes
+        _local.connection.execute('PRAGMA journal_mode=WAL')
     return _local.connection
 
 
@@ -72,8 +77,6 @@ def init_db():
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_created ON chat_messages(created_at)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_role ON chat_messages(role)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_updated ON chat_sessions(updated_at)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_pinned ON chat_sessions(is_pinned, updated_at)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_prompt_created ON prompt_library(created_at)')
         
         # ---------------------------------------------------------
         # MIGRATION: Add is_pinned to chat_sessions if not exists
@@ -82,6 +85,7 @@ def init_db():
             cursor.execute('ALTER TABLE chat_sessions ADD COLUMN is_pinned BOOLEAN DEFAULT 0')
         except sqlite3.OperationalError:
             pass # Column likely exists already
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_pinned ON chat_sessions(is_pinned, updated_at)')
             
         # ---------------------------------------------------------
         # NEW TABLE: Prompt Library
@@ -95,6 +99,7 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_prompt_created ON prompt_library(created_at)')
 
 
         # ---------------------------------------------------------
@@ -108,6 +113,77 @@ def init_db():
             )
         ''')
 
+        # ---------------------------------------------------------
+        # NEW TABLE: Shared State (tasks, browser context, pending
+        # approvals) visible to every server worker process
+        # ---------------------------------------------------------
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shared_state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+
+        # ---------------------------------------------------------
+        # NEW TABLE: Collections (named indexes with their own settings)
+        # ---------------------------------------------------------
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS collections (
+                name TEXT PRIMARY KEY,
+                settings TEXT DEFAULT '{}',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # ---------------------------------------------------------
+        # NEW TABLE: Vision descriptions (by image content hash,
+        # vision model and prompt), least recently used evicted
+        # ---------------------------------------------------------
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS vision_descriptions (
+                image_hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                description TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (image_hash, model, prompt_hash)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_vision_last_used ON vision_descriptions(last_used)')
+
+        # ---------------------------------------------------------
+        # NEW TABLE: Sources (indexed files per collection, with their
+        # top terms for the knowledge graph), kept in step with the
+        # index by ingest/removal; source_catalogs holds the index
+        # generation the rows describe
+        # ---------------------------------------------------------
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sources (
+                collection TEXT NOT NULL,
+                source TEXT NOT NULL,
+                full_path TEXT,
+                chunks INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER,
+                ingested_at REAL,
+                content_hash TEXT,
+                terms TEXT,
+                PRIMARY KEY (collection, source)
+            )
+        ''')
+        try:
+            cursor.execute('ALTER TABLE sources ADD COLUMN terms TEXT')
+        except sqlite3.OperationalError:
+            pass # Column exists already
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS source_catalogs (
+                collection TEXT PRIMARY KEY,
+                index_generation INTEGER NOT NULL
+            )
+        ''')
+
 
 def get_file_tags(filename):
     """Get tags for a specific file."""
@@ -128,15 +204,24 @@ def set_file_tags(filename, tags):
         with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute(
+                # Millisecond updated_at: see get_file_tags_version
                 '''INSERT INTO documents (filename, tags, updated_at) 
-                   VALUES (?, ?, CURRENT_TIMESTAMP)
+                   VALUES (?, ?, strftime('%Y-%m-%d %H:%M:%f', 'now'))
                    ON CONFLICT(filename) DO UPDATE SET 
                    tags=excluded.tags, 
-                   updated_at=CURRENT_TIMESTAMP''',
+                   updated_at=excluded.updated_at''',
                 (filename, json.dumps(tags))
             )
             return cursor.rowcount > 0
 
+def get_file_tags_version():
+    """Changes whenever any file's tags change (in any process): (tagged files, last update)."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) AS count, MAX(updated_at) AS latest FROM documents')
+        row = cursor.fetchone()
+        return (row['count'], row['latest'])
+
 def get_all_file_tags():
     """Get all file tags as a dictionary {filename: [tags]}."""
     with get_db() as conn:
@@ -151,6 +236,21 @@ def get_all_file_tags():
         return result
 
 
+def get_files_with_tags(tags):
+    """Get filenames having any of the given tags (tag -> files lookup for retrieval filters)."""
+    if not tags:
+        return []
+    with get_db() as conn:
+        cursor = conn.cursor()
+        placeholders = ", ".join("?" for _ in tags)
+        cursor.execute(
+            f'''SELECT DISTINCT documents.filename FROM documents, json_each(documents.tags)
+               WHERE json_each.value IN ({placeholders})''',
+            list(tags)
+        )
+        return [row['filename'] for row in cursor.fetchall()]
+
+
 def create_session(name=None, model_used=None):
     """Create a new chat session."""
     if name is None:
@@ -399,6 +499,214 @@ def delete_prompt(prompt_id):
             return cursor.rowcount > 0
 
 
+# ---------------------------------------------------------
+# Collections
+# ---------------------------------------------------------
+def create_collection(name, settings=None):
+    """Register a named collection. Returns False if it already exists."""
+    with _lock:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'INSERT OR IGNORE INTO collections (name, settings) VALUES (?, ?)',
+                (name, json.dumps(settings or {}))
+            )
+            return cursor.rowcount > 0
+
+def get_collection(name):
+    """Get a collection {name, settings, created_at} or None."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM collections WHERE name = ?', (name,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        collection = dict(row)
+        collection['settings'] = json.loads(collection['settings'] or '{}')
+        return collection
+
+def get_all_collections():
+    """Get all registered collections, oldest first."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM collections ORDER BY created_at, name')
+        collections = []
+        for row in cursor.fetchall():
+            collection = dict(row)
+            collection['settings'] = json.loads(collection['settings'] or '{}')
+            collections.append(collection)
+        return collections
+
+def delete_collection(name):
+    """Remove a collection from the registry (its index files are removed by the caller)."""
+    with _lock:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM collections WHERE name = ?', (name,))
+            return cursor.rowcount > 0
+
+
+# ---------------------------------------------------------
+# Source catalog
+# ---------------------------------------------------------
+_SOURCE_COLUMNS = ('source', 'full_path', 'chunks', 'bytes', 'ingested_at', 'content_hash')
+
+def get_sources(collection, index_generation):
+    """
+    Indexed files of a collection [{source, full_path, chunks, bytes,
+    ingested_at, content_hash}] sorted by source, or None if the table does
+    not describe that index generation (not built yet, or behind).
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT index_generation FROM source_catalogs WHERE collection = ?', (collection,))
+        row = cursor.fetchone()
+        if row is None or row['index_generation'] != index_generation:
+            return None
+        cursor.execute(
+            f'''SELECT {", ".join(_SOURCE_COLUMNS)} FROM sources
+               WHERE collection = ? ORDER BY source''',
+            (collection,)
+        )
+        return [dict(row) for row in cursor.fetchall()]
+
+def _read_source_terms(cursor, collection, sources=None):
+    if sources is None:
+        cursor.execute('SELECT source, terms FROM sources WHERE collection = ? AND terms IS NOT NULL', (collection,))
+        rows = cursor.fetchall()
+    else:
+        sources, rows = list(sources), []
+        for start in range(0, len(sources), 500):  # SQLite limits the number of parameters
+            batch = sources[start:start + 500]
+            cursor.execute(
+                f'''SELECT source, terms FROM sources WHERE collection = ? AND terms IS NOT NULL
+                   AND source IN ({", ".join("?" for _ in batch)})''',
+                [collection, *batch]
+            )
+            rows.extend(cursor.fetchall())
+    return {row['source']: json.loads(row['terms']) for row in rows}
+
+def get_source_terms(collection, sources=None):
+    """{source: {term: count}} of a collection's files (all, or the given sources) with terms recorded."""
+    with get_db() as conn:
+        return _read_source_terms(conn.cursor(), collection, sources)
+
+def _source_values(collection, source):
+    terms = source.get('terms')
+    return (collection, *(source.get(column) for column in _SOURCE_COLUMNS),
+            None if terms is None else json.dumps(terms))
+
+def set_sources(collection, index_generation, sources):
+    """
+    Replace a collection's sources with a full listing of an index generation
+    (dicts as in get_sources, optionally with "terms": {term: count}).
+    """
+    with _lock:
+        with get_db() as conn:
+            conn.execute('DELETE FROM sources WHERE collection = ?', (collection,))
+            conn.executemany(
+                f'''INSERT INTO sources (collection, {", ".join(_SOURCE_COLUMNS)}, terms)
+                   VALUES (?, {", ".join("?" for _ in _SOURCE_COLUMNS)}, ?)''',
+                [_source_values(collection, source) for source in sources]
+            )
+            conn.execute(
+                '''INSERT INTO source_catalogs (collection, index_generation) VALUES (?, ?)
+                   ON CONFLICT(collection) DO UPDATE SET index_generation=excluded.index_generation''',
+                (collection, index_generation)
+            )
+
+def update_sources(collection, previous_generation, index_generation, added=(), removed=(), max_terms=64):
+    """
+    Apply one index write to a collection's sources, in one transaction:
+    added chunks (dicts as in get_sources, "chunks" and "terms" counted on
+    top of what is recorded, keeping the max_terms most frequent terms) and
+    removed sources. Only applied if the table describes previous_generation
+    (0: no index yet); otherwise it stays behind, to be rebuilt with
+    set_sources. Returns True if applied.
+    """
+    with _lock:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT index_generation FROM source_catalogs WHERE collection = ?', (collection,))
+            row = cursor.fetchone()
+            if (row['index_generation'] if row else 0) != previous_generation:
+                return False
+            if not previous_generation:
+                cursor.execute('DELETE FROM sources WHERE collection = ?', (collection,))
+            added = list(added)
+            # A file indexed over several batches: its term counts add up
+            recorded = _read_source_terms(cursor, collection,
+                                          [source['source'] for source in added if source.get('terms')])
+            for i, source in enumerate(added):
+                if source['source'] in recorded:
+                    terms = Counter(recorded[source['source']])
+                    terms.update(source['terms'])
+                    added[i] = dict(source, terms=dict(terms.most_common(max_terms)))
+            cursor.executemany(
+                f'''INSERT INTO sources (collection, {", ".join(_SOURCE_COLUMNS)}, terms)
+                   VALUES (?, {", ".join("?" for _ in _SOURCE_COLUMNS)}, ?)
+                   ON CONFLICT(collection, source) DO UPDATE SET
+                   full_path=excluded.full_path,
+                   chunks=sources.chunks + excluded.chunks,
+                   bytes=excluded.bytes,
+                   ingested_at=MAX(COALESCE(sources.ingested_at, 0), excluded.ingested_at),
+                   content_hash=excluded.content_hash,
+                   terms=COALESCE(excluded.terms, sources.terms)''',
+                [_source_values(collection, source) for source in added]
+            )
+            cursor.executemany('DELETE FROM sources WHERE collection = ? AND source = ?',
+                               [(collection, source) for source in removed])
+            cursor.execute(
+                '''INSERT INTO source_catalogs (collection, index_generation) VALUES (?, ?)
+                   ON CONFLICT(collection) DO UPDATE SET index_generation=excluded.index_generation''',
+                (collection, index_generation)
+            )
+            return True
+
+def clear_sources(collection):
+    """Forget a collection's sources (its index was cleared)."""
+    with _lock:
+        with get_db() as conn:
+            conn.execute('DELETE FROM sources WHERE collection = ?', (collection,))
+            conn.execute('DELETE FROM source_catalogs WHERE collection = ?', (collection,))
+
+
+# ---------------------------------------------------------
+# Vision descriptions
+# ---------------------------------------------------------
+def get_vision_description(image_hash, model, prompt_hash):
+    """Cached description of an image, or None. A hit counts as a use for eviction."""
+    with _lock:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''UPDATE vision_descriptions SET last_used = ?
+                   WHERE image_hash = ? AND model = ? AND prompt_hash = ?
+                   RETURNING description''',
+                (time.time(), image_hash, model, prompt_hash)
+            )
+            rows = cursor.fetchall()  # Runs the statement to completion before the commit
+            return rows[0]['description'] if rows else None
+
+def save_vision_description(image_hash, model, prompt_hash, description, max_entries=1000):
+    """Cache an image description, evicting the least recently used beyond max_entries."""
+    with _lock:
+        with get_db() as conn:
+            conn.execute(
+                '''INSERT INTO vision_descriptions (image_hash, model, prompt_hash, description, last_used)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(image_hash, model, prompt_hash) DO UPDATE SET
+                   description=excluded.description,
+                   last_used=excluded.last_used''',
+                (image_hash, model, prompt_hash, description, time.time())
+            )
+            conn.execute(
+                '''DELETE FROM vision_descriptions WHERE rowid NOT IN
+                   (SELECT rowid FROM vision_descriptions ORDER BY last_used DESC LIMIT ?)''',
+                (max_entries,)
+            )
+
+
 def search_chat_data(query):
     """Search for sessions and messages matching the query."""
     results = {"sessions": [], "messages": []}
@@ -426,3 +734,100 @@ def search_chat_data(query):
         results["messages"] = [dict(row) for row in cursor.fetchall()]
         
     return results
+
+
+# ---------------------------------------------------------
+# NEW: Shared State (multi-worker)
+# ---------------------------------------------------------
+class SharedStateDict(MutableMapping):
+    """
+    Dict-like view over one namespace of the shared_state table.
+
+    Replaces module-level dicts (TASKS, BROWSER_SESSIONS, PENDING_ACTIONS) so
+    that every worker process of the production server sees the same state.
+    Values must be JSON-serializable and are copied on read: mutate, then
+    assign back (state[key] = value) to persist.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+
+    def __getitem__(self, key):
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT value FROM shared_state WHERE namespace = ? AND key = ?',
+                (self.namespace, str(key))
+            )
+            row = cursor.fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row['value'])
+
+    def __setitem__(self, key, value):
+        with _lock:
+            with get_db() as conn:
+                conn.execute(
+                    '''INSERT INTO shared_state (namespace, key, value, updated_at)
+                       VALUES (?, ?, ?, ?)
+                       ON CONFLICT(namespace, key) DO UPDATE SET
+                       value=excluded.value,
+                       updated_at=excluded.updated_at''',
+                    (self.namespace, str(key), json.dumps(value), time.time())
+                )
+
+    def __delitem__(self, key):
+        with _lock:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'DELETE FROM shared_state WHERE namespace = ? AND key = ?',
+                    (self.namespace, str(key))
+                )
+                if cursor.rowcount == 0:
+                    raise KeyError(key)
+
+    _MISSING = object()
+
+    def pop(self, key, default=_MISSING):
+        """
+        Remove and return an entry in one statement, so when several workers
+        pop the same key only one gets the value (the others get default).
+        """
+        with _lock:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'DELETE FROM shared_state WHERE namespace = ? AND key = ? RETURNING value',
+                    (self.namespace, str(key))
+                )
+                rows = cursor.fetchall()  # Runs the statement to completion before the commit
+        if rows:
+            return json.loads(rows[0]['value'])
+        if default is self._MISSING:
+            raise KeyError(key)
+        return default
+
+    def __iter__(self):
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT key FROM shared_state WHERE namespace = ?', (self.namespace,))
+            keys = [row['key'] for row in cursor.fetchall()]
+        return iter(keys)
+
+    def __len__(self):
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) as count FROM shared_state WHERE namespace = ?', (self.namespace,))
+            return cursor.fetchone()['count']
+
+    def purge_older_than(self, max_age_seconds):
+        """Delete entries not updated within max_age_seconds. Returns the number removed."""
+        with _lock:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'DELETE FROM shared_state WHERE namespace = ? AND updated_at < ?',
+                    (self.namespace, time.time() - max_age_seconds)
+                )
+                return cursor.rowcount
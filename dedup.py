@@ -0,0 +1,245 @@
+"""
+Near-duplicate chunk elimination at ingest.
+
+Corporate documents repeat boilerplate (headers, disclaimers, slide
+templates). Indexing every copy wastes embedding calls and index space, and
+near-identical chunks crowd distinct content out of the top-k results.
+
+Every chunk gets a 64-bit SimHash of its word 3-shingles ("simhash"
+metadata). Chunks whose hashes differ in at most "dedup_max_distance" bits
+are candidates: identical hashes are duplicates outright, others only if
+their embeddings have cosine similarity >= "dedup_min_similarity".
+Candidates are found with banded LSH: with distance <= 3, at least one of
+four 16-bit bands matches exactly.
+
+A duplicate is dropped and the kept chunk lists both files in "sources". If
+the kept chunk is already indexed, the extra source is appended to the
+store's aliases file instead of rewriting the stored chunk, and applied
+whenever the store is loaded.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("RAG_Agent.dedup")
+
+SIMHASH_BITS = 64
+ALIASES_FILE = "aliases.jsonl"
+
+_BANDS = 4
+_BAND_BITS = SIMHASH_BITS // _BANDS
+_SHINGLE_SIZE = 3
+
+
+def simhash(text: str) -> int:
+    """64-bit SimHash of a text's lowercased word 3-shingles."""
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return 0
+    shingles = {" ".join(words[i:i + _SHINGLE_SIZE]) for i in range(max(1, len(words) - _SHINGLE_SIZE + 1))}
+    digests = b"".join(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest() for s in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(len(shingles), SIMHASH_BITS)
+    # Majority vote per bit position
+    votes = bits.sum(axis=0) * 2 > len(shingles)
+    return int.from_bytes(np.packbits(votes).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class SimHashIndex:
+    """Banded LSH over SimHashes: finds hashes within a few bits of a query."""
+
+    def __init__(self):
+        self._bands: List[Dict[int, List[Tuple[int, object]]]] = [{} for _ in range(_BANDS)]
+
+    def add(self, value: int, key: object):
+        for band, table in enumerate(self._bands):
+            table.setdefault((value >> (band * _BAND_BITS)) & 0xFFFF, []).append((value, key))
+
+    def near(self, value: int, max_distance: int) -> List[Tuple[int, object]]:
+        """(distance, key) of indexed hashes within max_distance bits, nearest first.
+        Exhaustive for max_distance < 4 (bands)."""
+        found = {}
+        for band, table in enumerate(self._bands):
+            for other, key in table.get((value >> (band * _BAND_BITS)) & 0xFFFF, ()):
+                distance = hamming_distance(value, other)
+                if distance <= max_distance:
+                    found[key] = (distance, key)
+        return sorted(found.values(), key=lambda item: item[0])
+
+
+class EmbeddedChunks:
+    """
+    Chunks kept and embedded by earlier deduplicate calls but not indexed
+    yet (an ingest writes many batches to the index at once). Later batches
+    are checked against them as against their own chunks.
+    """
+
+    def __init__(self):
+        self.chunks: List = []
+        self.vectors: List[List[float]] = []
+        self._simhashes = SimHashIndex()
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def add(self, chunks: List, vectors: List[List[float]]):
+        for chunk, vector in zip(chunks, vectors):
+            self._simhashes.add(chunk.metadata["simhash"], len(self.chunks))
+            self.chunks.append(chunk)
+            self.vectors.append(vector)
+
+    def near(self, value: int, max_distance: int) -> List[Tuple[int, int]]:
+        return self._simhashes.near(value, max_distance)
+
+
+def chunk_sources(doc) -> List[str]:
+    """All files a (possibly collapsed) chunk came from."""
+    return doc.metadata.get("sources") or [doc.metadata.get("source", "")]
+
+
+def _add_source(doc, source: str):
+    sources = chunk_sources(doc)
+    if source not in sources:
+        doc.metadata["sources"] = sources + [source]
+
+
+def _cosine(a, b) -> float:
+    a = np.asarray(a, dtype="float32")
+    b = np.asarray(b, dtype="float32")
+    denominator = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(a @ b) / denominator if denominator else 0.0
+
+
+def deduplicate(chunks: List, embed_documents: Callable[[List[str]], List[List[float]]], config: dict,
+                existing: Optional[SimHashIndex] = None,
+                existing_vector: Optional[Callable[[object], Optional[np.ndarray]]] = None,
+                embedded: Optional[EmbeddedChunks] = None
+                ) -> Tuple[List, List[List[float]], List[Tuple[object, str]]]:
+    """
+    Drop near-duplicate chunks (chunks need "simhash" metadata).
+
+    existing: SimHashIndex of already-indexed chunks (keys are passed back);
+    existing_vector(key) returns such a chunk's vector for the similarity check.
+    embedded: chunks of earlier batches not indexed yet; a duplicate of one
+    is dropped and its source added to that chunk.
+    Returns (kept chunks, their embeddings, [(existing key, new source)]).
+    Only kept and inexact candidate chunks are embedded.
+    """
+    max_distance = config.get("dedup_max_distance", 3)
+    min_similarity = config.get("dedup_min_similarity", 0.95)
+    batch = SimHashIndex()
+    kept, pending, aliases = [], [], []
+
+    for i, chunk in enumerate(chunks):
+        value = chunk.metadata["simhash"]
+        in_batch = batch.near(value, max_distance)
+        earlier = embedded.near(value, max_distance) if embedded is not None else []
+        indexed = existing.near(value, max_distance) if existing is not None else []
+        if in_batch and in_batch[0][0] == 0:
+            _add_source(chunks[in_batch[0][1]], chunk.metadata["source"])
+        elif earlier and earlier[0][0] == 0:
+            _add_source(embedded.chunks[earlier[0][1]], chunk.metadata["source"])
+        elif indexed and indexed[0][0] == 0:
+            aliases.append((indexed[0][1], chunk.metadata["source"]))
+        elif in_batch or earlier or indexed:
+            pending.append((i, in_batch, earlier, indexed))
+        else:
+            kept.append(i)
+            batch.add(value, i)
+
+    # Embed once: kept chunks, plus inexact candidates that need the similarity check
+    to_embed = kept + [i for i, _, _, _ in pending]
+    vectors = dict(zip(to_embed, embed_documents([chunks[i].page_content for i in to_embed]))) if to_embed else {}
+    for i, in_batch, earlier, indexed in pending:
+        source = chunks[i].metadata["source"]
+        match = next((j for _, j in in_batch if j in vectors and _cosine(vectors[i], vectors[j]) >= min_similarity), None)
+        if match is not None:
+            _add_source(chunks[match], source)
+            continue
+        match = next((j for _, j in earlier if _cosine(vectors[i], embedded.vectors[j]) >= min_similarity), None)
+        if match is not None:
+            _add_source(embedded.chunks[match], source)
+            continue
+        if existing_vector is not None:
+            match = next((key for _, key in indexed
+                          if (vector := existing_vector(key)) is not None and _cosine(vectors[i], vector) >= min_similarity),
+                         None)
+            if match is not None:
+                aliases.append((match, source))
+                continue
+        kept.append(i)
+
+    kept.sort()
+    dropped = len(chunks) - len(kept)
+    if dropped:
+        logger.info("Dropped %d near-duplicate chunk(s) of %d", dropped, len(chunks))
+    return [chunks[i] for i in kept], [vectors[i] for i in kept], aliases
+
+
+def append_aliases(store_path: str, records: Iterable[Tuple[int, str, str]]):
+    """Record extra sources of indexed chunks: (simhash, chunk's source, extra source)."""
+    os.makedirs(store_path, exist_ok=True)
+    with open(os.path.join(store_path, ALIASES_FILE), "a", encoding="utf-8") as f:
+        for value, source, alias in records:
+            f.write(json.dumps({"simhash": value, "source": source, "alias": alias}) + "\n")
+
+
+def load_aliases(store_path: str) -> Dict[Tuple[int, str], List[str]]:
+    """{(simhash, source): [extra sources]} of a store."""
+    aliases: Dict[Tuple[int, str], List[str]] = {}
+    try:
+        with open(os.path.join(store_path, ALIASES_FILE), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line of an interrupted write
+                aliases.setdefault((record["simhash"], record["source"]), []).append(record["alias"])
+    except OSError:
+        pass
+    return aliases
+
+
+def remove_aliases(store_path: str, sources: Iterable[str]) -> bool:
+    """Drop the alias records of (or to) removed source files. Returns True if any were dropped."""
+    sources = set(sources)
+    path = os.path.join(store_path, ALIASES_FILE)
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = f.readlines()
+    except OSError:
+        return False
+    kept = []
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record["source"] not in sources and record["alias"] not in sources:
+            kept.append(line)
+    if len(kept) == len(lines):
+        return False
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(kept)
+    os.replace(tmp_path, path)
+    return True
+
+
+def apply_aliases(docs: Iterable, aliases: Dict[Tuple[int, str], List[str]]):
+    """Add recorded extra sources to chunks' "sources" metadata."""
+    if not aliases:
+        return
+    for doc in docs:
+        extra = aliases.get((doc.metadata.get("simhash"), doc.metadata.get("source")))
+        for alias in extra or ():
+            _add_source(doc, alias)
@@ -0,0 +1,166 @@
+"""
+In-memory catalog of the upload directory for /api/files.
+
+Listing used to listdir + stat every file, work out its type and merge tags
+and indexed status on every request, and the UI asks often. The catalog
+keeps one entry per file (stat, type, tags, indexed) and the sorted orders
+it was asked for, so a request is a slice of a precomputed list. It is kept
+current incrementally:
+
+- the directory's mtime is checked on each request: files added or deleted
+  are stat'd or dropped, without touching the others
+- watcher events (see watcher.py) re-stat the files that changed
+- tags are reloaded when database.get_file_tags_version changes, indexed
+  status when the index generation's file list changes
+- everything is re-stat'd every "file_catalog_rescan_seconds", for edits
+  in a process without the watcher
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from database import get_all_file_tags, get_file_tags_version
+
+logger = logging.getLogger("RAG_Agent.file_catalog")
+
+FILE_TYPES = {
+    ".pdf": "pdf",
+    ".doc": "word", ".docx": "word",
+    ".xls": "excel", ".xlsx": "excel",
+    ".ppt": "powerpoint", ".pptx": "powerpoint",
+    ".txt": "text", ".md": "text",
+    ".csv": "csv",
+    ".jpg": "image", ".jpeg": "image", ".png": "image", ".gif": "image", ".bmp": "image",
+    ".tif": "image", ".tiff": "image",
+}
+
+SORT_KEYS = {
+    "modified": lambda entry: entry["modified_at"],
+    "name": lambda entry: entry["name"].casefold(),
+    "size": lambda entry: entry["size"],
+    "type": lambda entry: (entry["type"], entry["name"].casefold()),
+}
+
+
+def format_file_size(size_bytes: int) -> str:
+    """Format file size in human-readable format."""
+    if size_bytes < 1024:
+        return f"{size_bytes} B"
+    elif size_bytes < 1024 * 1024:
+        return f"{size_bytes / 1024:.1f} KB"
+    elif size_bytes < 1024 * 1024 * 1024:
+        return f"{size_bytes / (1024 * 1024):.1f} MB"
+    else:
+        return f"{size_bytes / (1024 * 1024 * 1024):.1f} GB"
+
+
+def _format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class FileCatalog:
+    """Uploaded files with stat, type, tags and indexed status, in memory and pre-sorted."""
+
+    def __init__(self, directory: str, rescan_seconds: float = 60):
+        self.directory = directory
+        self.rescan_seconds = rescan_seconds
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}  # Never mutated once stored: replaced
+        self._orders: Dict[Tuple[str, bool], List[str]] = {}
+        self._dir_mtime: Optional[int] = None
+        self._scanned_at = float("-inf")
+        self._tags: Dict[str, List[str]] = {}
+        self._tags_version = None
+        self._indexed: Optional[Sequence[str]] = None
+        self._indexed_set = frozenset()
+
+    def _entry(self, name: str) -> Optional[dict]:
+        """A file's entry from a fresh stat (None if it is gone or not a regular file)."""
+        path = os.path.join(self.directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path) or name.endswith(".part"):
+            return None
+        ext = os.path.splitext(name)[1].lower()
+        return {
+            "name": name,
+            "size": stat.st_size,
+            "size_formatted": format_file_size(stat.st_size),
+            "created": _format_time(stat.st_ctime),
+            "modified": _format_time(stat.st_mtime),
+            "modified_at": stat.st_mtime,
+            "extension": ext,
+            "type": FILE_TYPES.get(ext, "document"),
+            "tags": self._tags.get(name, []),
+            "indexed": name in self._indexed_set,
+        }
+
+    def _restat(self, names: Iterable[str]):
+        for name in names:
+            entry = self._entry(name)
+            if entry is None:
+                self._entries.pop(name, None)
+            else:
+                self._entries[name] = entry
+        self._orders.clear()
+
+    def _sync(self, indexed: Sequence[str]):
+        """Bring the entries up to date (caller holds the lock)."""
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            dir_mtime = None
+        now = time.monotonic()
+        tags_version = get_file_tags_version()
+        if tags_version != self._tags_version:
+            self._tags = get_all_file_tags()
+            self._tags_version = tags_version
+            self._entries = {name: {**entry, "tags": self._tags.get(name, [])}
+                             for name, entry in self._entries.items()}
+        if indexed is not self._indexed:
+            # A new list object means a new index generation (or still none)
+            self._indexed = indexed
+            if indexed or self._indexed_set:
+                self._indexed_set = frozenset(indexed)
+                self._entries = {name: {**entry, "indexed": name in self._indexed_set}
+                                 for name, entry in self._entries.items()}
+        if dir_mtime is None:
+            self._entries, self._orders = {}, {}
+        elif now - self._scanned_at >= self.rescan_seconds:
+            self._entries = {}
+            self._restat(os.listdir(self.directory))
+            self._scanned_at = now
+        elif dir_mtime != self._dir_mtime:
+            # Files were added, deleted or renamed: only those are stat'd
+            names = set(os.listdir(self.directory))
+            self._restat((names - self._entries.keys()) | (self._entries.keys() - names))
+        self._dir_mtime = dir_mtime
+
+    def refresh(self, names: Optional[Iterable[str]] = None):
+        """Re-stat files that changed (watcher events), or everything with names None."""
+        with self._lock:
+            if names is None:
+                self._scanned_at = float("-inf")
+            else:
+                self._restat(names)
+
+    def list(self, indexed: Sequence[str], sort: str = "modified", descending: bool = True,
+             offset: int = 0, limit: Optional[int] = None) -> Tuple[List[dict], int]:
+        """
+        One page of files in the given order, and the total number of files.
+        indexed: the indexed file names (backend.get_indexed_files()).
+        """
+        with self._lock:
+            self._sync(indexed)
+            order = self._orders.get((sort, descending))
+            if order is None:
+                entries = sorted(self._entries.values(), key=SORT_KEYS[sort], reverse=descending)
+                order = self._orders[(sort, descending)] = [entry["name"] for entry in entries]
+            names = order[offset:None if limit is None else offset + limit]
+            return [self._entries[name] for name in names], len(order)
@@ -0,0 +1,149 @@
+"""
+The document-term graph of a collection, for the knowledge graph view.
+
+get_knowledge_graph used to unpickle the BM25 index (every chunk, text
+included) on each call and score the terms of its first 50 chunks, one node
+per chunk; chunks in shards and delta segments were missed. Now each file's
+most frequent content terms ("graph_terms_per_file") are counted at ingest,
+from the chunks being indexed, and stored with the file's row in the sources
+table, so they come and go with the file in the same transaction (see
+database.update_sources).
+
+The graph is derived from those counts: a term's weight for a file is its
+count relative to the file's most frequent term, times log(1 + files / files
+having the term). The derived state is cached per collection and brought up
+to date on a new index generation by reading only the terms of added or
+re-ingested files. A request gets one page of files with their top terms;
+terms linking fewer than min_degree files of the page, and the least
+connected beyond max_nodes, are left out (level of detail).
+"""
+
+import heapq
+import logging
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+import database
+
+logger = logging.getLogger("RAG_Agent.knowledge_graph")
+
+# Words starting with a letter (no numbers, no leading underscores)
+_TOKEN = re.compile(r"[^\W\d_]\w+")
+
+STOPWORDS = frozenset("""
+    about above after again against all also among and any are because been before being below between both
+    but can could did does doing down during each few for from further had has have having her here hers
+    herself him himself his how however into its itself just may might more most must not now off once only
+    other our ours ourselves out over own same she should since some such than that the their theirs them
+    themselves then there these they this those through too under until upon very was were what when where
+    which while who whom why will with within without would yet you your yours yourself yourselves
+    page source file document http https www com txt pdf doc docx xls xlsx ppt pptx csv
+""".split())
+
+
+def is_content_term(term: str) -> bool:
+    """False for stopwords, numbers and words under 3 letters (of lowercased text)."""
+    return len(term) > 2 and term not in STOPWORDS and _TOKEN.fullmatch(term) is not None
+
+
+def document_terms(text: str) -> Counter:
+    """Content terms of a chunk (lowercased; see is_content_term)."""
+    if text.startswith("Source: "):
+        text = text.split("\n\n", 1)[-1]  # The file name prefix added at ingest
+    return Counter(token for token in _TOKEN.findall(text.lower())
+                   if len(token) > 2 and token not in STOPWORDS)
+
+
+def top_terms(counts: Counter, limit: int) -> Dict[str, int]:
+    return dict(counts.most_common(limit))
+
+
+class _CollectionGraph:
+    """Term counts and document frequencies of one collection's files, as of an index generation."""
+
+    def __init__(self):
+        self.disk_generation = None
+        self.versions: Dict[str, tuple] = {}  # source -> (ingested_at, chunks)
+        self.terms: Dict[str, Dict[str, int]] = {}
+        self.document_frequency = Counter()
+        self.lock = threading.Lock()
+
+    def update(self, collection: str, generation):
+        versions = {source["source"]: (source["ingested_at"], source["chunks"]) for source in generation.get_sources()}
+        for source in [source for source in self.terms if versions.get(source) != self.versions.get(source)]:
+            self.document_frequency.subtract(self.terms.pop(source).keys())
+        changed = [source for source, version in versions.items() if self.versions.get(source) != version]
+        if changed:
+            for source, terms in database.get_source_terms(collection, changed).items():
+                self.terms[source] = terms
+                self.document_frequency.update(terms.keys())
+        self.document_frequency = +self.document_frequency  # Drops terms no file has any more
+        logger.debug("Knowledge graph of %s: %d file(s) re-read, %d in total", collection, len(changed), len(versions))
+        self.versions = versions
+        self.disk_generation = generation.disk_generation
+
+    def page(self, sources: List[dict], offset: int, limit: int, terms_per_doc: int,
+             min_degree: int, max_nodes: int) -> dict:
+        n_files = len(sources)
+        nodes = []
+        term_links: Dict[str, list] = {}
+        for source in sources[offset:offset + limit]:
+            name = source["source"]
+            doc_id = f"doc_{name}"
+            nodes.append({"id": doc_id, "label": name, "type": "document", "group": 1, "radius": 12,
+                          "chunks": source["chunks"]})
+            terms = self.terms.get(name)
+            if not terms:
+                continue
+            most_frequent = max(terms.values())
+            weighted = []
+            for term, count in terms.items():
+                files_with_term = self.document_frequency[term] or 1
+                if n_files > 2 and files_with_term >= n_files:
+                    continue  # In every file: says nothing about this one
+                weighted.append((count / most_frequent * math.log(1 + n_files / files_with_term), term))
+            for weight, term in heapq.nlargest(terms_per_doc, weighted):
+                term_links.setdefault(term, []).append((doc_id, weight))
+
+        # Terms shared by the most files of the page first, then the strongest
+        terms = sorted((term for term, links in term_links.items() if len(links) >= min_degree),
+                       key=lambda term: (-len(term_links[term]), -max(weight for _, weight in term_links[term]), term))
+        links = []
+        for term in terms[:max(0, max_nodes - len(nodes))]:
+            term_id = f"term_{term}"
+            nodes.append({"id": term_id, "label": term, "type": "term", "group": 2, "radius": 6,
+                          "degree": len(term_links[term]), "documents": self.document_frequency[term]})
+            links.extend({"source": doc_id, "target": term_id, "value": round(weight, 4)}
+                         for doc_id, weight in term_links[term])
+        return {"nodes": nodes, "links": links, "total_documents": n_files, "offset": offset, "limit": limit}
+
+
+_graphs: Dict[str, _CollectionGraph] = {}
+_graphs_lock = threading.Lock()
+
+
+def get_graph(collection: str, generation, offset: int = 0, limit: int = 50, terms_per_doc: int = 5,
+              min_degree: int = 1, max_nodes: int = 200) -> dict:
+    """
+    One page of a collection's graph: limit files from offset (in source
+    order), their top terms_per_doc terms, and the links between them.
+    generation: the collection's current backend.IndexGeneration.
+    """
+    with _graphs_lock:
+        graph = _graphs.setdefault(collection, _CollectionGraph())
+    with graph.lock:
+        if graph.disk_generation != generation.disk_generation:
+            graph.update(collection, generation)
+        return graph.page(generation.get_sources(), offset, limit, terms_per_doc, min_degree, max_nodes)
+
+
+def forget(collection: Optional[str] = None):
+    """Drop the cached graph of a collection (or all), e.g. when it is deleted."""
+    with _graphs_lock:
+        if collection is None:
+            _graphs.clear()
+        else:
+            _graphs.pop(collection, None)
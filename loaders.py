@@ -0,0 +1,71 @@
+"""
+Streaming document loading.
+
+loader.load() builds every page, row or element of a file before returning,
+so a large PDF or CSV is held in memory whole, then again as chunks. The
+LangChain loaders also implement lazy_load(), yielding one page (PDF), row
+(CSV) or element (Excel, PowerPoint) at a time: ingest chunks and embeds the
+stream in batches, and previews read only as much as they show.
+
+Plain text files are streamed with TextStreamLoader, in blocks cut at
+paragraph boundaries, instead of TextLoader's single document per file.
+"""
+
+import logging
+from typing import Iterable, Iterator, Optional, Tuple
+
+from langchain_core.document_loaders import BaseLoader
+from langchain_core.documents import Document
+
+logger = logging.getLogger("RAG_Agent.loaders")
+
+TEXT_BLOCK_CHARS = 1_000_000
+
+
+class TextStreamLoader(BaseLoader):
+    """A text file as documents of about block_chars characters, cut at blank lines (or line ends)."""
+
+    def __init__(self, file_path: str, encoding: str = "utf-8", block_chars: int = TEXT_BLOCK_CHARS):
+        self.file_path = file_path
+        self.encoding = encoding
+        self.block_chars = block_chars
+
+    def lazy_load(self) -> Iterator[Document]:
+        try:
+            with open(self.file_path, encoding=self.encoding) as f:
+                buffer = ""
+                while data := f.read(self.block_chars):
+                    buffer += data
+                    cut = buffer.rfind("\n\n")
+                    if cut <= 0:
+                        cut = buffer.rfind("\n")
+                    if cut <= 0:
+                        if len(buffer) < 4 * self.block_chars:
+                            continue  # No line break yet: keep reading (bounded)
+                        cut = len(buffer)
+                    yield Document(page_content=buffer[:cut], metadata={"source": self.file_path})
+                    buffer = buffer[cut:].lstrip("\n")
+                if buffer.strip():
+                    yield Document(page_content=buffer, metadata={"source": self.file_path})
+        except UnicodeDecodeError as e:
+            raise RuntimeError(f"Error loading {self.file_path}") from e
+
+
+def read_text(docs: Iterable[Document], max_chars: Optional[int] = None) -> Tuple[str, bool]:
+    """
+    Join documents' text (blank line between them), pulling documents from
+    docs only until max_chars characters are read.
+    Returns (text, truncated).
+    """
+    parts, length = [], 0
+    for doc in docs:
+        if not doc.page_content.strip():
+            continue
+        if max_chars is not None and length >= max_chars:
+            return "\n\n".join(parts)[:max_chars], True
+        parts.append(doc.page_content)
+        length += len(doc.page_content) + 2
+    text = "\n\n".join(parts)
+    if max_chars is not None and len(text) > max_chars:
+        return text[:max_chars], True
+    return text, False
@@ -1,13 +1,37 @@
-
+import atexit
+import itertools
 import logging
 import os
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+from collections import defaultdict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Background listener that owns the real (blocking) handlers
+_listener = None
+
+# Verbose payload sampling (prompts, model outputs)
+PAYLOAD_SAMPLE_EVERY = 20  # Log the full payload on 1 in N calls per label
+PAYLOAD_MAX_CHARS = 2000   # Truncate sampled payloads beyond this
+_payload_counters = defaultdict(itertools.count)
 
-def setup_logging(log_dir="logs", log_file="app.log", level=logging.INFO):
+
+def setup_logging(log_dir="logs", log_file="app.log", level=logging.INFO, module_levels=None,
+                  payload_sample_every=None, payload_max_chars=None):
     """
     Setup structured logging with console and file handlers.
+
+    Request threads only enqueue records; a QueueListener thread does the
+    console/file I/O so slow terminals never add to request latency.
+
+    Args:
+        module_levels: Optional {logger_name: level} overrides, e.g.
+            {"RAG_Agent.backend": "DEBUG", "werkzeug": "WARNING"}
+        payload_sample_every: Override for PAYLOAD_SAMPLE_EVERY
+        payload_max_chars: Override for PAYLOAD_MAX_CHARS
     """
+    global _listener, PAYLOAD_SAMPLE_EVERY, PAYLOAD_MAX_CHARS
+
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
@@ -24,21 +48,74 @@ def setup_logging(log_dir="logs", log_file="app.log", level=logging.INFO):
         log_path, maxBytes=10*1024*1024, backupCount=5, encoding='utf-8' # 10MB
     )
     file_handler.setFormatter(formatter)
-    file_handler.setLevel(level)
 
     # 2. Console Handler
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
-    console_handler.setLevel(level)
 
-    # Root Logger Configuration
-    logging.basicConfig(
-        level=level,
-        handlers=[file_handler, console_handler]
-    )
-    
+    # 3. Non-blocking sink: callers enqueue, the listener thread writes
+    if _listener is not None:
+        _listener.stop()
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+
+    # Root Logger Configuration (replace anything installed by basicConfig on import).
+    # Handlers stay at NOTSET: the level is applied by loggers only, so a
+    # per-module override below it (see module_levels) is not dropped.
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+
     # Silence noisy libraries
     logging.getLogger("werkzeug").setLevel(logging.WARNING)
     logging.getLogger("httpx").setLevel(logging.WARNING)
 
+    # Per-module overrides (from config "log_levels")
+    for name, module_level in (module_levels or {}).items():
+        try:
+            logging.getLogger(name).setLevel(str(module_level).upper())
+        except (ValueError, TypeError):
+            logging.getLogger("RAG_Agent").warning("Invalid log level %r for %s", module_level, name)
+
+    if payload_sample_every:
+        PAYLOAD_SAMPLE_EVERY = max(1, int(payload_sample_every))
+    if payload_max_chars is not None:
+        PAYLOAD_MAX_CHARS = max(0, int(payload_max_chars))
+
     return logging.getLogger("RAG_Agent")
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+def log_payload(logger, label, payload, level=logging.DEBUG):
+    """
+    Log a large payload (system prompt, vision output) without paying for it on every request.
+
+    Nothing is formatted when the level is disabled. Otherwise only 1 in
+    PAYLOAD_SAMPLE_EVERY calls per label logs the (truncated) payload; the
+    rest log its size.
+    """
+    if not logger.isEnabledFor(level):
+        return
+
+    text = str(payload)
+    size = len(text)
+    if next(_payload_counters[label]) % PAYLOAD_SAMPLE_EVERY:
+        logger.log(level, "%s: %d chars (payload sampled out)", label, size)
+        return
+
+    if size > PAYLOAD_MAX_CHARS:
+        text = f"{text[:PAYLOAD_MAX_CHARS]}\n... [{size - PAYLOAD_MAX_CHARS} more chars]"
+    logger.log(level, "%s (%d chars):\n%s", label, size, text)
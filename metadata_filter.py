@@ -0,0 +1,133 @@
+"""
+Metadata filters for retrieval (tags, source, file type, ingest date).
+
+Filters are resolved to the chunk ids that may match *before* scoring, so a
+filtered query only scores those chunks instead of over-fetching and
+discarding. Each store keeps a MetadataIndex (source -> chunk ids, plus
+per-chunk ingest time); tags are resolved to sources through the documents
+table.
+
+Filter format (all keys optional, combined with AND):
+    {
+        "tags": ["finance", "2024"],        # files having ANY of these tags
+        "sources": ["report.pdf"],          # exact file names
+        "file_types": ["pdf", ".docx"],     # extensions
+        "ingested_after": "2026-01-01",     # ISO date/time or epoch seconds
+        "ingested_before": 1767225600
+    }
+"""
+
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+import database
+
+logger = logging.getLogger("RAG_Agent.metadata_filter")
+
+FILTER_KEYS = ("tags", "sources", "file_types", "ingested_after", "ingested_before")
+
+
+def _as_list(value) -> List[str]:
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, (list, tuple)) and all(isinstance(v, str) for v in value):
+        return list(value)
+    raise ValueError(f"Expected a string or list of strings, got {value!r}")
+
+
+def _as_timestamp(value) -> float:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f"Expected an ISO date or epoch seconds, got {value!r}")
+
+
+def normalize_filter(raw) -> Optional[dict]:
+    """
+    Validate a request's filter argument. Returns None for no filter.
+    Raises ValueError for unknown keys or malformed values.
+    """
+    if not raw:
+        return None
+    if not isinstance(raw, dict):
+        raise ValueError("filter must be an object")
+    unknown = set(raw) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown filter keys: {', '.join(sorted(unknown))}")
+
+    normalized = {}
+    if raw.get("tags"):
+        normalized["tags"] = _as_list(raw["tags"])
+    if raw.get("sources"):
+        normalized["sources"] = [os.path.basename(s) for s in _as_list(raw["sources"])]
+    if raw.get("file_types"):
+        normalized["file_types"] = [
+            t.lower() if t.startswith(".") else f".{t.lower()}" for t in _as_list(raw["file_types"])
+        ]
+    for key in ("ingested_after", "ingested_before"):
+        if raw.get(key) is not None:
+            normalized[key] = _as_timestamp(raw[key])
+    return normalized or None
+
+
+def resolve_tag_sources(metadata_filter: dict) -> Optional[Set[str]]:
+    """Files carrying any of the filter's tags (None if the filter has no tags)."""
+    if "tags" not in metadata_filter:
+        return None
+    return set(database.get_files_with_tags(metadata_filter["tags"]))
+
+
+class MetadataIndex:
+    """
+    Column-oriented metadata of a store's chunks, by chunk position
+    (FAISS vector id or BM25 document index).
+    """
+
+    def __init__(self, documents: Iterable):
+        positions: Dict[str, List[int]] = {}
+        ingested_at = []
+        for i, doc in enumerate(documents):
+            metadata = getattr(doc, "metadata", None) or {}
+            # Collapsed near-duplicates belong to every file they came from
+            for source in metadata.get("sources") or [metadata.get("source", "")]:
+                positions.setdefault(source, []).append(i)
+            # Chunks indexed before ingest times were recorded never match a date filter
+            ingested_at.append(metadata.get("ingested_at", np.nan))
+        self.source_ids = {source: np.array(ids, dtype="int64") for source, ids in positions.items()}
+        self.ingested_at = np.array(ingested_at, dtype="float64")
+
+    def __len__(self):
+        return len(self.ingested_at)
+
+    def matching_ids(self, metadata_filter: dict, tag_sources: Optional[Set[str]] = None) -> np.ndarray:
+        """Sorted chunk positions passing the filter."""
+        sources = set(self.source_ids)
+        if "sources" in metadata_filter:
+            sources &= set(metadata_filter["sources"])
+        if "file_types" in metadata_filter:
+            file_types = tuple(metadata_filter["file_types"])
+            sources = {s for s in sources if s.lower().endswith(file_types)}
+        if tag_sources is not None:
+            sources &= tag_sources
+
+        if not sources:
+            return np.empty(0, dtype="int64")
+        ids = np.unique(np.concatenate([self.source_ids[s] for s in sources]))
+
+        if "ingested_after" in metadata_filter or "ingested_before" in metadata_filter:
+            times = self.ingested_at[ids]
+            keep = np.ones(len(ids), dtype=bool)
+            if "ingested_after" in metadata_filter:
+                keep &= times >= metadata_filter["ingested_after"]
+            if "ingested_before" in metadata_filter:
+                keep &= times < metadata_filter["ingested_before"]
+            ids = ids[keep]
+        return ids
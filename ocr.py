@@ -0,0 +1,148 @@
+"""
+OCR for scanned PDFs and images (pytesseract + the tesseract binary).
+
+PyPDFLoader returns (nearly) empty pages for scanned PDFs, so those files
+indexed nothing. OCRPDFLoader wraps it: pages with fewer than
+"ocr_min_chars" extracted characters get their embedded page images (a
+scanned page is stored as one image) OCR'd, and the text joins the page
+before chunking. Image files are OCR'd the same way (see vision.ImageLoader).
+
+Pages are OCR'd a window at a time on a process pool ("ocr_workers"), so a
+large scanned archive uses every core while memory stays bounded by the
+window. Results are cached on disk by the SHA-256 of the page image and the
+OCR languages ("ocr_cache_dir"), so re-ingesting or re-parsing a file never
+OCRs a page twice.
+"""
+
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterator, List, Optional
+
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.document_loaders import BaseLoader
+from langchain_core.documents import Document
+
+logger = logging.getLogger("RAG_Agent.ocr")
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def ocr_available() -> bool:
+    """True if pytesseract and the tesseract binary are installed."""
+    try:
+        import pytesseract
+        pytesseract.get_tesseract_version()
+        return True
+    except Exception as e:
+        logger.warning("OCR unavailable (%s); scanned pages won't be indexed, images only by their description", e)
+        return False
+
+
+def _ocr_image(data: bytes, languages: str) -> str:
+    """OCR one encoded image (runs in a pool process)."""
+    import pytesseract
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        return pytesseract.image_to_string(image.convert("L"), lang=languages).strip()
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: worker processes don't inherit the server's threads and locks
+            _pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _cache_path(config: dict, data: bytes) -> str:
+    languages = config.get("ocr_languages", "eng")
+    digest = hashlib.sha256(data + languages.encode("utf-8")).hexdigest()
+    return os.path.join(config.get("ocr_cache_dir", "ocr_cache"), digest[:2], f"{digest}.txt")
+
+
+def ocr_images(images: List[bytes], config: dict) -> List[str]:
+    """Text of encoded images, from the cache or OCR'd in parallel on the process pool."""
+    texts: List[Optional[str]] = []
+    for data in images:
+        try:
+            with open(_cache_path(config, data), encoding="utf-8") as f:
+                texts.append(f.read())
+        except OSError:
+            texts.append(None)
+    missing = [i for i, text in enumerate(texts) if text is None]
+    if missing:
+        pool = _get_pool(config.get("ocr_workers", 0))
+        languages = config.get("ocr_languages", "eng")
+        futures = {i: pool.submit(_ocr_image, images[i], languages) for i in missing}
+        for i, future in futures.items():
+            try:
+                texts[i] = future.result()
+            except Exception as e:
+                logger.warning("OCR failed for an image: %s", e)
+                texts[i] = ""
+                continue
+            path = _cache_path(config, images[i])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(texts[i])
+            os.replace(tmp_path, path)
+    return texts
+
+
+def _page_images(reader, page_number: int) -> List[bytes]:
+    try:
+        return [image.data for image in reader.pages[page_number].images]
+    except Exception as e:  # Unsupported image encodings
+        logger.debug("Could not extract images of page %d: %s", page_number, e)
+        return []
+
+
+class OCRPDFLoader(BaseLoader):
+    """PyPDFLoader pages, with text-less (scanned) pages OCR'd from their images."""
+
+    def __init__(self, file_path: str, config: dict):
+        self.file_path = file_path
+        self.config = config
+        # Part of the parsed-text cache key: OCR'd and plain parses differ
+        self.mode = f"ocr-{config.get('ocr_languages', 'eng')}"
+
+    def lazy_load(self) -> Iterator[Document]:
+        workers = self.config.get("ocr_workers", 0) or os.cpu_count() or 1
+        window: List[Document] = []
+        reader = None
+        for page in PyPDFLoader(self.file_path).lazy_load():
+            window.append(page)
+            if len(window) >= 2 * workers:
+                reader = yield from self._flush(window, reader)
+        if window:
+            yield from self._flush(window, reader)
+
+    def _flush(self, window: List[Document], reader):
+        """Yield a window of pages, OCR-ing its text-less ones together. Returns the pypdf reader."""
+        min_chars = self.config.get("ocr_min_chars", 20)
+        scanned = [page for page in window if len(page.page_content.strip()) < min_chars]
+        if scanned:
+            if reader is None:
+                from pypdf import PdfReader
+                reader = PdfReader(self.file_path)
+            images = [_page_images(reader, page.metadata.get("page", 0)) for page in scanned]
+            texts = iter(ocr_images([data for page_images in images for data in page_images], self.config))
+            for page, page_images in zip(scanned, images):
+                ocr_text = "\n\n".join(filter(None, (next(texts) for _ in page_images)))
+                if ocr_text:
+                    page.page_content = "\n\n".join(filter(None, (page.page_content.strip(), ocr_text)))
+                    page.metadata["ocr"] = True
+        yield from window
+        window.clear()
+        return reader
@@ -0,0 +1,242 @@
+"""
+Content-addressed cache of parsed (extracted) document text.
+
+Previews, temp chat analysis and ingest all parse the same uploads, and
+parsing a large PDF or spreadsheet takes seconds. The first full parse of a
+file stores its documents (pages, rows, elements) on disk, keyed by the
+SHA-256 of the file's bytes and the loader version, so any later consumer
+reads them back without parsing:
+
+    <key>.txt     the documents' text, concatenated (UTF-8)
+    <key>.jsonl   one line per document: byte offset, length, metadata
+
+so page N or the first few thousand characters are a seek away. Both files
+are written under temporary names and renamed into place once the parse is
+complete; the index file appearing marks the entry as usable.
+
+A consumer that stops early (a preview reading one page) leaves no entry
+behind; the full parse then continues in a background thread, so the next
+request for the file is served from the cache. Entries beyond
+"parsed_cache_max_mb" are evicted least recently used first.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from importlib.metadata import PackageNotFoundError, version
+from itertools import islice
+from typing import Dict, Iterator, Optional, Tuple
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger("RAG_Agent.parsed_cache")
+
+# Bump when what is stored per document changes
+CACHE_FORMAT = 1
+INDEX_SUFFIX = ".jsonl"
+TEXT_SUFFIX = ".txt"
+
+_digests: Dict[Tuple[str, int, int], str] = {}
+_digests_lock = threading.Lock()
+_MAX_DIGESTS = 4096
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's contents, remembered while its size and mtime are unchanged."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _digests_lock:
+        if memo_key in _digests:
+            return _digests[memo_key]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    with _digests_lock:
+        if len(_digests) >= _MAX_DIGESTS:
+            _digests.clear()
+        _digests[memo_key] = digest.hexdigest()
+    return _digests[memo_key]
+
+
+def remember_digest(path: str, digest: str):
+    """Record a file's SHA-256 computed elsewhere (verifying an upload), so it isn't hashed again."""
+    stat = os.stat(path)
+    with _digests_lock:
+        if len(_digests) >= _MAX_DIGESTS:
+            _digests.clear()
+        _digests[(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)] = digest
+
+
+def loader_version(loader) -> str:
+    """Identifies how a loader parses: its type, mode and the loader package version."""
+    try:
+        package = version("langchain-community")
+    except PackageNotFoundError:
+        package = "unknown"
+    return f"{type(loader).__name__}/{getattr(loader, 'mode', '')}/{package}/{CACHE_FORMAT}"
+
+
+class ParsedTextCache:
+    """Parsed documents of files on disk, keyed by content hash and loader version."""
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._filling = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="parsed-cache")
+
+    def key(self, file_path: str, loader) -> str:
+        loader_hash = hashlib.sha256(loader_version(loader).encode("utf-8")).hexdigest()[:12]
+        return f"{file_digest(file_path)}-{loader_hash}"
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.cache_dir, key)
+        return base + INDEX_SUFFIX, base + TEXT_SUFFIX
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self._paths(key)[0])
+
+    def lazy_load(self, file_path: str, loader, start: int = 0) -> Iterator[Document]:
+        """
+        A file's documents from index start on: from the cache if the file
+        was parsed before, otherwise from loader.lazy_load(), caching them.
+        """
+        if os.path.getsize(file_path) > self.max_bytes:
+            # Would evict everything else, itself included
+            yield from islice(loader.lazy_load(), start, None)
+            return
+        key = self.key(file_path, loader)
+        if self.contains(key):
+            read = 0
+            try:
+                for doc in self._read(key, file_path, start):
+                    read += 1
+                    yield doc
+                return
+            except (OSError, ValueError) as e:
+                if read:
+                    raise
+                # Evicted between the check and the read: parse again
+                logger.warning("Parsed text cache entry %s unreadable (%s); re-parsing", key, e)
+        parsed = self._parse(key, file_path, loader)
+        try:
+            for i, doc in enumerate(parsed):
+                if i >= start:
+                    yield doc
+        finally:
+            parsed.close()  # Stopped early: lets the parse continue in the background
+
+    def document(self, file_path: str, loader, number: int) -> Optional[Document]:
+        """Document number (page / row / element, from 0) of a file, or None past the end."""
+        return next(self.lazy_load(file_path, loader, start=number), None)
+
+    def _read(self, key: str, file_path: str, start: int = 0) -> Iterator[Document]:
+        index_path, text_path = self._paths(key)
+        with open(index_path, encoding="utf-8") as index, open(text_path, "rb") as text:
+            os.utime(index_path)  # Recently used: evicted last
+            for i, line in enumerate(index):
+                if i < start:
+                    continue
+                entry = json.loads(line)
+                text.seek(entry["offset"])
+                content = text.read(entry["length"]).decode("utf-8")
+                # Same content may have been uploaded under another name
+                yield Document(page_content=content, metadata={**entry["metadata"], "source": file_path})
+
+    def _parse(self, key: str, file_path: str, loader, fill_if_stopped: bool = True) -> Iterator[Document]:
+        index_path, text_path = self._paths(key)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        complete = False
+        os.makedirs(self.cache_dir, exist_ok=True)
+        try:
+            with open(index_path + suffix, "w", encoding="utf-8") as index, open(text_path + suffix, "wb") as text:
+                offset = 0
+                for doc in loader.lazy_load():
+                    data = doc.page_content.encode("utf-8")
+                    text.write(data)
+                    # Written before the consumer sees (and possibly tags) the metadata
+                    metadata = {k: v for k, v in doc.metadata.items() if k != "source"}
+                    index.write(json.dumps({"offset": offset, "length": len(data), "metadata": metadata},
+                                           default=str) + "\n")
+                    offset += len(data)
+                    yield doc
+            os.replace(text_path + suffix, text_path)
+            os.replace(index_path + suffix, index_path)
+            complete = True
+            self._evict()
+        except GeneratorExit:
+            if fill_if_stopped:
+                self._schedule_fill(key, file_path, loader)
+            raise
+        finally:
+            if not complete:
+                for path in (index_path + suffix, text_path + suffix):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def _schedule_fill(self, key: str, file_path: str, loader):
+        """Finish parsing a file in the background, after a consumer stopped reading early."""
+        with self._lock:
+            if key in self._filling:
+                return
+            self._filling.add(key)
+
+        def fill():
+            try:
+                if not self.contains(key) and self.key(file_path, loader) == key:
+                    for _ in self._parse(key, file_path, loader, fill_if_stopped=False):
+                        pass
+            except Exception as e:
+                logger.warning("Background parse of %s failed: %s", os.path.basename(file_path), e)
+            finally:
+                with self._lock:
+                    self._filling.discard(key)
+
+        self._executor.submit(fill)
+
+    def _evict(self):
+        """Delete least recently used entries while the cache is over max_bytes."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(INDEX_SUFFIX):
+                continue
+            index_path, text_path = self._paths(name[:-len(INDEX_SUFFIX)])
+            try:
+                size = os.path.getsize(index_path) + os.path.getsize(text_path)
+                entries.append((os.path.getmtime(index_path), size, index_path, text_path))
+            except OSError:
+                continue
+            total += size
+        for _, size, index_path, text_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (index_path, text_path):  # Index first: the entry stops being visible
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+
+_caches: Dict[Tuple[str, int], ParsedTextCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_parsed_cache(config: dict) -> Optional[ParsedTextCache]:
+    """The parsed-text cache for the configured directory and size (None if disabled)."""
+    max_mb = config.get("parsed_cache_max_mb", 2048)
+    if max_mb <= 0:
+        return None
+    cache_key = (os.path.abspath(config.get("parsed_cache_dir", "parsed_cache")), max_mb)
+    with _caches_lock:
+        if cache_key not in _caches:
+            _caches[cache_key] = ParsedTextCache(cache_key[0], max_mb * 1024 * 1024)
+        return _caches[cache_key]
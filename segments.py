@@ -0,0 +1,88 @@
+"""
+Append-only delta segments for FAISS stores.
+
+The first ingest into a store (the whole index, or one shard) writes its
+main index (index.faiss / index.pkl / BM25 pickle). Later ingests write only
+their new chunks, as a small flat FAISS store in a delta_NNNNNN directory
+next to it, so a small upload into a large corpus writes O(new chunks)
+bytes instead of rewriting the index and the pickled docstore.
+
+Queries search the main index and its deltas together (see
+sharding.ShardedVectorStore); BM25 is refit in memory over the main and
+delta documents, so keyword scores use corpus-wide statistics.
+
+Once a store has "delta_compaction_segments" deltas, or its deltas hold
+"delta_compaction_ratio" of the main index's vectors, a background job
+merges them into the main index. ANN promotion and compression apply to
+delta vectors at that point.
+"""
+
+import logging
+import os
+import re
+import shutil
+from typing import List, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger("RAG_Agent.segments")
+
+DELTA_PREFIX = "delta_"
+_DELTA_PATTERN = re.compile(rf"^{DELTA_PREFIX}(\d+)$")
+
+
+def list_delta_paths(store_path: str) -> List[str]:
+    """Delta segment directories of a store, oldest first."""
+    try:
+        names = os.listdir(store_path)
+    except OSError:
+        return []
+    deltas = sorted((int(m.group(1)), name) for name in names if (m := _DELTA_PATTERN.match(name)))
+    return [os.path.join(store_path, name) for _, name in deltas]
+
+
+def write_delta(db, store_path: str) -> str:
+    """
+    Save a FAISS store holding only new chunks as the store's next delta.
+    Written to a temp directory and renamed, so readers never see a partial segment.
+    """
+    existing = list_delta_paths(store_path)
+    seq = int(_DELTA_PATTERN.match(os.path.basename(existing[-1])).group(1)) + 1 if existing else 1
+    path = os.path.join(store_path, f"{DELTA_PREFIX}{seq:06d}")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    db.save_local(tmp_path)
+    os.rename(tmp_path, path)
+    return path
+
+
+def delta_documents(db) -> List[Document]:
+    """A delta's chunks in vector id order."""
+    return [db.docstore.search(db.index_to_docstore_id[i]) for i in range(db.index.ntotal)]
+
+
+def delta_contents(db) -> Tuple[list, List[dict]]:
+    """A delta's (text, vector) pairs and metadatas, as ingest passes them to the main index."""
+    vectors = db.index.reconstruct_n(0, db.index.ntotal)
+    docs = delta_documents(db)
+    return [(doc.page_content, vector) for doc, vector in zip(docs, vectors)], [doc.metadata for doc in docs]
+
+
+def needs_compaction(main_vectors: int, delta_vectors: Sequence[int], config: dict) -> bool:
+    """True if a store's deltas should be merged into its main index."""
+    if not delta_vectors:
+        return False
+    max_segments = config.get("delta_compaction_segments", 8)
+    return (max_segments < 1 or len(delta_vectors) >= max_segments
+            or sum(delta_vectors) >= config.get("delta_compaction_ratio", 0.1) * main_vectors)
+
+
+def remove_deltas(paths: Sequence[str]):
+    """Delete compacted deltas (renamed first, so a listing never shows a half-deleted one)."""
+    for path in paths:
+        trash = f"{path}.{os.getpid()}.compacted"
+        try:
+            os.rename(path, trash)
+        except OSError as e:
+            logger.warning("Could not remove delta segment %s: %s", path, e)
+            continue
+        shutil.rmtree(trash, ignore_errors=True)
@@ -0,0 +1,103 @@
+"""
+Production server launcher for the Onyx web app.
+
+`python app.py` runs Flask's development server (reloader + debugger, one
+process). This launcher serves the same app with several workers so concurrent
+chat users don't serialize on a single process:
+
+- gunicorn (Linux/macOS): N worker processes x M threads each
+- waitress (Windows, or when gunicorn is missing): one process, M threads
+
+State that must be visible to every worker (background tasks, browser context,
+pending tool approvals) lives in SQLite (see database.SharedStateDict). Each
+worker memory-maps the FAISS index read-only (config "mmap_index"), so the
+vectors are shared through the OS page cache instead of copied per worker, and
+reloads when another worker bumps the index generation after an ingest.
+
+Usage:
+    python serve.py [--host 127.0.0.1] [--port 8501] [--workers 2] [--threads 8]
+"""
+
+import argparse
+import logging
+import sys
+
+from config_manager import load_config
+
+logger = logging.getLogger("RAG_Agent.serve")
+
+
+def parse_args(config):
+    """Parse CLI options, defaulting to the server_* config values."""
+    parser = argparse.ArgumentParser(description="Run the Onyx web app with a production WSGI server.")
+    parser.add_argument("--host", default=config.get("server_host", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=config.get("server_port", 8501))
+    parser.add_argument("--workers", type=int, default=config.get("server_workers", 2),
+                        help="Worker processes (gunicorn only)")
+    parser.add_argument("--threads", type=int, default=config.get("server_threads", 8),
+                        help="Request threads per worker")
+    parser.add_argument("--server", choices=["auto", "gunicorn", "waitress"], default="auto")
+    return parser.parse_args()
+
+
+def run_gunicorn(host, port, workers, threads):
+    """Serve app:app with gunicorn's threaded workers."""
+    from gunicorn.app.base import BaseApplication
+
+    class OnyxApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+            # Chat responses are streamed and can take a while on CPU-only models
+            self.cfg.set("timeout", 300)
+            # No preload: every worker imports app itself so its logging
+            # listener thread and SQLite connections are created post-fork
+            self.cfg.set("preload_app", False)
+
+        def load(self):
+            from app import app
+            return app
+
+    OnyxApplication().run()
+
+
+def run_waitress(host, port, threads):
+    """Serve the app with waitress (pure Python, works on Windows)."""
+    from waitress import serve
+    from app import app
+    serve(app, host=host, port=port, threads=threads)
+
+
+def main():
+    config = load_config()
+    args = parse_args(config)
+
+    server = args.server
+    if server == "auto":
+        server = "waitress" if sys.platform == "win32" else "gunicorn"
+        if server == "gunicorn":
+            try:
+                import gunicorn  # noqa: F401
+            except ImportError:
+                server = "waitress"
+
+    # Create the schema once before workers start
+    from database import init_db
+    init_db()
+
+    logging.basicConfig(level=logging.INFO)
+    if server == "gunicorn":
+        logger.info("Starting gunicorn on %s:%s (%d workers x %d threads)",
+                    args.host, args.port, args.workers, args.threads)
+        run_gunicorn(args.host, args.port, args.workers, args.threads)
+    else:
+        if args.workers > 1:
+            logger.info("waitress runs a single process; using %d threads", args.threads)
+        logger.info("Starting waitress on %s:%s (%d threads)", args.host, args.port, args.threads)
+        run_waitress(args.host, args.port, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Sharded FAISS/BM25 indexes searched in parallel.
+
+With config "index_shards" > 1, a collection's chunks are partitioned by a
+stable hash of their source file into shard_000 ... shard_NNN directories
+under db_path, each holding its own index.faiss / index.pkl / BM25 pickle.
+An ingest rewrites only the shards its files hash to.
+
+ShardedVectorStore and ShardedBM25 expose the parts of LangChain's FAISS
+store and of BM25Index that retrieval uses, so HybridRetriever works on
+either. A query is embedded once, every shard is searched on a thread pool
+(FAISS and numpy release the GIL), and the per-shard top-k lists are merged
+with a heap.
+"""
+
+import heapq
+import json
+import logging
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from vector_index import search_with_ids
+
+logger = logging.getLogger("RAG_Agent.sharding")
+
+SHARDS_FILE = "shards.json"
+
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+
+def get_search_pool(max_workers: int = 8) -> ThreadPoolExecutor:
+    """Thread pool shared by all shard searches (created on first use)."""
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is None:
+            _search_pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="shard-search")
+        return _search_pool
+
+
+def shard_for_source(source: str, n_shards: int) -> int:
+    """Stable shard number of a source file (crc32: same in every process, unlike hash())."""
+    return zlib.crc32(source.encode("utf-8")) % n_shards
+
+
+def shard_path(db_path: str, shard: int) -> str:
+    return os.path.join(db_path, f"shard_{shard:03d}")
+
+
+def get_shard_count(db_path: str) -> int:
+    """Number of shards of the index at db_path (1 = unsharded layout)."""
+    try:
+        with open(os.path.join(db_path, SHARDS_FILE)) as f:
+            return int(json.load(f)["shards"])
+    except (OSError, ValueError, KeyError):
+        return 1
+
+
+def write_shard_count(db_path: str, n_shards: int):
+    os.makedirs(db_path, exist_ok=True)
+    with open(os.path.join(db_path, SHARDS_FILE), "w") as f:
+        json.dump({"shards": n_shards}, f)
+
+
+def index_exists(db_path: str) -> bool:
+    """True if db_path holds an index in either layout."""
+    return (os.path.exists(os.path.join(db_path, "index.faiss"))
+            or os.path.exists(os.path.join(db_path, SHARDS_FILE)))
+
+
+def store_shards(store) -> list:
+    """The FAISS stores behind a (possibly sharded) vector store."""
+    return store.shards if isinstance(store, ShardedVectorStore) else [store]
+
+
+def _search_shard(store, vector: List[float], k: int, ids: Optional[np.ndarray] = None) -> List[Tuple]:
+    """Top-k (doc, distance) of one FAISS store, optionally restricted to vector ids."""
+    if ids is None:
+        return store.similarity_search_with_score_by_vector(vector, k=k)
+    if len(ids) == 0:
+        return []
+    distances, labels = search_with_ids(store.index, np.array([vector], dtype="float32"), k, ids)
+    return [
+        (store.docstore.search(store.index_to_docstore_id[int(i)]), float(dist))
+        for dist, i in zip(distances[0], labels[0]) if i >= 0
+    ]
+
+
+def search_shards(shards: Sequence, vector: List[float], k: int,
+                  ids_per_shard: Optional[Sequence[np.ndarray]] = None) -> List[Tuple]:
+    """Search every shard in parallel and merge the top-k by distance."""
+    ids_per_shard = ids_per_shard or [None] * len(shards)
+    if len(shards) == 1:
+        return _search_shard(shards[0], vector, k, ids_per_shard[0])
+    futures = [
+        get_search_pool().submit(_search_shard, shard, vector, k, ids)
+        for shard, ids in zip(shards, ids_per_shard)
+    ]
+    return heapq.nsmallest(k, chain.from_iterable(f.result() for f in futures), key=lambda r: r[1])
+
+
+class _MergedDocstore:
+    """Read-only view over the shards' docstores (for listing/counting chunks)."""
+
+    def __init__(self, shards: Sequence):
+        self._dict = _ChainedDict([shard.docstore._dict for shard in shards])
+
+
+class _ChainedDict:
+    def __init__(self, dicts: Sequence[dict]):
+        self._dicts = dicts
+
+    def __len__(self):
+        return sum(len(d) for d in self._dicts)
+
+    def values(self):
+        return chain.from_iterable(d.values() for d in self._dicts)
+
+
+class ShardedVectorStore:
+    """Several FAISS stores (same embedding model) searched as one: shards and their delta segments."""
+
+    def __init__(self, shards: Dict[object, object]):
+        """shards: {sortable key, e.g. (shard, segment): FAISS store}; shards without data are omitted."""
+        self.shard_numbers = sorted(shards)
+        self.shards = [shards[n] for n in self.shard_numbers]
+        self.docstore = _MergedDocstore(self.shards)
+
+    @property
+    def embeddings(self):
+        return self.shards[0].embeddings
+
+    def similarity_search_with_score(self, query: str, k: int = 4) -> List[Tuple]:
+        # Embed once, not once per shard
+        return search_shards(self.shards, self.embeddings.embed_query(query), k)
+
+
+class ShardedBM25:
+    """Several BM25Index shards searched in parallel, addressed by global document position."""
+
+    def __init__(self, shards: Dict[int, object]):
+        """shards: {shard number: BM25Index}"""
+        self.shards = shards
+        self._ordered = [shards[n] for n in sorted(shards)]
+        self.documents = [doc for shard in self._ordered for doc in shard.documents]
+        self._offsets = np.cumsum([0] + [len(shard.documents) for shard in self._ordered])
+
+    def search(self, query: str, k: int = 5, candidates: Optional[np.ndarray] = None) -> List[Tuple]:
+        if candidates is None:
+            per_shard = [None] * len(self._ordered)
+        else:
+            candidates = np.asarray(candidates, dtype="int64")
+            bounds = np.searchsorted(candidates, self._offsets)
+            per_shard = [
+                candidates[bounds[i]:bounds[i + 1]] - self._offsets[i]
+                for i in range(len(self._ordered))
+            ]
+        pool = get_search_pool()
+        futures = [
+            pool.submit(shard.search, query, k, shard_candidates)
+            for shard, shard_candidates in zip(self._ordered, per_shard)
+            if shard_candidates is None or len(shard_candidates)
+        ]
+        return heapq.nlargest(k, chain.from_iterable(f.result() for f in futures), key=lambda r: r[1])
@@ -112,10 +112,12 @@ def start():
     ui = None
     if not server_was_running:
         if "--debug" in sys.argv:
+            # Flask development server (reloader + debugger)
             print("🔧 Debug Mode Enabled")
-            app_args = [sys.executable, "debug_server.py"]
-        else:
             app_args = [sys.executable, "app.py"]
+        else:
+            # Multi-worker production server
+            app_args = [sys.executable, "serve.py"]
             
         ui = subprocess.Popen(
             app_args,
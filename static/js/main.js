@@ -1949,12 +1949,22 @@ async function sendMessage() {
         abortController = new AbortController();
 
         // Build payload with files
+        const files = (typeof currentFiles !== 'undefined' && currentFiles) ? currentFiles : [];
         const payload = {
             message: message,
             session_id: currentSessionId,
-            files: (typeof currentFiles !== 'undefined' && currentFiles) ? currentFiles : [],
+            // Attachments holding a File go as binary multipart parts instead of base64
+            files: files.map((f, i) => f.file ? { type: f.type, name: f.name, addToRag: f.addToRag, part: `file${i}` } : f),
             deep_search: typeof isDeepSearchEnabled !== 'undefined' ? isDeepSearchEnabled : false
         };
+        let body = JSON.stringify(payload);
+        let headers = { 'Content-Type': 'application/json' };
+        if (files.some(f => f.file)) {
+            body = new FormData();
+            body.append('payload', JSON.stringify(payload));
+            files.forEach((f, i) => { if (f.file) body.append(`file${i}`, f.file, f.name); });
+            headers = {};  // The browser sets the multipart boundary
+        }
 
         // Clear attachments immediately
         if (typeof currentFiles !== 'undefined') {
@@ -1964,8 +1974,8 @@ async function sendMessage() {
 
         const response = await fetch('/chat', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(payload),
+            headers: headers,
+            body: body,
             signal: abortController.signal
         });
 
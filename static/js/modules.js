@@ -177,26 +177,84 @@ document.addEventListener('DOMContentLoaded', function () {
 // window.renderFiles = renderFiles; // Removed
 
 
+// Larger files go through the resumable upload API (/api/uploads) in byte
+// ranges, so a dropped connection only re-sends the current range
+const RESUMABLE_UPLOAD_THRESHOLD = 64 * 1024 * 1024;
+const RESUMABLE_UPLOAD_RETRIES = 5;
+
+async function uploadResumable(file) {
+    let response = await fetch('/api/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+    });
+    let upload = await response.json();
+    if (!response.ok) throw new Error(upload.error || 'Could not start upload');
+    let offset = 0;
+    let failures = 0;
+    while (offset < file.size) {
+        const end = Math.min(offset + upload.chunk_size, file.size);
+        try {
+            response = await fetch(`/api/uploads/${upload.upload_id}`, {
+                method: 'PUT',
+                headers: { 'Content-Range': `bytes ${offset}-${end - 1}/${file.size}` },
+                body: file.slice(offset, end)
+            });
+            const data = await response.json();
+            if (!response.ok && response.status !== 409) throw new Error(data.error);
+            if (response.status === 409) {
+                offset = (await (await fetch(`/api/uploads/${upload.upload_id}`)).json()).offset;
+            } else {
+                offset = data.offset;
+            }
+            failures = 0;
+        } catch (e) {
+            if (++failures > RESUMABLE_UPLOAD_RETRIES) throw e;
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** failures));
+            // Resume from what the server actually received
+            const status = await fetch(`/api/uploads/${upload.upload_id}`).catch(() => null);
+            if (status && status.ok) offset = (await status.json()).offset;
+        }
+    }
+    response = await fetch(`/api/uploads/${upload.upload_id}/commit`, { method: 'POST' });
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error || 'Upload failed');
+    return data;
+}
+
 async function uploadFiles(files) {
     if (!files || files.length === 0) return;
     const formData = new FormData();
+    const large = [];
     for (let i = 0; i < files.length; i++) {
-        formData.append('files', files[i]);
+        if (files[i].size > RESUMABLE_UPLOAD_THRESHOLD) {
+            large.push(files[i]);
+        } else {
+            formData.append('files', files[i]);
+        }
     }
     showToast('Uploading files...', 'info');
     try {
-        const response = await fetch('/api/files/upload', {
-            method: 'POST',
-            body: formData
-        });
-        const data = await response.json();
-        if (data.status === 'success') {
-            showToast(`Uploaded ${data.uploaded.length} files`, 'success');
-            loadFiles();
-            loadStats();
-        } else {
-            showToast('Upload failed: ' + (data.message || 'Unknown error'), 'error');
+        let uploaded = 0;
+        for (const file of large) {
+            await uploadResumable(file);
+            uploaded++;
+        }
+        if (large.length < files.length) {
+            const response = await fetch('/api/files/upload', {
+                method: 'POST',
+                body: formData
+            });
+            const data = await response.json();
+            if (data.status !== 'success') {
+                showToast('Upload failed: ' + (data.message || 'Unknown error'), 'error');
+                return;
+            }
+            uploaded += data.uploaded.length;
         }
+        showToast(`Uploaded ${uploaded} files`, 'success');
+        loadFiles();
+        loadStats();
     } catch (e) {
         showToast('Upload error: ' + e.message, 'error');
     }
@@ -472,7 +530,7 @@ window.addEventListener('click', (e) => {
 // They are likely set BEFORE this script runs if we put this script at the end.
 
 // Unified file staging (max 5 files)
-let currentFiles = []; // {type: 'image'|'document', name: string, data: base64, addToRag: boolean}
+let currentFiles = []; // {type: 'image'|'document', name: string, file: File, data: preview URL (images), addToRag: boolean}
 const MAX_FILES = 5;
 let pendingRagDocs = []; // Documents awaiting RAG confirmation
 
@@ -1011,6 +1069,29 @@ function removeFile(index) {
     renderFilePreviews();
 }
 
+// Chat attachments (📎): images are staged right away, documents after the "Add to RAG?" prompt.
+// The File itself is kept, so sendMessage sends it as a binary multipart part.
+function stageChatFiles(event) {
+    const files = Array.from(event.target.files || []);
+    event.target.value = '';  // Lets the same file be picked again
+    const room = Math.max(0, MAX_FILES - currentFiles.length - pendingRagDocs.length);
+    if (files.length > room) {
+        showToast(`Up to ${MAX_FILES} files can be attached`, 'warning');
+    }
+    const prompting = pendingRagDocs.length > 0;
+    files.slice(0, room).forEach(file => {
+        if (file.type.startsWith('image/')) {
+            currentFiles.push({ type: 'image', name: file.name, file: file, data: URL.createObjectURL(file), addToRag: false });
+        } else {
+            pendingRagDocs.push({ type: 'document', name: file.name, file: file });
+        }
+    });
+    renderFilePreviews();
+    if (!prompting && pendingRagDocs.length > 0) {
+        showRagPrompt(pendingRagDocs[0]);
+    }
+}
+
 // loadSettings removed - integrated into main.js
 
 document.addEventListener('DOMContentLoaded', () => {
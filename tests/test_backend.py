@@ -20,6 +20,40 @@ from database import (
 )
 
 
+def switch_db(path):
+    """
+    Point the database module at path and return the previous path. The
+    open connection is closed first: database connects once per thread (at
+    import already), so changing DB_PATH alone would keep using the old file.
+    """
+    import database
+    connection = getattr(database._local, "connection", None)
+    if connection is not None:
+        connection.close()
+        del database._local.connection
+    previous, database.DB_PATH = database.DB_PATH, path
+    return previous
+
+
+
+_module_dir = None
+_module_db_path = None
+
+
+def setUpModule():
+    # Tests that don't set up their own database still never write to the real one
+    global _module_dir, _module_db_path
+    _module_dir = tempfile.mkdtemp()
+    _module_db_path = switch_db(os.path.join(_module_dir, "chat_history.db"))
+    init_db()
+
+
+def tearDownModule():
+    switch_db(_module_db_path)
+    shutil.rmtree(_module_dir, ignore_errors=True)
+
+
+
 class TestLoaders(unittest.TestCase):
     """Test document loaders."""
     
@@ -60,6 +94,590 @@ class TestLoaders(unittest.TestCase):
         self.assertIn("Unsupported file type", str(context.exception))
 
 
+class TestStreamingLoaders(unittest.TestCase):
+    """Test lazy loading and incremental chunking."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_text_stream_loader_cuts_at_paragraphs(self):
+        from loaders import TextStreamLoader
+        path = os.path.join(self.temp_dir, "big.txt")
+        paragraphs = [f"Paragraph {i} " + " ".join(["word"] * 30) for i in range(40)]
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n\n".join(paragraphs))
+        blocks = list(TextStreamLoader(path, block_chars=500).lazy_load())
+        self.assertGreater(len(blocks), 5)
+        for block in blocks:
+            self.assertTrue(block.page_content.startswith("Paragraph "))
+        self.assertEqual("\n\n".join(b.page_content.strip() for b in blocks), "\n\n".join(paragraphs))
+    
+    def test_read_text_stops_early(self):
+        from langchain_core.documents import Document
+        from loaders import read_text
+        pulled = []
+        
+        def pages():
+            for i in range(1000):
+                pulled.append(i)
+                yield Document(page_content=f"Page {i} " + "x" * 100)
+        
+        text, truncated = read_text(pages(), max_chars=250)
+        self.assertTrue(truncated)
+        self.assertEqual(len(text), 250)
+        self.assertLess(len(pulled), 5)
+        self.assertEqual(read_text(iter([Document(page_content="a"), Document(page_content="b")])), ("a\n\nb", False))
+    
+    def test_chunks_are_produced_lazily(self):
+        from langchain_core.documents import Document
+        from chunking import iter_chunks
+        pulled = []
+        
+        def pages():
+            for i in range(1000):
+                pulled.append(i)
+                yield Document(page_content=f"Page {i} text. " * 5, metadata={"page": i})
+        
+        chunks = iter_chunks(pages(), "report.pdf", {"chunk_size": 200, "chunk_overlap": 20})
+        first = [next(chunks) for _ in range(3)]
+        self.assertEqual([c.metadata["page"] for c in first], [0, 1, 2])
+        self.assertLess(len(pulled), 5)
+
+
+class TestParsedTextCache(unittest.TestCase):
+    """Test the content-addressed parsed-text cache."""
+    
+    def setUp(self):
+        from langchain_core.document_loaders import BaseLoader
+        from langchain_core.documents import Document
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "report.pdf")
+        with open(self.path, "w") as f:
+            f.write("original bytes")
+        self.parses = []
+        parses = self.parses
+        
+        class PageLoader(BaseLoader):
+            def __init__(self, path):
+                self.path = path
+            
+            def lazy_load(self):
+                parses.append(self.path)
+                for i in range(5):
+                    yield Document(page_content=f"Page {i} é", metadata={"source": self.path, "page": i})
+        
+        self.loader = PageLoader(self.path)
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def make_cache(self, max_bytes=1 << 20):
+        from parsed_cache import ParsedTextCache
+        return ParsedTextCache(os.path.join(self.temp_dir, "cache"), max_bytes)
+    
+    def test_second_read_is_served_from_cache(self):
+        cache = self.make_cache()
+        first = list(cache.lazy_load(self.path, self.loader))
+        second = list(cache.lazy_load(self.path, self.loader))
+        self.assertEqual(len(self.parses), 1)
+        self.assertEqual([d.page_content for d in second], [d.page_content for d in first])
+        self.assertEqual(second[3].metadata, {"source": self.path, "page": 3})
+        self.assertEqual(cache.document(self.path, self.loader, 4).page_content, "Page 4 é")
+        self.assertIsNone(cache.document(self.path, self.loader, 5))
+        self.assertEqual(len(self.parses), 1)
+    
+    def test_early_stop_finishes_parse_in_background(self):
+        cache = self.make_cache()
+        self.assertEqual(cache.document(self.path, self.loader, 0).page_content, "Page 0 é")
+        cache._executor.submit(lambda: None).result()  # Wait for the background parse
+        self.assertTrue(cache.contains(cache.key(self.path, self.loader)))
+        list(cache.lazy_load(self.path, self.loader))
+        self.assertEqual(len(self.parses), 2)
+    
+    def test_changed_content_is_parsed_again(self):
+        cache = self.make_cache()
+        list(cache.lazy_load(self.path, self.loader))
+        with open(self.path, "w") as f:
+            f.write("new bytes, new length")
+        list(cache.lazy_load(self.path, self.loader))
+        self.assertEqual(len(self.parses), 2)
+    
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = self.make_cache(max_bytes=400)  # Room for one entry
+        other = os.path.join(self.temp_dir, "other.pdf")
+        with open(other, "w") as f:
+            f.write("other bytes")
+        list(cache.lazy_load(self.path, self.loader))
+        first_key = cache.key(self.path, self.loader)
+        list(cache.lazy_load(other, type(self.loader)(other)))
+        self.assertFalse(cache.contains(first_key))
+        self.assertTrue(cache.contains(cache.key(other, self.loader)))
+
+
+class TestOCR(unittest.TestCase):
+    """Test OCR of scanned PDF pages (tesseract itself is mocked)."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.config = {"ocr_cache_dir": os.path.join(self.temp_dir, "ocr"), "ocr_workers": 1}
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_text_less_pages_are_ocred(self):
+        from unittest import mock
+        from PIL import Image
+        import ocr
+        path = os.path.join(self.temp_dir, "scan.pdf")
+        Image.new("RGB", (200, 100), "white").save(path, "PDF")
+        with mock.patch.object(ocr, "ocr_images", return_value=["Scanned invoice 42"]) as ocr_images:
+            pages = list(ocr.OCRPDFLoader(path, self.config).lazy_load())
+        self.assertEqual(len(ocr_images.call_args[0][0]), 1)  # The page's image
+        self.assertEqual(pages[0].page_content, "Scanned invoice 42")
+        self.assertTrue(pages[0].metadata["ocr"])
+    
+    def test_cached_pages_skip_ocr(self):
+        from unittest import mock
+        import ocr
+        path = ocr._cache_path(self.config, b"page image")
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("cached text")
+        with mock.patch.object(ocr, "_get_pool", side_effect=AssertionError("OCR'd again")):
+            self.assertEqual(ocr.ocr_images([b"page image"], self.config), ["cached text"])
+
+
+class TestVisionImages(unittest.TestCase):
+    """Test image preparation for the vision model."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.config = {"image_cache_dir": os.path.join(self.temp_dir, "images"), "vision_image_size": 100}
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def png_bytes(self, size, mode="RGB"):
+        import io
+        from PIL import Image
+        out = io.BytesIO()
+        Image.new(mode, size, "red").save(out, "PNG")
+        return out.getvalue()
+    
+    def test_images_are_downscaled_and_cached(self):
+        import io
+        from unittest import mock
+        from PIL import Image
+        import vision
+        data = self.png_bytes((1600, 800), "RGBA")
+        prepared = vision.prepare_image(data, self.config)
+        self.assertEqual(prepared.mime_type, "image/jpeg")
+        with Image.open(io.BytesIO(prepared.data)) as image:
+            self.assertEqual(image.size, (100, 50))
+        with mock.patch.object(vision, "_downscale", side_effect=AssertionError("prepared again")):
+            self.assertEqual(vision.prepare_image(data, self.config), prepared)
+    
+    def test_unreadable_images_pass_through(self):
+        import vision
+        unreadable = vision.prepare_image(b"not an image", self.config)
+        self.assertEqual(unreadable.data, b"not an image")
+        self.assertTrue(vision.to_data_url(unreadable).startswith("data:image/png;base64,"))
+
+
+class TestUploads(unittest.TestCase):
+    """Test chunked writing of uploads to disk and resumable uploads."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = bytes(range(256)) * 1000
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_stream_to_file(self):
+        import io
+        from uploads import stream_to_file
+        path = os.path.join(self.temp_dir, "upload.bin")
+        self.assertEqual(stream_to_file(io.BytesIO(self.data), path, chunk_size=1000), len(self.data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(os.listdir(self.temp_dir), ["upload.bin"])
+    
+    def test_base64_to_file_decodes_in_slices(self):
+        import base64
+        from uploads import base64_to_file
+        path = os.path.join(self.temp_dir, "doc.pdf")
+        url = "data:application/pdf;base64," + base64.b64encode(self.data).decode()
+        self.assertEqual(base64_to_file(url, path, chunk_size=999), len(self.data))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        with self.assertRaises(ValueError):
+            base64_to_file("not*base64", path)
+        self.assertEqual(os.listdir(self.temp_dir), ["doc.pdf"])
+
+    def test_save_upload_picks_free_name(self):
+        import io
+        from uploads import save_upload
+        self.assertEqual(save_upload(io.BytesIO(b"one"), self.temp_dir, "a.txt"), ("a.txt", 3))
+        self.assertEqual(save_upload(io.BytesIO(b"two"), self.temp_dir, "a.txt"), ("a_1.txt", 3))
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ["a.txt", "a_1.txt"])
+    
+    def test_resumable_upload(self):
+        """Test ranges with a retry and a resume, then commit with hash verification."""
+        import hashlib
+        import io
+        from uploads import UploadError, commit_upload, create_upload, get_upload, write_range
+        config = {"upload_sessions_dir": os.path.join(self.temp_dir, "sessions")}
+        upload_dir = os.path.join(self.temp_dir, "uploaded")
+        os.makedirs(upload_dir)
+        upload_id = create_upload("big.bin", len(self.data), config,
+                                  sha256=hashlib.sha256(self.data).hexdigest())["upload_id"]
+        self.assertEqual(write_range(upload_id, io.BytesIO(self.data[:100000]), 0, config), 100000)
+        with self.assertRaises(UploadError) as gap:
+            write_range(upload_id, io.BytesIO(self.data[200000:]), 200000, config)
+        self.assertEqual(gap.exception.status, 409)
+        # Connection dropped: the client asks where to resume, and re-sends an overlap
+        self.assertEqual(get_upload(upload_id, config)["offset"], 100000)
+        self.assertEqual(write_range(upload_id, io.BytesIO(self.data[50000:]), 50000, config), len(self.data))
+        with self.assertRaises(UploadError) as too_large:
+            write_range(upload_id, io.BytesIO(b"extra"), len(self.data), config)
+        self.assertEqual(too_large.exception.status, 413)
+        
+        state = commit_upload(upload_id, upload_dir, config)
+        self.assertEqual(state["name"], "big.bin")
+        with open(os.path.join(upload_dir, "big.bin"), "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        with self.assertRaises(UploadError) as gone:
+            get_upload(upload_id, config)
+        self.assertEqual(gone.exception.status, 404)
+    
+    def test_resumable_upload_hash_mismatch(self):
+        import io
+        from uploads import UploadError, abort_upload, commit_upload, create_upload, get_upload, write_range
+        config = {"upload_sessions_dir": os.path.join(self.temp_dir, "sessions")}
+        upload_id = create_upload("bad.bin", 3, config, sha256="0" * 64)["upload_id"]
+        write_range(upload_id, io.BytesIO(b"abc"), 0, config)
+        with self.assertRaises(UploadError) as mismatch:
+            commit_upload(upload_id, self.temp_dir, config)
+        self.assertEqual(mismatch.exception.status, 422)
+        self.assertEqual(get_upload(upload_id, config)["offset"], 0)  # Send it again
+        abort_upload(upload_id, config)
+        self.assertEqual(os.listdir(config["upload_sessions_dir"]), [])
+
+
+def import_app():
+    """The Flask app module, imported without its log files, upload dir watcher or index warm-up."""
+    if "app" not in sys.modules:
+        import logging
+        from unittest import mock
+        import config_manager
+        config = dict(config_manager.load_config(), watch_uploads=False)
+        with mock.patch("config_manager.load_config", return_value=config), \
+                mock.patch("logging_config.setup_logging", return_value=logging.getLogger("RAG_Agent")), \
+                mock.patch("backend.warm_index_cache"):
+            import app
+        app.load_config = config_manager.load_config
+    return sys.modules["app"]
+
+
+class TestChatAttachments(unittest.TestCase):
+    """Test /chat attachments sent as multipart parts or by file_id."""
+    
+    def setUp(self):
+        from unittest import mock
+        self.app = import_app()
+        self.temp_dir = tempfile.mkdtemp()
+        self.upload_dir = os.path.join(self.temp_dir, "uploads")
+        self.chat_dir = os.path.join(self.temp_dir, "chat")
+        os.makedirs(self.upload_dir)
+        os.makedirs(self.chat_dir)
+        self.read, self.answered = [], []
+        
+        def get_rag_chain(*args, **kwargs):
+            self.answered.append(True)
+            raise RuntimeError("no model in tests")  # Stop once the attachments are handled
+        
+        patches = [
+            mock.patch.object(self.app, "UPLOAD_DIR", self.upload_dir),
+            mock.patch.object(self.app, "CHAT_ATTACHMENTS_DIR", self.chat_dir),
+            mock.patch.object(self.app, "check_ollama_health", return_value={"available": True}),
+            mock.patch.object(self.app, "load_document_content",
+                              side_effect=lambda path, max_chars=None: self.read.append(path) or "text"),
+            mock.patch.object(self.app, "get_rag_chain", side_effect=get_rag_chain),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _chat(self, payload, **parts):
+        import io
+        import json
+        data = {"payload": json.dumps({"message": "What is in it?", "session_id": 1, **payload})}
+        data.update({name: (io.BytesIO(content), name + ".bin") for name, content in parts.items()})
+        return self.app.app.test_client().post("/chat", data=data, content_type="multipart/form-data")
+    
+    def test_multipart_part_is_a_temp_attachment(self):
+        self._chat({"files": [{"type": "document", "name": "notes.txt", "addToRag": False, "part": "file0"}]},
+                   file0=b"binary \x00 bytes")
+        self.assertEqual(self.read, [os.path.join(self.chat_dir, "notes.txt")])
+        with open(self.read[0], "rb") as f:
+            self.assertEqual(f.read(), b"binary \x00 bytes")
+        self.assertEqual(os.listdir(self.upload_dir), [])  # Kept out of the watched upload dir
+    
+    def test_file_id_references_an_upload(self):
+        with open(os.path.join(self.upload_dir, "report.txt"), "w") as f:
+            f.write("uploaded before")
+        self._chat({"files": [{"type": "document", "file_id": "report.txt"}]})
+        self.assertEqual(self.read, [os.path.join(self.upload_dir, "report.txt")])
+        
+        self._chat({"files": [{"type": "document", "file_id": "../outside.txt"}]})
+        self.assertEqual(len(self.read), 1)  # Rejected, not read
+    
+    def test_added_attachment_is_ingested(self):
+        from unittest import mock
+        result = {"success": True, "processed_count": 1, "failed_count": 0, "results": []}
+        with mock.patch.object(self.app, "ingest_files", return_value=result) as ingest:
+            self._chat({"files": [{"type": "document", "name": "keep.txt", "addToRag": True, "part": "file0"}]},
+                       file0=b"keep me")
+        ingest.assert_called_once_with([os.path.join(self.upload_dir, "keep.txt")])
+        self.assertEqual(self.read, [])
+        self.assertEqual(self.answered, [True])
+
+
+class TestChunking(unittest.TestCase):
+    """Test the per-file-type chunking strategies."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.config = {"chunk_size": 200, "chunk_overlap": 20}
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_markdown_chunks_carry_heading_path(self):
+        from langchain_core.documents import Document
+        from chunking import iter_chunks
+        text = "# Guide\nIntro.\n## Install\n" + "Run the installer and wait. " * 20 + "\n## Usage\nUse it.\n"
+        chunks = list(iter_chunks([Document(page_content=text)], "guide.md", self.config))
+        install = [c for c in chunks if c.metadata["section"] == "Guide > Install"]
+        self.assertGreater(len(install), 1)
+        for chunk in install:
+            self.assertTrue(chunk.page_content.startswith("Guide > Install\n"))
+            self.assertLessEqual(len(chunk.page_content), 200)
+    
+    def test_csv_rows_are_batched_with_header(self):
+        from langchain_community.document_loaders import CSVLoader
+        from chunking import iter_chunks
+        path = os.path.join(self.temp_dir, "people.csv")
+        with open(path, "w", newline="") as f:
+            f.write("name,age,note\n" + "".join(f'P{i},{i},"multi\nline: {i}"\n' for i in range(12)))
+        chunks = list(iter_chunks(CSVLoader(path).load(), path, self.config))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertTrue(chunk.page_content.startswith("name | age | note\n"))
+        self.assertIn("P3 | 3 | multi line: 3", chunks[0].page_content)
+        self.assertEqual(chunks[0].metadata["rows"].split("-")[0], "0")
+    
+    def test_rows_are_measured_once(self):
+        from langchain_core.documents import Document
+        from chunking import ChunkSizer, _batch_rows
+        measured = []
+        def length(text):
+            measured.append(text)
+            return len(text)
+        rows = [(i, f"row {i} " + "x" * (i % 7)) for i in range(500)]
+        chunks = list(_batch_rows(ChunkSizer(120, 0, length), Document(page_content=""), "h1 | h2", rows, "csv_rows"))
+        self.assertLessEqual(len(measured), len(rows) + 1)  # Header, then each row once
+        self.assertTrue(all(len(c.page_content) <= 120 for c in chunks))
+        self.assertEqual([line for c in chunks for line in c.page_content.split("\n")[1:]], [r for _, r in rows])
+    
+    def test_pdf_chunks_stay_on_their_page(self):
+        from langchain_core.documents import Document
+        from chunking import iter_chunks
+        pages = [
+            Document(page_content="1. Introduction\nIntro words.\n2. Methods\n" + "We measured. " * 25, metadata={"page": 0}),
+            Document(page_content="More method text.", metadata={"page": 1}),
+        ]
+        chunks = list(iter_chunks(pages, "paper.pdf", self.config))
+        self.assertEqual(chunks[-1].page_content, "2. Methods\nMore method text.")
+        self.assertEqual(chunks[-1].metadata["page"], 1)
+        self.assertEqual({c.metadata["section"] for c in chunks}, {"1. Introduction", "2. Methods"})
+    
+    def test_one_chunk_per_slide(self):
+        from langchain_core.documents import Document
+        from chunking import iter_chunks
+        elements = [
+            Document(page_content="Roadmap", metadata={"page_number": 1, "category": "Title"}),
+            Document(page_content="Ship v2", metadata={"page_number": 1, "category": "ListItem"}),
+            Document(page_content="Budget", metadata={"page_number": 2, "category": "Title"}),
+        ]
+        chunks = list(iter_chunks(elements, "deck.pptx", self.config))
+        self.assertEqual([c.page_content for c in chunks], ["Roadmap\nShip v2", "Budget"])
+        self.assertEqual([c.metadata["slide"] for c in chunks], [1, 2])
+    
+    def test_recursive_strategy_setting(self):
+        from langchain_core.documents import Document
+        from chunking import iter_chunks
+        chunks = list(iter_chunks([Document(page_content="# Title\nBody")], "a.md",
+                                      {**self.config, "chunking_strategy": "recursive"}))
+        self.assertEqual([c.page_content for c in chunks], ["# Title\nBody"])
+    
+    def test_failed_strategy_falls_back_for_the_rest(self):
+        from unittest import mock
+        from langchain_core.documents import Document
+        import chunking
+        pulled = []
+        
+        def pages():
+            for i in range(100):
+                pulled.append(i)
+                yield Document(page_content=f"Page {i}", metadata={"page": i})
+        
+        def broken(docs, sizer):
+            for doc in docs:
+                if doc.metadata["page"] == 2:
+                    raise ValueError("bad page")
+                yield doc
+        
+        with mock.patch.dict(chunking.STRATEGIES, {".pdf": broken}):
+            chunks = chunking.iter_chunks(pages(), "report.pdf", self.config)
+            first = [next(chunks).page_content for _ in range(2)]
+            self.assertEqual(len(pulled), 2)  # Still lazy while the strategy works
+            rest = [c.page_content for c in chunks]
+        self.assertEqual(first, ["Page 0", "Page 1"])
+        self.assertEqual(rest[0], "Page 1")  # The page of the last chunk is split again
+        self.assertEqual(rest[1:], [f"Page {i}" for i in range(2, 100)])
+
+
+class TestTokenCounting(unittest.TestCase):
+    """Test token counting, token-sized chunks and context packing."""
+    
+    def test_approximate_counter(self):
+        from token_counter import get_token_counter
+        count = get_token_counter("approximate")
+        self.assertEqual(count("The quick brown fox."), 5)
+        self.assertEqual(count("internationalization"), 4)
+        self.assertEqual(count(""), 0)
+    
+    def test_counter_caches_only_short_pieces(self):
+        from token_counter import get_token_counter, CACHED_PIECE_CHARS
+        count = get_token_counter("approximate")
+        before = count.cache_info().currsize
+        count("word " * CACHED_PIECE_CHARS)  # Chunk-sized: counted, not kept
+        self.assertEqual(count.cache_info().currsize, before)
+        count("a short separator-sized piece for the cache test")
+        self.assertEqual(count.cache_info().currsize, before + 1)
+    
+    def test_token_sized_chunks(self):
+        from langchain_core.documents import Document
+        from chunking import iter_chunks
+        from token_counter import get_token_counter
+        count = get_token_counter("approximate")
+        config = {"chunk_size": 50, "chunk_overlap": 5, "chunk_size_unit": "tokens", "tokenizer": "approximate"}
+        chunks = list(iter_chunks([Document(page_content="Alpha beta gamma delta. " * 100)], "notes.txt", config))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(count(c.page_content) <= 50 for c in chunks))
+    
+    def test_pack_documents_uses_stored_counts(self):
+        from langchain_core.documents import Document
+        from token_counter import pack_documents
+        docs = [
+            Document(page_content="best", metadata={"token_count": 60}),
+            Document(page_content="too big", metadata={"token_count": 50}),
+            Document(page_content="small", metadata={"token_count": 20}),
+        ]
+        def counter(text):
+            raise AssertionError("stored counts must be used")
+        packed = pack_documents(docs, 100, counter, overhead=0)
+        self.assertEqual([d.page_content for d in packed], ["best", "small"])
+        self.assertEqual(len(pack_documents(docs, 0, counter)), 3)
+        self.assertEqual([d.page_content for d in pack_documents(docs, 10, counter)], ["best"])
+
+
+class TestDedup(unittest.TestCase):
+    """Test near-duplicate chunk elimination."""
+    
+    BOILERPLATE = ("This document is confidential and the property of Acme Corp. "
+                   "It must not be shared outside the company without written permission.")
+    
+    def _chunk(self, text, source):
+        from langchain_core.documents import Document
+        from dedup import simhash
+        return Document(page_content=f"Source: {source}\n\n{text}", metadata={"source": source, "simhash": simhash(text)})
+    
+    def test_simhash_distance(self):
+        from dedup import hamming_distance, simhash
+        base = simhash(self.BOILERPLATE)
+        self.assertEqual(base, simhash(self.BOILERPLATE.upper()))
+        self.assertGreater(hamming_distance(base, simhash("Quarterly revenue grew in every region we operate in.")), 10)
+    
+    def test_batch_duplicates_collapse_without_embedding(self):
+        from dedup import deduplicate
+        chunks = [self._chunk(self.BOILERPLATE, "a.pdf"), self._chunk("Unique text.", "a.pdf"),
+                  self._chunk(self.BOILERPLATE, "b.pdf")]
+        embedded = []
+        
+        def embed(texts):
+            embedded.extend(texts)
+            return [[float(i), 1.0] for i in range(len(texts))]
+        kept, vectors, aliases = deduplicate(chunks, embed, {})
+        self.assertEqual(len(kept), 2)
+        self.assertEqual(len(embedded), 2)
+        self.assertEqual(kept[0].metadata["sources"], ["a.pdf", "b.pdf"])
+        self.assertEqual(len(vectors), 2)
+        self.assertEqual(aliases, [])
+    
+    def test_indexed_duplicates_become_aliases(self):
+        from dedup import SimHashIndex, deduplicate, simhash
+        existing = SimHashIndex()
+        existing.add(simhash(self.BOILERPLATE), ("shard", 0, 7))
+        kept, _, aliases = deduplicate([self._chunk(self.BOILERPLATE, "c.pdf")], lambda texts: [], {}, existing)
+        self.assertEqual(kept, [])
+        self.assertEqual(aliases, [(("shard", 0, 7), "c.pdf")])
+    
+    def test_duplicates_of_embedded_chunks_not_indexed_yet(self):
+        from dedup import EmbeddedChunks, deduplicate
+        embedded = EmbeddedChunks()
+        kept, vectors, _ = deduplicate([self._chunk(self.BOILERPLATE, "a.pdf")], lambda texts: [[1.0, 0.0]], {})
+        embedded.add(kept, vectors)
+        kept, _, aliases = deduplicate([self._chunk(self.BOILERPLATE, "b.pdf")], lambda texts: [], {},
+                                       embedded=embedded)
+        self.assertEqual((kept, aliases), ([], []))
+        self.assertEqual(embedded.chunks[0].metadata["sources"], ["a.pdf", "b.pdf"])
+    
+    def test_near_duplicates_need_similar_embeddings(self):
+        from dedup import deduplicate, hamming_distance
+        words = [f"word{i}" for i in range(160)]
+        edited = list(words)
+        edited[81] = "changed"
+        variants = [self._chunk(" ".join(words), "a.pdf"), self._chunk(" ".join(edited), "b.pdf")]
+        self.assertLessEqual(hamming_distance(variants[0].metadata["simhash"], variants[1].metadata["simhash"]), 3)
+        
+        similar = lambda texts: [[1.0, 0.0]] * len(texts)
+        kept, _, _ = deduplicate(list(variants), similar, {})
+        self.assertEqual(len(kept), 1)
+        
+        for chunk in variants:
+            chunk.metadata.pop("sources", None)
+        different = lambda texts: [[1.0, 0.0], [0.0, 1.0]][:len(texts)]
+        self.assertEqual(len(deduplicate(list(variants), different, {})[0]), 2)
+    
+    def test_collapsed_chunks_match_every_source(self):
+        from langchain_core.documents import Document
+        from metadata_filter import MetadataIndex
+        index = MetadataIndex([
+            Document(page_content="x", metadata={"source": "a.pdf", "sources": ["a.pdf", "b.pdf"]}),
+            Document(page_content="y", metadata={"source": "b.pdf"}),
+        ])
+        self.assertEqual(index.matching_ids({"sources": ["b.pdf"]}).tolist(), [0, 1])
+
+
 class TestBM25Index(unittest.TestCase):
     """Test BM25 keyword search index."""
     
@@ -116,6 +734,778 @@ class TestBM25Index(unittest.TestCase):
         """Test loading from nonexistent path."""
         loaded = BM25Index.load("/nonexistent/path.pkl")
         self.assertIsNone(loaded)
+    
+    def test_extend_matches_refit(self):
+        """Test that appending documents scores like fitting all of them, leaving the original as it was."""
+        from langchain_core.documents import Document
+        old = [Document(page_content=f"python notes {i} about indexes") for i in range(5)]
+        new = [Document(page_content="python indexes grow"), Document(page_content="rust notes")]
+        index = BM25Index()
+        index.fit(old)
+        extended = index.extend(new)
+        refit = BM25Index()
+        refit.fit(old + new)
+        
+        for query in ("python indexes", "rust", "notes 3"):
+            self.assertEqual([(d.page_content, round(score, 9)) for d, score in extended.search(query, k=4)],
+                             [(d.page_content, round(score, 9)) for d, score in refit.search(query, k=4)])
+        self.assertEqual(extended.doc_freqs, refit.doc_freqs)
+        self.assertEqual(len(index.documents), 5)
+        self.assertNotIn("rust", index.search("rust", k=1)[0][0].page_content)
+        
+        extended.save(self.index_path)
+        loaded = BM25Index.load(self.index_path)
+        self.assertEqual([d.page_content for d, _ in loaded.search("python indexes", k=3)],
+                         [d.page_content for d, _ in refit.search("python indexes", k=3)])
+
+
+class TestIndexHolder(unittest.TestCase):
+    """Test the RW-locked holder that swaps index generations."""
+    
+    def _generation(self, config_key=("db", "model"), disk_generation=1):
+        from backend import IndexGeneration
+        return IndexGeneration(config_key, disk_generation, db=object())
+    
+    def _wait_for(self, predicate):
+        import time
+        for _ in range(100):
+            if predicate():
+                return True
+            time.sleep(0.05)
+        return predicate()
+    
+    def test_get_or_load_caches_until_generation_changes(self):
+        """Test that a loaded generation is reused until the disk generation changes."""
+        from backend import IndexHolder
+        holder = IndexHolder()
+        loads = []
+        
+        def loader(gen):
+            def _load():
+                loads.append(gen)
+                return self._generation(disk_generation=gen)
+            return _load
+        
+        first = holder.get_or_load(("db", "model"), 1, loader(1))
+        self.assertIs(holder.get_or_load(("db", "model"), 1, loader(1)), first)
+        
+        # Newer data on disk: old generation is served while it reloads
+        self.assertIs(holder.get_or_load(("db", "model"), 2, loader(2)), first)
+        self.assertTrue(self._wait_for(lambda: holder.current().disk_generation == 2))
+        second = holder.current()
+        self.assertEqual(loads, [1, 2])
+        
+        holder.invalidate()
+        self.assertTrue(second.stale)
+        holder.get_or_load(("db", "model"), 2, loader(2))
+        self.assertTrue(self._wait_for(lambda: len(loads) == 3))
+        
+        # Config change: loads inline
+        third = holder.get_or_load(("db", "other-model"), 2, loader(3))
+        self.assertEqual(third.disk_generation, 3)
+    
+    def test_readers_use_old_generation_while_new_one_loads(self):
+        """Test that readers are served the old generation during a background reload."""
+        import threading
+        from backend import IndexHolder
+        holder = IndexHolder()
+        old = holder.get_or_load(("db", "model"), 1, lambda: self._generation(disk_generation=1))
+        
+        loading = threading.Event()
+        release = threading.Event()
+        
+        def slow_loader():
+            loading.set()
+            release.wait(5)
+            return self._generation(disk_generation=2)
+        
+        # The request that notices the new generation is not blocked either
+        self.assertIs(holder.get_or_load(("db", "model"), 2, slow_loader), old)
+        self.assertTrue(loading.wait(5))
+        self.assertIs(holder.get_or_load(("db", "model"), 2, slow_loader), old)
+        
+        release.set()
+        self.assertTrue(self._wait_for(lambda: holder.current().disk_generation == 2))
+    
+    def test_reload_does_not_replace_a_newer_generation(self):
+        """Test that a reload finishing after an ingest's publish keeps the published generation."""
+        import threading
+        from backend import IndexHolder
+        holder = IndexHolder()
+        holder.get_or_load(("db", "model"), 1, lambda: self._generation(disk_generation=1))
+        loading, release, done = threading.Event(), threading.Event(), threading.Event()
+        
+        def slow_loader():
+            loading.set()
+            release.wait(5)
+            done.set()
+            return self._generation(disk_generation=2)
+        
+        holder.get_or_load(("db", "model"), 2, slow_loader)
+        self.assertTrue(loading.wait(5))
+        published = self._generation(disk_generation=3)
+        holder.swap(published)  # An ingest publishes while the reload runs
+        release.set()
+        self.assertTrue(done.wait(5))
+        self.assertTrue(self._wait_for(lambda: not holder._load_lock.locked()))
+        self.assertIs(holder.current(), published)
+    
+    def test_write_lock_excludes_readers(self):
+        """Test that a writer waits for active readers to finish."""
+        import threading
+        from backend import ReadWriteLock
+        lock = ReadWriteLock()
+        events = []
+        
+        def write():
+            with lock.write_lock():
+                events.append("write")
+        
+        with lock.read_lock():
+            writer = threading.Thread(target=write)
+            writer.start()
+            writer.join(0.2)
+            self.assertEqual(events, [])
+            events.append("read-done")
+        writer.join(5)
+        self.assertEqual(events, ["read-done", "write"])
+
+
+class TestVectorIndex(unittest.TestCase):
+    """Test ANN index selection, training and the recall report."""
+    
+    def setUp(self):
+        import numpy as np
+        self.vectors = np.random.default_rng(0).random((2000, 16), dtype="float32")
+        self.config = {"faiss_index_type": "auto", "ann_index_type": "ivf_flat",
+                       "ann_promotion_threshold": 1000, "faiss_nprobe": 8}
+    
+    def test_auto_promotion_threshold(self):
+        from vector_index import choose_index_type
+        self.assertEqual(choose_index_type(999, self.config), "flat")
+        self.assertEqual(choose_index_type(1000, self.config), "ivf_flat")
+    
+    def test_promotes_flat_index_and_keeps_ids(self):
+        import faiss
+        from vector_index import ensure_index_type, describe_index, load_ann_report
+        flat = faiss.IndexFlatL2(16)
+        flat.add(self.vectors)
+        
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            index = ensure_index_type(flat, self.config, tmp_dir)
+            self.assertEqual(describe_index(index), "ivf_flat")
+            self.assertEqual(index.ntotal, len(self.vectors))
+            # Stored vectors find themselves, so docstore ids stay aligned
+            _, ids = index.search(self.vectors[:5], 1)
+            self.assertEqual(ids[:, 0].tolist(), [0, 1, 2, 3, 4])
+            
+            report = load_ann_report(tmp_dir)
+            self.assertEqual(report["index_type"], "ivf_flat")
+            self.assertTrue(all(0 <= row["recall_at_k"] <= 1 for row in report["sweep"]))
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_sq8_rescoring_matches_exact_search(self):
+        import faiss
+        from vector_index import build_faiss_index, describe_compression, RescoredIndex
+        index = build_faiss_index(self.vectors, "flat", dict(self.config, vector_compression="sq8"))
+        self.assertEqual(describe_compression(index), "sq8")
+        
+        queries = self.vectors[:20]
+        exact_d, exact_ids = faiss.knn(queries, self.vectors, 5)
+        distances, ids = RescoredIndex(index, self.vectors, 4).search(queries, 5)
+        self.assertEqual(ids.tolist(), exact_ids.tolist())
+        self.assertTrue(((distances - exact_d) ** 2 < 1e-6).all())
+    
+    def test_append_vectors_truncates_partial_write(self):
+        import numpy as np
+        from vector_index import append_vectors, VECTORS_FILE
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            append_vectors(tmp_dir, self.vectors[:10], 0)
+            append_vectors(tmp_dir, self.vectors[10:15], 10)  # e.g. a failed ingest
+            append_vectors(tmp_dir, self.vectors[10:20], 10)
+            stored = np.fromfile(os.path.join(tmp_dir, VECTORS_FILE), dtype="float32").reshape(-1, 16)
+            self.assertTrue(np.array_equal(stored, self.vectors[:20]))
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_too_few_vectors_stays_flat(self):
+        from vector_index import build_faiss_index, describe_index
+        index = build_faiss_index(self.vectors[:100], "ivf_pq", self.config)
+        self.assertEqual(describe_index(index), "flat")
+    
+    def test_search_settings_load_a_new_generation(self):
+        """Test that nprobe/efSearch changes reload indexes instead of being set per query."""
+        from backend import _index_config_key
+        key = _index_config_key(DEFAULT_CONFIG)
+        self.assertEqual(key, _index_config_key(dict(DEFAULT_CONFIG)))
+        self.assertNotEqual(key, _index_config_key(dict(DEFAULT_CONFIG, faiss_nprobe=32)))
+        self.assertNotEqual(key, _index_config_key(dict(DEFAULT_CONFIG, faiss_ef_search=128)))
+    
+    def test_hnsw_build_settings(self):
+        from vector_index import build_faiss_index, describe_index
+        index = build_faiss_index(self.vectors, "hnsw", dict(self.config, hnsw_m=8, hnsw_ef_construction=40,
+                                                             faiss_ef_search=24))
+        self.assertEqual(describe_index(index), "hnsw")
+        self.assertEqual((index.hnsw.efConstruction, index.hnsw.efSearch), (40, 24))
+
+
+class TestCollections(unittest.TestCase):
+    """Test named collection registry and the LRU of loaded collections."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_db_path = switch_db(os.path.join(self.temp_dir, "collections.db"))
+        init_db()
+    
+    def tearDown(self):
+        switch_db(self.original_db_path)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_collection_config_overrides(self):
+        from collection_manager import create_collection, get_collection_config
+        create_collection("test_notes", {"chunk_size": 300, "ollama_host": "http://elsewhere"})
+        config = get_collection_config("test_notes")
+        self.assertEqual(config["chunk_size"], 300)
+        # Only per-collection settings can be overridden
+        self.assertEqual(config["ollama_host"], load_config()["ollama_host"])
+        self.assertTrue(config["db_path"].endswith("test_notes"))
+        self.assertEqual(get_collection_config()["db_path"], load_config()["db_path"])
+        with self.assertRaises(KeyError):
+            get_collection_config("missing_collection")
+    
+    def test_invalid_and_duplicate_names(self):
+        from collection_manager import create_collection
+        with self.assertRaises(ValueError):
+            create_collection("../etc")
+        create_collection("test_notes")
+        with self.assertRaises(ValueError):
+            create_collection("test_notes")
+    
+    def test_lru_unloads_least_recently_used(self):
+        from collection_manager import CollectionCache
+        cache = CollectionCache(object)
+        first = cache.get("a", max_loaded=2)
+        cache.get("b", max_loaded=2)
+        self.assertIs(cache.get("a", max_loaded=2), first)
+        cache.get("c", max_loaded=2)
+        self.assertEqual(cache.loaded(), ["a", "c"])
+        # Idle entries are dropped on the next access
+        cache.get("d", max_loaded=10, idle_seconds=0)
+        self.assertEqual(cache.loaded(), ["d"])
+
+
+class TestMetadataFilter(unittest.TestCase):
+    """Test metadata-filtered retrieval."""
+    
+    def _docs(self):
+        from langchain_core.documents import Document
+        return [
+            Document(page_content=f"chunk {i} about apples", metadata={
+                "source": f"file{i % 3}.{'pdf' if i % 3 == 0 else 'txt'}", "ingested_at": 1000.0 + i
+            })
+            for i in range(12)
+        ]
+    
+    def test_normalize_filter(self):
+        from metadata_filter import normalize_filter
+        self.assertIsNone(normalize_filter({}))
+        normalized = normalize_filter({"file_types": "PDF", "sources": "dir/a.txt", "ingested_after": "2026-01-01"})
+        self.assertEqual(normalized["file_types"], [".pdf"])
+        self.assertEqual(normalized["sources"], ["a.txt"])
+        self.assertIsInstance(normalized["ingested_after"], float)
+        with self.assertRaises(ValueError):
+            normalize_filter({"owner": "me"})
+        with self.assertRaises(ValueError):
+            normalize_filter({"ingested_before": "yesterday"})
+    
+    def test_matching_ids(self):
+        from metadata_filter import MetadataIndex
+        index = MetadataIndex(self._docs())
+        self.assertEqual(index.matching_ids({"file_types": [".pdf"]}).tolist(), [0, 3, 6, 9])
+        self.assertEqual(index.matching_ids({"sources": ["file1.txt"], "ingested_after": 1005.0}).tolist(), [7, 10])
+        self.assertEqual(index.matching_ids({}, tag_sources={"file2.txt"}).tolist(), [2, 5, 8, 11])
+        self.assertEqual(len(index.matching_ids({"sources": ["missing.txt"]})), 0)
+    
+    def test_hybrid_retriever_scores_only_matching_chunks(self):
+        from langchain_community.vectorstores import FAISS
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        from backend import HybridRetriever
+        docs = self._docs()
+        store = FAISS.from_documents(docs, DeterministicFakeEmbedding(size=16))
+        bm25 = BM25Index()
+        bm25.fit(docs)
+        retriever = HybridRetriever(store, bm25, alpha=0.5)
+        
+        results = retriever.get_relevant_documents("apples", k=3, filter={"file_types": [".pdf"]})
+        self.assertTrue(results)
+        self.assertTrue(all(doc.metadata["source"] == "file0.pdf" for doc in results))
+        self.assertEqual(retriever.get_relevant_documents("apples", k=3, filter={"sources": ["none.txt"]}), [])
+
+
+class TestSharding(unittest.TestCase):
+    """Test sharded search merges like a single index."""
+    
+    def _docs(self):
+        from langchain_core.documents import Document
+        words = ["alpha", "beta", "gamma", "delta", "omega"]
+        return [
+            Document(page_content=" ".join(words[(i + j) % 5] for j in range(i % 4 + 1)),
+                     metadata={"source": f"file{i}.txt"})
+            for i in range(30)
+        ]
+    
+    def test_shard_for_source_is_stable(self):
+        from sharding import shard_for_source
+        self.assertEqual(shard_for_source("report.pdf", 8), shard_for_source("report.pdf", 8))
+        self.assertTrue(all(0 <= shard_for_source(f"f{i}", 4) < 4 for i in range(50)))
+    
+    def test_sharded_bm25_matches_single_index_ranking(self):
+        from sharding import ShardedBM25, shard_for_source
+        docs = self._docs()
+        groups = {}
+        for doc in docs:
+            groups.setdefault(shard_for_source(doc.metadata["source"], 3), []).append(doc)
+        shards = {}
+        for shard, shard_docs in groups.items():
+            shards[shard] = BM25Index()
+            shards[shard].fit(shard_docs)
+        sharded = ShardedBM25(shards)
+        
+        results = sharded.search("omega alpha", k=5)
+        self.assertEqual(len(results), 5)
+        scores = [score for _, score in results]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        
+        # Candidate positions address the concatenated shard documents
+        candidates = [i for i, doc in enumerate(sharded.documents) if doc.metadata["source"] in ("file3.txt", "file9.txt")]
+        sources = {doc.metadata["source"] for doc, _ in sharded.search("omega", k=5, candidates=candidates)}
+        self.assertEqual(sources, {"file3.txt", "file9.txt"})
+    
+    def test_sharded_vector_store_merges_by_distance(self):
+        from langchain_community.vectorstores import FAISS
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        from sharding import ShardedVectorStore
+        docs = self._docs()
+        embeddings = DeterministicFakeEmbedding(size=16)
+        single = FAISS.from_documents(docs, embeddings)
+        sharded = ShardedVectorStore({
+            0: FAISS.from_documents(docs[:10], embeddings),
+            1: FAISS.from_documents(docs[10:], embeddings),
+        })
+        query = docs[12].page_content
+        expected = [score for _, score in single.similarity_search_with_score(query, k=4)]
+        actual = [score for _, score in sharded.similarity_search_with_score(query, k=4)]
+        self.assertEqual(len(sharded.docstore._dict), len(docs))
+        self.assertEqual([round(s, 4) for s in actual], [round(s, 4) for s in expected])
+
+
+class TestDeltaSegments(unittest.TestCase):
+    """Test append-only delta segments and the compaction policy."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_deltas_are_listed_in_write_order(self):
+        from langchain_community.vectorstores import FAISS
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        from segments import delta_contents, list_delta_paths, remove_deltas, write_delta
+        embeddings = DeterministicFakeEmbedding(size=8)
+        for i in range(11):
+            write_delta(FAISS.from_texts([f"chunk {i}"], embeddings, metadatas=[{"source": f"f{i}.txt"}]), self.temp_dir)
+        paths = list_delta_paths(self.temp_dir)
+        self.assertEqual([os.path.basename(p) for p in paths[-2:]], ["delta_000010", "delta_000011"])
+        
+        items, metadatas = delta_contents(FAISS.load_local(paths[-1], embeddings, allow_dangerous_deserialization=True))
+        self.assertEqual(items[0][0], "chunk 10")
+        self.assertEqual([round(float(x), 4) for x in items[0][1]],
+                         [round(x, 4) for x in embeddings.embed_query("chunk 10")])
+        self.assertEqual(metadatas, [{"source": "f10.txt"}])
+        
+        remove_deltas(paths)
+        self.assertEqual(list_delta_paths(self.temp_dir), [])
+    
+    def test_needs_compaction(self):
+        from segments import needs_compaction
+        config = {"delta_compaction_segments": 3, "delta_compaction_ratio": 0.1}
+        self.assertFalse(needs_compaction(1000, [], config))
+        self.assertFalse(needs_compaction(1000, [10, 20], config))
+        self.assertTrue(needs_compaction(1000, [10, 20, 5], config))
+        self.assertTrue(needs_compaction(1000, [100], config))
+        self.assertTrue(needs_compaction(1000, [1], {"delta_compaction_segments": 0}))
+
+
+class TestDocumentRemoval(unittest.TestCase):
+    """Test removing files from the index and syncing it with a directory."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.config = {"db_path": os.path.join(self.temp_dir, "index"), "use_hybrid_search": True}
+    
+    def tearDown(self):
+        import backend
+        backend._index_holder("removal-test", self.config).swap(None)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_remove_documents_keeps_shared_chunks(self):
+        from unittest import mock
+        from langchain_community.vectorstores import FAISS
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        import backend
+        from segments import list_delta_paths, write_delta
+        embeddings = DeterministicFakeEmbedding(size=8)
+        db_path = self.config["db_path"]
+        main = FAISS.from_texts(["a one", "a two", "b one", "shared"], embeddings, metadatas=[
+            {"source": "a.txt"}, {"source": "a.txt"}, {"source": "b.txt"},
+            {"source": "a.txt", "sources": ["a.txt", "b.txt"]},
+        ])
+        main.save_local(db_path)
+        write_delta(FAISS.from_texts(["a three", "c one"], embeddings,
+                                     metadatas=[{"source": "a.txt"}, {"source": "c.txt"}]), db_path)
+        
+        with mock.patch.object(backend, "get_collection_config", return_value=self.config):
+            self.assertEqual(backend.remove_documents(["a.txt"], "removal-test"), 3)
+        self.assertEqual(list_delta_paths(db_path), [])  # Merged into the rewritten store
+        stored = FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
+        docs = {doc.page_content: doc.metadata for doc in stored.docstore._dict.values()}
+        self.assertEqual(sorted(docs), ["b one", "c one", "shared"])
+        self.assertEqual(docs["shared"]["source"], "b.txt")
+        self.assertEqual(sorted(doc.page_content for doc in BM25Index.load(backend.get_bm25_path(db_path)).documents),
+                         ["b one", "c one", "shared"])
+        # Vectors stay with their chunks
+        for i, docstore_id in stored.index_to_docstore_id.items():
+            text = stored.docstore.search(docstore_id).page_content
+            self.assertEqual([round(float(x), 4) for x in stored.index.reconstruct(i)],
+                             [round(x, 4) for x in embeddings.embed_query(text)])
+    
+    def test_sync_directory_decides_per_file(self):
+        import time
+        from unittest import mock
+        import backend
+        directory = os.path.join(self.temp_dir, "uploads")
+        os.makedirs(directory)
+        for name in ("new.txt", "edited.txt", "same.txt", "upload.bin.1234.part"):
+            with open(os.path.join(directory, name), "w") as f:
+                f.write("text")
+        past, future = time.time() - 60, time.time() + 60
+        generation = mock.Mock()
+        generation.get_sources.return_value = [
+            {"source": "edited.txt", "full_path": os.path.join(directory, "edited.txt"), "ingested_at": past},
+            {"source": "elsewhere.txt", "full_path": "/somewhere/else/elsewhere.txt", "ingested_at": past},
+            {"source": "gone.txt", "full_path": os.path.join(directory, "gone.txt"), "ingested_at": past},
+            {"source": "same.txt", "full_path": os.path.join(directory, "same.txt"), "ingested_at": future},
+        ]
+        with mock.patch.object(backend, "get_active_index", return_value=generation), \
+                mock.patch.object(backend, "remove_documents") as remove, \
+                mock.patch.object(backend, "ingest_files", return_value={"results": []}) as ingest:
+            result = backend.sync_directory(directory)
+        self.assertEqual(result["ingested"], ["edited.txt", "new.txt"])
+        self.assertEqual(result["removed"], ["gone.txt"])
+        self.assertEqual(sorted(remove.call_args[0][0]), ["edited.txt", "gone.txt"])
+        self.assertEqual(len(ingest.call_args[0][0]), 2)
+    
+    def test_sync_directory_follows_upload_targets(self):
+        from unittest import mock
+        import backend
+        directory = os.path.join(self.temp_dir, "uploads")
+        os.makedirs(directory)
+        for name in ("to_x.txt", "claimed.txt", "plain.txt"):
+            with open(os.path.join(directory, name), "w") as f:
+                f.write("text")
+        backend.record_upload(os.path.join(directory, "to_x.txt"), "x")
+        backend.claim_files([os.path.join(directory, "claimed.txt")], "y")
+        generation = mock.Mock()
+        generation.get_sources.return_value = []
+        with mock.patch.object(backend, "get_collection_config", return_value=self.config), \
+                mock.patch.object(backend, "get_active_index", return_value=generation), \
+                mock.patch.object(backend, "ingest_files", return_value={"results": []}) as ingest:
+            backend.sync_directory(directory, {"to_x.txt", "claimed.txt", "plain.txt"})
+            calls = {collection: [os.path.basename(path) for path in paths] for (paths, collection), _ in ingest.call_args_list}
+            self.assertEqual(calls, {"x": ["to_x.txt"], None: ["plain.txt"]})
+            
+            ingest.reset_mock()
+            backend.release_files([os.path.join(directory, "claimed.txt")])
+            os.utime(os.path.join(directory, "claimed.txt"))
+            backend.sync_directory(directory, {"claimed.txt"})
+            ingest.assert_called_once_with([os.path.join(directory, "claimed.txt")], "y")
+        
+        os.remove(os.path.join(directory, "to_x.txt"))
+        with mock.patch.object(backend, "get_collection_config", return_value=self.config), \
+                mock.patch.object(backend, "get_active_index", return_value=generation):
+            backend.sync_directory(directory, {"to_x.txt"})
+        self.assertNotIn(os.path.join(directory, "to_x.txt"), backend._upload_targets)  # Forgotten once deleted
+
+
+class TestDirectoryWatcher(unittest.TestCase):
+    """Test debounced, coalesced change notification."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _watch(self, poll: bool):
+        import queue
+        import time
+        import watcher
+        batches = queue.Queue()
+        w = watcher.DirectoryWatcher(self.temp_dir, batches.put, debounce=0.3, max_delay=5, poll_interval=0.1)
+        if poll:
+            w._source = watcher._Poller(w.directory, w.poll_interval)
+        w.start(initial_scan=False)
+        try:
+            time.sleep(0.2)
+            for i in range(50):
+                with open(os.path.join(self.temp_dir, f"doc{i}.txt"), "w") as f:
+                    f.write("x")
+            with open(os.path.join(self.temp_dir, "big.bin.abc.part"), "w") as f:
+                f.write("partial upload")
+            self.assertEqual(batches.get(timeout=5), {f"doc{i}.txt" for i in range(50)})
+            os.remove(os.path.join(self.temp_dir, "doc0.txt"))
+            self.assertEqual(batches.get(timeout=5), {"doc0.txt"})
+            self.assertTrue(batches.empty())
+        finally:
+            w.stop()
+    
+    def test_burst_is_one_batch(self):
+        self._watch(poll=False)  # inotify on Linux
+    
+    def test_polling_fallback(self):
+        self._watch(poll=True)
+    
+    def test_watch_lock_is_exclusive_per_process(self):
+        import subprocess
+        import watcher
+        self.assertTrue(watcher.acquire_watch_lock(self.temp_dir))
+        code = f"import watcher; print(watcher.acquire_watch_lock({self.temp_dir!r}))"
+        try:
+            other = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            self.assertEqual(other.stdout.strip(), "False")
+        finally:
+            lock_path = f"{os.path.abspath(self.temp_dir)}.watch.lock"
+            watcher._lock_files.pop(lock_path).close()
+            os.remove(lock_path)
+
+
+class TestFileCatalog(unittest.TestCase):
+    """Test the incrementally maintained upload dir listing."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_db_path = switch_db(os.path.join(self.temp_dir, "catalog.db"))
+        init_db()
+        self.uploads = os.path.join(self.temp_dir, "uploads")
+        os.makedirs(self.uploads)
+        for i, name in enumerate(["b.pdf", "a.txt", "c.xlsx"]):
+            self._write(name, "x" * (i + 1), mtime=1000 + i)
+    
+    def tearDown(self):
+        switch_db(self.original_db_path)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _write(self, name, content, mtime=None):
+        path = os.path.join(self.uploads, name)
+        with open(path, "w") as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+    
+    def test_sorting_and_pagination(self):
+        from file_catalog import FileCatalog
+        catalog = FileCatalog(self.uploads)
+        files, total = catalog.list([])
+        self.assertEqual(([f["name"] for f in files], total), (["c.xlsx", "a.txt", "b.pdf"], 3))
+        files, _ = catalog.list([], sort="name", descending=False, offset=1, limit=1)
+        self.assertEqual([f["name"] for f in files], ["b.pdf"])
+        self.assertEqual([f["type"] for f in catalog.list([], sort="type", descending=False)[0]],
+                         ["excel", "pdf", "text"])
+    
+    def test_incremental_updates(self):
+        import database
+        from file_catalog import FileCatalog
+        catalog = FileCatalog(self.uploads)
+        before = {f["name"]: f for f in catalog.list([])[0]}
+        
+        self._write("d.md", "new")
+        os.remove(os.path.join(self.uploads, "b.pdf"))
+        indexed = ["a.txt"]
+        database.set_file_tags("c.xlsx", ["finance"])
+        after = {f["name"]: f for f in catalog.list(indexed)[0]}
+        self.assertEqual(sorted(after), ["a.txt", "c.xlsx", "d.md"])
+        self.assertTrue(after["a.txt"]["indexed"])
+        self.assertEqual(after["c.xlsx"]["tags"], ["finance"])
+        self.assertEqual(before["a.txt"]["modified_at"], after["a.txt"]["modified_at"])
+        
+        # In-place edits don't change the directory: watcher events re-stat them
+        self._write("a.txt", "edited content")
+        self.assertEqual(catalog.list(indexed, sort="size")[0][0]["name"], "c.xlsx")
+        catalog.refresh(["a.txt"])
+        files, _ = catalog.list(indexed, sort="size")
+        self.assertEqual((files[0]["name"], files[0]["size"]), ("a.txt", 14))
+
+
+class TestSourceCatalog(unittest.TestCase):
+    """Test the sources table kept in step with index generations."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_db_path = switch_db(os.path.join(self.temp_dir, "sources.db"))
+        init_db()
+    
+    def tearDown(self):
+        switch_db(self.original_db_path)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_updates_apply_only_in_sequence(self):
+        import database
+        row = {"source": "a.txt", "full_path": "/docs/a.txt", "chunks": 2, "bytes": 10,
+               "ingested_at": 1.0, "content_hash": "h1"}
+        self.assertTrue(database.update_sources("default", 0, 100, added=[row]))
+        self.assertTrue(database.update_sources("default", 100, 200, added=[
+            {**row, "chunks": 3, "ingested_at": 2.0, "content_hash": "h2"},
+            {**row, "source": "b.txt", "chunks": 1}]))
+        sources = database.get_sources("default", 200)
+        self.assertEqual([(s["source"], s["chunks"], s["content_hash"]) for s in sources],
+                         [("a.txt", 5, "h2"), ("b.txt", 1, "h1")])
+        self.assertIsNone(database.get_sources("default", 100))
+        self.assertIsNone(database.get_sources("other", 200))
+        
+        # A write the table missed leaves it behind until it is rebuilt
+        self.assertFalse(database.update_sources("default", 300, 400, removed=["a.txt"]))
+        self.assertIsNone(database.get_sources("default", 400))
+        database.set_sources("default", 400, [{**row, "source": "b.txt"}])
+        self.assertTrue(database.update_sources("default", 400, 500, removed=["b.txt"]))
+        self.assertEqual(database.get_sources("default", 500), [])
+        
+        database.clear_sources("default")
+        self.assertIsNone(database.get_sources("default", 500))
+
+
+class TestKnowledgeGraph(unittest.TestCase):
+    """Test the document-term graph derived from stored term counts."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_db_path = switch_db(os.path.join(self.temp_dir, "graph.db"))
+        init_db()
+    
+    def tearDown(self):
+        import knowledge_graph
+        switch_db(self.original_db_path)
+        knowledge_graph.forget()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _generation(self, disk_generation, rows):
+        from unittest import mock
+        generation = mock.Mock(disk_generation=disk_generation)
+        generation.get_sources.return_value = [{k: v for k, v in row.items() if k != "terms"} for row in rows]
+        return generation
+    
+    def test_document_terms(self):
+        from knowledge_graph import document_terms
+        terms = document_terms("Source: report.pdf\n\nThe quarterly revenue of the 2023 revenue report, Q4")
+        self.assertEqual(terms, {"quarterly": 1, "revenue": 2, "report": 1})
+    
+    def test_graph_pages_and_incremental_updates(self):
+        from unittest import mock
+        import database
+        import knowledge_graph
+        rows = [
+            {"source": "a.txt", "chunks": 1, "ingested_at": 1.0, "terms": {"shared": 5, "apple": 3, "common": 9}},
+            {"source": "b.txt", "chunks": 1, "ingested_at": 1.0, "terms": {"shared": 4, "banana": 2, "common": 9}},
+            {"source": "c.txt", "chunks": 1, "ingested_at": 1.0, "terms": {"cherry": 1, "common": 9}},
+        ]
+        database.set_sources("default", 1, rows)
+        graph = knowledge_graph.get_graph("default", self._generation(1, rows))
+        self.assertEqual(graph["total_documents"], 3)
+        term_ids = {node["id"] for node in graph["nodes"] if node["type"] == "term"}
+        # "common" is in every file; "shared" links two
+        self.assertEqual(term_ids, {"term_shared", "term_apple", "term_banana", "term_cherry"})
+        shared = next(node for node in graph["nodes"] if node["id"] == "term_shared")
+        self.assertEqual(shared["degree"], 2)
+        
+        graph = knowledge_graph.get_graph("default", self._generation(1, rows), min_degree=2)
+        self.assertEqual({node["id"] for node in graph["nodes"] if node["type"] == "term"}, {"term_shared"})
+        graph = knowledge_graph.get_graph("default", self._generation(1, rows), offset=2, limit=1)
+        self.assertEqual([node["label"] for node in graph["nodes"]], ["c.txt", "cherry"])
+        
+        # A new generation re-reads only the files that changed
+        rows = rows[:2] + [{"source": "d.txt", "chunks": 2, "ingested_at": 2.0, "terms": {"date": 1}}]
+        database.set_sources("default", 2, rows)
+        with mock.patch.object(database, "get_source_terms", wraps=database.get_source_terms) as read:
+            graph = knowledge_graph.get_graph("default", self._generation(2, rows))
+        self.assertEqual(read.call_args[0][1], ["d.txt"])
+        labels = {node["label"] for node in graph["nodes"]}
+        self.assertIn("date", labels)
+        self.assertNotIn("cherry", labels)
+
+
+class TestCorpusGraph(unittest.TestCase):
+    """Test the corpus-wide term co-occurrence graph and its clusters."""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _indexes(self):
+        import random
+        from langchain_core.documents import Document
+        rng = random.Random(0)
+        topics = [["kubernetes", "container", "pods", "cluster", "deploy", "helm"],
+                  ["invoice", "payment", "tax", "revenue", "budget", "ledger"]]
+        indexes, sources = [], []
+        for shard in range(2):
+            docs = []
+            for i in range(60):
+                words = rng.choices(topics[i % 2], k=12) + rng.choices(["notes", "misc", "general"], k=3)
+                source = f"{'ops' if i % 2 == 0 else 'finance'}{i % 3}.txt"
+                docs.append(Document(page_content=" ".join(words), metadata={"source": source}))
+                sources.append(source)
+            index = BM25Index()
+            index.fit(docs)
+            indexes.append(index)
+        return indexes, sources, topics
+    
+    def test_topics_become_clusters(self):
+        import corpus_graph
+        indexes, sources, topics = self._indexes()
+        graph = corpus_graph.build_corpus_graph(indexes, sources, {"corpus_graph_min_cooccurrence": 2})
+        self.assertEqual(graph["chunks"], 120)
+        clusters = {frozenset(cluster["top_terms"]): cluster for cluster in graph["clusters"]}
+        self.assertEqual(set(clusters), {frozenset(topic) for topic in topics})
+        ops = clusters[frozenset(topics[0])]
+        self.assertEqual(ops["chunks"], 60)
+        self.assertEqual({f["source"] for f in ops["files"]}, {"ops0.txt", "ops1.txt", "ops2.txt"})
+        self.assertTrue(all(edge["source"] in topics[0] and edge["target"] in topics[0] for edge in ops["edges"]))
+        
+        overview = corpus_graph.summary(graph)
+        self.assertNotIn("terms", overview["clusters"][0])
+        self.assertNotIn("edges", overview["clusters"][0])
+        self.assertIn("terms", graph["clusters"][0])
+    
+    def test_save_and_load(self):
+        import corpus_graph
+        self.assertIsNone(corpus_graph.load_corpus_graph(self.temp_dir))
+        indexes, sources, _ = self._indexes()
+        graph = corpus_graph.build_corpus_graph(indexes, sources, {})
+        corpus_graph.save_corpus_graph(self.temp_dir, {**graph, "signature": "abc"})
+        loaded = corpus_graph.load_corpus_graph(self.temp_dir)
+        self.assertEqual(loaded["signature"], "abc")
+        self.assertEqual(len(loaded["clusters"]), len(graph["clusters"]))
+    
+    def test_empty_corpus(self):
+        import corpus_graph
+        graph = corpus_graph.build_corpus_graph([], [], {})
+        self.assertEqual((graph["chunks"], graph["clusters"], graph["links"]), (0, [], []))
 
 
 class TestConfigManager(unittest.TestCase):
@@ -178,16 +1568,34 @@ class TestDatabase(unittest.TestCase):
     
     def setUp(self):
         # Use a separate test database
-        import database
-        self.original_db_path = database.DB_PATH
-        database.DB_PATH = "test_chat_history.db"
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_db_path = switch_db(os.path.join(self.temp_dir, "test_chat_history.db"))
         init_db()
     
     def tearDown(self):
+        switch_db(self.original_db_path)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_vision_description_cache_evicts_least_recently_used(self):
         import database
-        if os.path.exists("test_chat_history.db"):
-            os.remove("test_chat_history.db")
-        database.DB_PATH = self.original_db_path
+        database.save_vision_description("img1", "moondream", "p", "A red square", max_entries=2)
+        database.save_vision_description("img2", "moondream", "p", "A blue circle", max_entries=2)
+        self.assertEqual(database.get_vision_description("img1", "moondream", "p"), "A red square")
+        database.save_vision_description("img3", "moondream", "p", "A green line", max_entries=2)
+        self.assertIsNone(database.get_vision_description("img2", "moondream", "p"))
+        self.assertEqual(database.get_vision_description("img1", "moondream", "p"), "A red square")
+        self.assertIsNone(database.get_vision_description("img1", "llava", "p"))
+    
+    def test_described_images_skip_the_vision_model(self):
+        from unittest import mock
+        import vision
+        image = vision.PreparedImage(b"jpeg bytes", "image/jpeg", f"digest-{os.getpid()}-{id(self)}")
+        with mock.patch.object(vision, "ChatOllama") as chat:
+            chat.return_value.invoke.return_value.content = "A cat sitting on a red sofa."
+            first = vision.describe_image(image, {"vision_model": "moondream"})
+            second = vision.describe_image(image, {"vision_model": "moondream"})
+        self.assertEqual(first, second)
+        self.assertEqual(chat.return_value.invoke.call_count, 1)
     
     def test_create_session(self):
         """Test creating a chat session."""
@@ -270,6 +1678,127 @@ class TestDatabase(unittest.TestCase):
         self.assertGreaterEqual(len(sessions), 3)
 
 
+class TestSharedState(unittest.TestCase):
+    """Test the SQLite-backed state shared by server worker processes."""
+    
+    def setUp(self):
+        from database import SharedStateDict
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_db_path = switch_db(os.path.join(self.temp_dir, "state.db"))
+        init_db()
+        self.state = SharedStateDict("test_namespace")
+    
+    def tearDown(self):
+        switch_db(self.original_db_path)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_set_get_delete(self):
+        """Test dict-style access round-trips JSON values."""
+        self.state["task-1"] = {"status": "processing"}
+        self.assertIn("task-1", self.state)
+        self.assertEqual(self.state["task-1"], {"status": "processing"})
+        self.assertEqual(len(self.state), 1)
+        
+        self.state["task-1"] = {"status": "completed"}
+        self.assertEqual(self.state.get("task-1")["status"], "completed")
+        
+        del self.state["task-1"]
+        self.assertIsNone(self.state.get("task-1"))
+        with self.assertRaises(KeyError):
+            del self.state["task-1"]
+    
+    def test_pop_returns_value_once(self):
+        """Test that only the first pop of an entry gets it (concurrent confirmations)."""
+        self.state["7"] = {"id": "action-1"}
+        self.assertEqual(self.state.pop(7, None), {"id": "action-1"})
+        self.assertIsNone(self.state.pop(7, None))
+        with self.assertRaises(KeyError):
+            self.state.pop(7)
+    
+    def test_integer_keys_are_normalized(self):
+        """Test that int and str session IDs address the same entry."""
+        self.state[42] = {"tool": "delete_document"}
+        self.assertEqual(self.state["42"]["tool"], "delete_document")
+    
+    def test_purge_older_than(self):
+        """Test TTL cleanup of stale entries."""
+        self.state["fresh"] = {"timestamp": 1}
+        self.assertEqual(self.state.purge_older_than(300), 0)
+        self.assertEqual(self.state.purge_older_than(-1), 1)
+        self.assertEqual(len(self.state), 0)
+
+
+class TestLogging(unittest.TestCase):
+    """Test the payload sampling helper used on hot paths."""
+    
+    def test_log_payload_skipped_when_disabled(self):
+        """Test that the payload is not even formatted when the level is disabled."""
+        import logging
+        from logging_config import log_payload
+        
+        class Unformattable:
+            def __str__(self):
+                raise AssertionError("payload should not be formatted")
+        
+        test_logger = logging.getLogger("RAG_Agent.test_disabled")
+        test_logger.setLevel(logging.INFO)
+        log_payload(test_logger, "prompt", Unformattable())
+    
+    def test_log_payload_sampling_and_truncation(self):
+        """Test that only 1 in N payloads is logged in full (truncated)."""
+        import logging
+        import logging_config
+        
+        test_logger = logging.getLogger("RAG_Agent.test_sampling")
+        test_logger.setLevel(logging.DEBUG)
+        with self.assertLogs(test_logger, level=logging.DEBUG) as captured:
+            for _ in range(logging_config.PAYLOAD_SAMPLE_EVERY):
+                logging_config.log_payload(test_logger, "sampling-test", "y" * (logging_config.PAYLOAD_MAX_CHARS + 50))
+        
+        full = [r for r in captured.output if "more chars" in r]
+        sampled_out = [r for r in captured.output if "sampled out" in r]
+        self.assertEqual(len(full), 1)
+        self.assertEqual(len(sampled_out), logging_config.PAYLOAD_SAMPLE_EVERY - 1)
+    
+    def test_module_level_below_global_level(self):
+        """Test that a per-module DEBUG override is written with a global INFO level."""
+        import logging
+        import logging_config
+        
+        log_dir = tempfile.mkdtemp()
+        try:
+            logging_config.setup_logging(log_dir=log_dir, level=logging.INFO,
+                                         module_levels={"RAG_Agent.test_override": "DEBUG"})
+            logging.getLogger("RAG_Agent.test_override").debug("override debug line")
+            logging.getLogger("RAG_Agent.test_other").debug("other debug line")
+            logging_config.stop_logging()
+            with open(os.path.join(log_dir, "app.log"), encoding="utf-8") as f:
+                written = f.read()
+            self.assertIn("override debug line", written)
+            self.assertNotIn("other debug line", written)
+        finally:
+            logging_config.stop_logging()
+            logging.getLogger().handlers.clear()
+            logging.getLogger("RAG_Agent.test_override").setLevel(logging.NOTSET)
+            shutil.rmtree(log_dir, ignore_errors=True)
+    
+    def test_payloads_can_be_cut_to_nothing(self):
+        """Test that payload_max_chars=0 is applied, not taken as unset."""
+        import logging
+        import logging_config
+        
+        log_dir = tempfile.mkdtemp()
+        previous = logging_config.PAYLOAD_MAX_CHARS
+        try:
+            logging_config.setup_logging(log_dir=log_dir, payload_max_chars=0)
+            self.assertEqual(logging_config.PAYLOAD_MAX_CHARS, 0)
+        finally:
+            logging_config.PAYLOAD_MAX_CHARS = previous
+            logging_config.stop_logging()
+            logging.getLogger().handlers.clear()
+            shutil.rmtree(log_dir, ignore_errors=True)
+
+
 class TestHealthCheck(unittest.TestCase):
     """Test health check functionality."""
     
@@ -305,6 +1834,27 @@ class TestIngestion(unittest.TestCase):
         success, msg = ingest_files(["/nonexistent/file.txt"])
         self.assertFalse(success)
         self.assertIn("Error", msg)
+    
+    def test_batches_are_indexed_in_larger_steps(self):
+        """Test that embedded batches are written to the index every ingest_publish_chunks, not per batch."""
+        from unittest import mock
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        import backend
+        with open(self.test_file, "w") as f:
+            f.write("\n\n".join(f"Paragraph {i} has words of its own: {'w%d ' % i * 12}" for i in range(40)))
+        config = dict(load_config(), db_path=os.path.join(self.temp_dir, "index"), chunk_size=100, chunk_overlap=0,
+                      ingest_batch_chunks=4, ingest_publish_chunks=10, dedup_chunks=False,
+                      parsed_cache_dir=os.path.join(self.temp_dir, "parsed_cache"))
+        with mock.patch.object(backend, "get_collection_config", return_value=config), \
+                mock.patch.object(backend, "load_config", return_value=config), \
+                mock.patch.object(backend, "OllamaEmbeddings", lambda **kwargs: DeterministicFakeEmbedding(size=8)), \
+                mock.patch.object(backend, "_index_chunks") as index_chunks:
+            result = backend.ingest_files([self.test_file])
+        self.assertTrue(result["success"])
+        published = [len(call.args[0]) for call in index_chunks.call_args_list]
+        self.assertGreater(len(published), 1)
+        self.assertTrue(all(10 <= size < 14 for size in published[:-1]))
+        self.assertEqual(sum(published), 40)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+"""
+Token counting for chunk sizing and prompt budgets.
+
+Context windows are measured in tokens, so chunk sizes and the retrieved
+context in a prompt can be too. tiktoken is used when installed (a fast
+local BPE tokenizer); otherwise a regex estimate stands in: one token per
+punctuation mark and per started 6 characters of a word (common English
+words are single BPE tokens, long and rare words split into pieces).
+
+Ingest stores each chunk's count as "token_count" metadata, so prompt
+assembly can pack retrieved chunks into a token budget without
+re-tokenizing them per query.
+"""
+
+import logging
+import re
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+logger = logging.getLogger("RAG_Agent.token_counter")
+
+DEFAULT_ENCODING = "cl100k_base"
+
+_WORD_PIECES = re.compile(r"\w{1,6}|[^\w\s]")
+
+# Splitters measure the same separators and short pieces repeatedly while
+# merging them into chunks; only those are cached (chunk-sized texts would
+# pin hundreds of MB for the life of the process)
+CACHED_PIECE_CHARS = 256
+CACHED_PIECES = 4096
+
+
+def approximate_token_count(text: str) -> int:
+    """Dependency-free token estimate (see module docstring)."""
+    return len(_WORD_PIECES.findall(text))
+
+
+@lru_cache(maxsize=8)
+def get_token_counter(tokenizer: str = "auto") -> Callable[[str], int]:
+    """
+    Token counting function for a tokenizer setting:
+    "auto" (tiktoken if installed, else approximate), "approximate",
+    or a tiktoken encoding name such as "cl100k_base".
+    """
+    count = approximate_token_count
+    if tokenizer != "approximate":
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding(DEFAULT_ENCODING if tokenizer == "auto" else tokenizer)
+
+            def count_tiktoken(text: str) -> int:
+                return len(encoding.encode_ordinary(text))
+            count = count_tiktoken
+        except ImportError:
+            if tokenizer != "auto":
+                logger.warning("tiktoken is not installed; using approximate token counts")
+        except Exception as e:
+            logger.warning("Unknown tokenizer %s (%s); using approximate token counts", tokenizer, e)
+    return _cache_short_pieces(count)
+
+
+def _cache_short_pieces(count: Callable[[str], int]) -> Callable[[str], int]:
+    cached = lru_cache(maxsize=CACHED_PIECES)(count)
+
+    def counter(text: str) -> int:
+        return cached(text) if len(text) <= CACHED_PIECE_CHARS else count(text)
+    counter.cache_info = cached.cache_info
+    return counter
+
+
+def count_tokens(text: str, config: Optional[dict] = None) -> int:
+    return get_token_counter((config or {}).get("tokenizer", "auto"))(text)
+
+
+def document_tokens(doc, counter: Callable[[str], int]) -> int:
+    """A chunk's token count from its metadata, counted only for chunks indexed without one."""
+    token_count = doc.metadata.get("token_count")
+    return token_count if isinstance(token_count, int) else counter(doc.page_content)
+
+
+def pack_documents(docs: List, budget: int, counter: Callable[[str], int], overhead: int = 8) -> List:
+    """
+    Keep retrieved documents, in rank order, while they fit in budget tokens.
+    A document that doesn't fit is skipped so smaller, lower-ranked ones can
+    still use the remaining space. overhead: per-document formatting tokens.
+    """
+    if budget <= 0:
+        return list(docs)
+    packed, used = [], 0
+    for doc in docs:
+        cost = document_tokens(doc, counter) + overhead
+        if used + cost <= budget:
+            packed.append(doc)
+            used += cost
+    if docs and not packed:
+        logger.debug("No retrieved chunk fits in %d tokens; keeping the best one", budget)
+        packed = [docs[0]]
+    return packed
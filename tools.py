@@ -2,7 +2,7 @@ import os
 import json
 import logging
 from security import SAFE_ROOT, is_safe_path
-from backend import ingest_files
+from backend import ingest_files, claim_files, release_files
 
 logger = logging.getLogger(__name__)
 
@@ -35,7 +35,11 @@ def ingest_document(filename):
         # Ingest just this file
         # We might need to refactor backend.ingest_files to handle single list
         # Currently ingest_files takes 'file_paths' list
-        result = ingest_files([filepath])
+        claim_files([filepath])  # Not synced by the upload dir watcher meanwhile
+        try:
+            result = ingest_files([filepath])
+        finally:
+            release_files([filepath])
         if result:
             return json.dumps({"status": "success", "message": f"Successfully ingested {filename}"})
         else:
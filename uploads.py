@@ -0,0 +1,250 @@
+"""
+Writing uploaded files to disk.
+
+Uploads are copied to disk in fixed-size chunks instead of being read into
+memory whole, and written under a temporary name first, so a file in the
+upload dir is never partial (ingest or a preview may read it at any
+time).
+
+Large files can be uploaded resumably, in byte ranges over several requests:
+
+    create_upload()   reserve an upload ID for a file name and size
+    write_range()     write one range (a retried range may overlap)
+    get_upload()      the bytes received so far, to resume from after a failure
+    commit_upload()   verify size and SHA-256, move the file into the upload dir
+
+The ranges are written to a part file in "upload_sessions_dir" and the
+upload's metadata is kept in SQLite (database.SharedStateDict), so every
+server worker can take any request of an upload. Uploads idle for longer
+than "upload_session_ttl_hours" are deleted.
+"""
+
+import base64
+import binascii
+import hashlib
+import itertools
+import logging
+import os
+import re
+import time
+import uuid
+from typing import BinaryIO, Optional, Tuple
+
+from database import SharedStateDict
+
+logger = logging.getLogger("RAG_Agent.uploads")
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+_UPLOAD_ID = re.compile(r"[0-9a-f]{32}")
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+# {upload_id: {"filename", "size", "sha256", "collection", "ingest", "created"}}
+_uploads = SharedStateDict("uploads")
+
+
+class UploadError(Exception):
+    """A resumable upload request that can't be applied, with the HTTP status to answer."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def _tmp_path(path: str) -> str:
+    return f"{path}.{uuid.uuid4().hex}.part"
+
+
+def stream_to_file(stream: BinaryIO, path: str, chunk_size: int = UPLOAD_CHUNK_SIZE) -> int:
+    """Copy a binary stream to path chunk by chunk. Returns the number of bytes written."""
+    tmp_path = _tmp_path(path)
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            while chunk := stream.read(chunk_size):
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
+
+
+def base64_to_file(data: str, path: str, chunk_size: int = UPLOAD_CHUNK_SIZE) -> int:
+    """
+    Decode base64 (optionally a data URL) straight into a file, a slice at a
+    time, so the decoded bytes never exist in memory all at once.
+    Returns the number of bytes written.
+    """
+    start = data.find(",", 0, 256) + 1  # After a "data:...;base64," header, if any
+    step = chunk_size // 3 * 4  # Whole 4-character groups
+    tmp_path = _tmp_path(path)
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for offset in range(start, len(data), step):
+                chunk = base64.b64decode(data[offset:offset + step])
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, path)
+    except (binascii.Error, ValueError) as e:
+        os.remove(tmp_path)
+        raise ValueError(f"Invalid base64 data: {e}")
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
+
+
+def publish_file(tmp_path: str, directory: str, filename: str) -> str:
+    """
+    Move a complete file into directory as filename, or filename_1,
+    filename_2, ... if that name is taken. Returns the name used.
+    """
+    base_name, ext = os.path.splitext(filename)
+    for counter in itertools.count():
+        name = f"{base_name}_{counter}{ext}" if counter else filename
+        path = os.path.join(directory, name)
+        try:
+            # Unlike a rename, fails if the name is taken: no check-then-write race
+            os.link(tmp_path, path)
+        except FileExistsError:
+            continue
+        except OSError:  # No hard links (FAT, some network filesystems)
+            if os.path.exists(path):
+                continue
+            os.replace(tmp_path, path)
+            return name
+        os.remove(tmp_path)
+        return name
+
+
+def save_upload(stream: BinaryIO, directory: str, filename: str,
+                chunk_size: int = UPLOAD_CHUNK_SIZE) -> Tuple[str, int]:
+    """Stream an upload into directory under a free name. Returns (name used, size)."""
+    tmp_path = _tmp_path(os.path.join(directory, filename))
+    size = stream_to_file(stream, tmp_path, chunk_size)
+    try:
+        return publish_file(tmp_path, directory, filename), size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def parse_content_range(header: str) -> Tuple[int, int, Optional[int]]:
+    """(first byte, last byte, total size or None) of a "bytes first-last/total" header."""
+    match = _CONTENT_RANGE.fullmatch(header.strip())
+    if not match or int(match.group(2)) < int(match.group(1)):
+        raise UploadError(f"Invalid Content-Range: {header}")
+    total = None if match.group(3) == "*" else int(match.group(3))
+    return int(match.group(1)), int(match.group(2)), total
+
+
+def _part_path(upload_id: str, config: dict) -> str:
+    return os.path.join(config.get("upload_sessions_dir", "upload_sessions"), f"{upload_id}.part")
+
+
+def _expire_uploads(config: dict):
+    """Delete uploads without a write for upload_session_ttl_hours."""
+    cutoff = time.time() - config.get("upload_session_ttl_hours", 24) * 3600
+    for upload_id in list(_uploads):
+        path = _part_path(upload_id, config)
+        try:
+            expired = os.path.getmtime(path) < cutoff
+        except OSError:
+            expired = True  # Part file gone: the upload can't be resumed
+        if expired:
+            logger.info("Expiring idle upload %s", upload_id)
+            abort_upload(upload_id, config)
+
+
+def create_upload(filename: str, size: int, config: dict, sha256: Optional[str] = None,
+                  collection: Optional[str] = None, ingest: bool = False) -> dict:
+    """Start a resumable upload of size bytes. Returns its state, including "upload_id"."""
+    if size < 0:
+        raise UploadError("size must be non-negative")
+    if sha256 is not None and not re.fullmatch(r"[0-9a-fA-F]{64}", sha256):
+        raise UploadError("sha256 must be 64 hex digits")
+    _expire_uploads(config)
+    upload_id = uuid.uuid4().hex
+    path = _part_path(upload_id, config)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    state = {"filename": filename, "size": size, "sha256": sha256 and sha256.lower(),
+             "collection": collection, "ingest": ingest, "created": time.time()}
+    _uploads[upload_id] = state
+    logger.info("Upload %s started: %s (%d bytes)", upload_id, filename, size)
+    return {**state, "upload_id": upload_id, "offset": 0}
+
+
+def get_upload(upload_id: str, config: dict) -> dict:
+    """An upload's state; "offset" is the number of bytes received, where to resume."""
+    try:
+        state = _uploads[upload_id] if _UPLOAD_ID.fullmatch(upload_id) else None
+        offset = os.path.getsize(_part_path(upload_id, config)) if state else 0
+    except (KeyError, OSError):
+        state = None
+    if state is None:
+        raise UploadError("Unknown or expired upload", 404)
+    return {**state, "upload_id": upload_id, "offset": offset}
+
+
+def write_range(upload_id: str, stream: BinaryIO, start: int, config: dict,
+                chunk_size: int = UPLOAD_CHUNK_SIZE) -> int:
+    """
+    Write the bytes of stream to an upload from byte start on. start may be
+    before the current offset (a retried range) but not after it. Returns the
+    new offset.
+    """
+    state = get_upload(upload_id, config)
+    if start > state["offset"]:
+        raise UploadError(f"Range starts at {start}, but only {state['offset']} bytes were received", 409)
+    remaining = state["size"] - start
+    with open(_part_path(upload_id, config), "r+b") as f:
+        f.seek(start)
+        while chunk := stream.read(min(chunk_size, remaining + 1)):
+            if len(chunk) > remaining:
+                f.write(chunk[:remaining])
+                raise UploadError(f"Upload is larger than its declared size of {state['size']} bytes", 413)
+            f.write(chunk)
+            remaining -= len(chunk)
+        return max(f.tell(), state["offset"])
+
+
+def commit_upload(upload_id: str, directory: str, config: dict,
+                  sha256: Optional[str] = None) -> dict:
+    """
+    Finish an upload: check that all bytes arrived and their SHA-256 matches
+    (the one given here or at create_upload), then move the file into
+    directory. Returns the upload's state with the "name" used and "sha256".
+    A hash mismatch discards the received bytes.
+    """
+    state = get_upload(upload_id, config)
+    if state["offset"] != state["size"]:
+        raise UploadError(f"Upload incomplete: {state['offset']} of {state['size']} bytes received", 409)
+    path = _part_path(upload_id, config)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(UPLOAD_CHUNK_SIZE):
+            digest.update(block)
+    expected = (sha256 or state["sha256"] or "").lower()
+    if expected and digest.hexdigest() != expected:
+        os.truncate(path, 0)
+        raise UploadError("SHA-256 mismatch: the upload was corrupted, send it again", 422)
+    name = publish_file(path, directory, state["filename"])
+    del _uploads[upload_id]
+    logger.info("Upload %s committed as %s", upload_id, name)
+    return {**state, "upload_id": upload_id, "name": name, "sha256": digest.hexdigest()}
+
+
+def abort_upload(upload_id: str, config: dict):
+    """Delete an upload and the bytes received."""
+    _uploads.pop(upload_id, None)
+    try:
+        os.remove(_part_path(upload_id, config))
+    except OSError:
+        pass
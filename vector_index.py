@@ -0,0 +1,456 @@
+"""
+FAISS index construction and tuning for large corpora.
+
+LangChain's FAISS store always builds an exact IndexFlatL2. This module swaps
+in approximate nearest-neighbour (ANN) indexes once the corpus is big enough:
+
+- ivf_flat: inverted lists over k-means cells, exact vectors inside a cell
+- hnsw:     graph search, no training, highest recall per ms, most RAM
+- ivf_pq:   inverted lists + product-quantized codes, smallest RAM footprint
+
+Independently, "vector_compression" stores int8 scalar-quantized (sq8) or
+PQ codes instead of float32 vectors. The exact vectors are kept in a
+memory-mapped file (vectors.f32) and only the top candidates are re-scored
+against them, so RAM holds the compact codes and recall stays close to exact.
+
+Vector ids (0..n-1) are preserved on conversion, so the store's
+index_to_docstore_id mapping stays valid.
+"""
+
+import json
+import logging
+import math
+import os
+import time
+from typing import List, Optional
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger("RAG_Agent.vector_index")
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+COMPRESSION_TYPES = ("none", "sq8", "pq")
+ANN_REPORT_FILE = "ann_report.json"
+VECTORS_FILE = "vectors.f32"  # Raw float32 rows, in vector-id order
+
+# faiss warns below ~39 training points per k-means centroid
+MIN_POINTS_PER_CENTROID = 39
+PQ_CODEBOOK_SIZE = 256  # 8-bit PQ codes
+
+
+class RescoredIndex:
+    """
+    Wraps a compressed FAISS index for querying: fetches rerank_factor * k
+    candidates from the codes, then re-ranks them by exact L2 distance to the
+    float32 vectors (memory-mapped, so only touched rows are paged in).
+
+    Duck-types the parts of faiss.Index that LangChain's FAISS store uses for
+    search; anything else is delegated to the wrapped index. Never saved.
+    """
+
+    def __init__(self, index: faiss.Index, vectors: np.ndarray, rerank_factor: int):
+        self.index = index
+        self.vectors = vectors
+        self.rerank_factor = rerank_factor
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def search(self, x, k, params=None):
+        fetch_k = min(k * self.rerank_factor, self.index.ntotal)
+        _, candidates = self.index.search(x, fetch_k, params=params)
+        distances = np.full((len(x), k), np.inf, dtype="float32")
+        labels = np.full((len(x), k), -1, dtype="int64")
+        for row, (query, ids) in enumerate(zip(x, candidates)):
+            ids = ids[ids >= 0]
+            exact = ((self.vectors[ids] - query) ** 2).sum(axis=1)
+            order = np.argsort(exact)[:k]
+            distances[row, :len(order)] = exact[order]
+            labels[row, :len(order)] = ids[order]
+        return distances, labels
+
+
+def _unwrap(index):
+    return index.index if isinstance(index, RescoredIndex) else index
+
+
+def describe_index(index: faiss.Index) -> str:
+    """Return the INDEX_TYPES name of a FAISS index."""
+    index = _unwrap(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    ivf = _extract_ivf(index)
+    if ivf is not None:
+        return "ivf_pq" if isinstance(ivf, faiss.IndexIVFPQ) else "ivf_flat"
+    return "flat"
+
+
+def describe_compression(index: faiss.Index) -> str:
+    """Return the COMPRESSION_TYPES name of the codes a FAISS index stores."""
+    index = _unwrap(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    ivf = _extract_ivf(index)
+    if ivf is not None:
+        index = ivf
+    if isinstance(index, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "sq8"
+    return "none"
+
+
+def _extract_ivf(index: faiss.Index):
+    try:
+        return faiss.downcast_index(faiss.extract_index_ivf(index))
+    except RuntimeError:
+        return None
+
+
+def choose_index_type(n_vectors: int, config: dict) -> str:
+    """
+    Pick the index type for a corpus of n_vectors.
+    "auto" stays flat (exact) until ann_promotion_threshold, then uses ann_index_type.
+    """
+    index_type = config.get("faiss_index_type", "auto")
+    if index_type == "auto":
+        if n_vectors < config.get("ann_promotion_threshold", 100000):
+            return "flat"
+        index_type = config.get("ann_index_type", "ivf_flat")
+    if index_type not in INDEX_TYPES:
+        logger.warning("Unknown faiss_index_type %r, using flat", index_type)
+        return "flat"
+    return index_type
+
+
+def choose_compression(index_type: str, config: dict) -> str:
+    """Codes the index should store; ivf_pq is PQ by definition."""
+    if index_type == "ivf_pq":
+        return "pq"
+    compression = config.get("vector_compression", "none")
+    if compression not in COMPRESSION_TYPES:
+        logger.warning("Unknown vector_compression %r, storing full vectors", compression)
+        return "none"
+    return compression
+
+
+def _auto_nlist(n_vectors: int, config: dict) -> int:
+    nlist = config.get("faiss_nlist", 0) or int(4 * math.sqrt(n_vectors))
+    return max(1, min(nlist, n_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def _pq_subquantizers(dim: int, requested: int) -> int:
+    """Largest divisor of dim that is <= requested (PQ needs dim % m == 0)."""
+    for m in range(min(requested, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def build_faiss_index(vectors: np.ndarray, index_type: str, config: dict) -> faiss.Index:
+    """
+    Build (and train, where needed) an index of the given type holding vectors,
+    storing codes according to vector_compression.
+    Falls back to flat when there are too few vectors to train.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n_vectors, dim = vectors.shape
+    compression = choose_compression(index_type, config)
+    pq_m = _pq_subquantizers(dim, config.get("faiss_pq_m", 16))
+    nlist = _auto_nlist(n_vectors, config)
+
+    min_train = 1
+    if index_type in ("ivf_flat", "ivf_pq"):
+        min_train = MIN_POINTS_PER_CENTROID * nlist
+    if compression == "pq":
+        min_train = max(min_train, PQ_CODEBOOK_SIZE)
+    if n_vectors < min_train:
+        logger.warning("Only %d vectors, need %d to train %s/%s; keeping a flat index",
+                       n_vectors, min_train, index_type, compression)
+        index_type, compression = "flat", "none"
+
+    sq8 = faiss.ScalarQuantizer.QT_8bit
+    if index_type == "hnsw":
+        hnsw_m = config.get("hnsw_m", 32)
+        if compression == "sq8":
+            index = faiss.IndexHNSWSQ(dim, sq8, hnsw_m)
+        elif compression == "pq":
+            index = faiss.IndexHNSWPQ(dim, pq_m, hnsw_m)
+        else:
+            index = faiss.IndexHNSWFlat(dim, hnsw_m)
+        index.hnsw.efConstruction = config.get("hnsw_ef_construction", 200)
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        quantizer = faiss.IndexFlatL2(dim)
+        if compression == "pq":
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, 8)
+        elif compression == "sq8":
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, sq8)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+    elif compression == "sq8":
+        index = faiss.IndexScalarQuantizer(dim, sq8)
+    elif compression == "pq":
+        index = faiss.IndexPQ(dim, pq_m, 8)
+    else:
+        index = faiss.IndexFlatL2(dim)
+
+    if not index.is_trained:
+        # Train on a sample; k-means cost grows with the training set
+        max_train = config.get("faiss_max_train_points", 0) or 256 * max(nlist, PQ_CODEBOOK_SIZE)
+        sample = vectors
+        if n_vectors > max_train:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(n_vectors, max_train, replace=False)]
+        start = time.perf_counter()
+        index.train(sample)
+        logger.info("Trained %s/%s on %d vectors in %.1fs",
+                    index_type, compression, len(sample), time.perf_counter() - start)
+
+    index.add(vectors)
+    apply_search_params(index, config)
+    return index
+
+
+def apply_search_params(index: faiss.Index, config: dict):
+    """
+    Set query-time knobs (nprobe for IVF, efSearch for HNSW, rerank_factor).
+    They live on the index object, which concurrent queries share: set them
+    when an index is built or loaded, never per query (a changed setting
+    loads a new index generation, see backend._index_config_key).
+    """
+    if isinstance(index, RescoredIndex):
+        index.rerank_factor = max(1, config.get("rerank_factor", 4))
+        index = index.index
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = config.get("faiss_ef_search", 64)
+        return
+    ivf = _extract_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(config.get("faiss_nprobe", 16), ivf.nlist)
+
+
+def search_with_ids(index: faiss.Index, x: np.ndarray, k: int, ids: np.ndarray):
+    """
+    Search only among the given vector ids: a packed bitmap (1 bit per vector)
+    is handed to FAISS as an IDSelectorBitmap, so other vectors are skipped
+    without computing their distances. For IVF/HNSW, nprobe/efSearch are
+    raised in proportion to the filter's selectivity so that enough matching
+    vectors are visited to fill k results.
+    """
+    base = _unwrap(index)
+    if isinstance(base, faiss.IndexPQ):
+        # IndexPQ takes no search parameters
+        return _search_subset(index, x, k, ids)
+
+    mask = np.zeros(base.ntotal, dtype=bool)
+    mask[ids] = True
+    # The selector only holds a pointer: bits must outlive the search call
+    bits = np.packbits(mask, bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(bits), faiss.swig_ptr(bits))
+    fetch_k = k * index.rerank_factor if isinstance(index, RescoredIndex) else k
+    scale = base.ntotal / max(1, len(ids))
+
+    if isinstance(base, faiss.IndexHNSW):
+        ef_search = min(base.ntotal, max(base.hnsw.efSearch, int(fetch_k * scale)))
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+    elif _extract_ivf(base) is not None:
+        ivf = _extract_ivf(base)
+        nprobe = min(ivf.nlist, max(ivf.nprobe, math.ceil(fetch_k * ivf.nlist / max(1, len(ids)))))
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+
+    return index.search(x, k, params=params)
+
+
+def _search_subset(index, x: np.ndarray, k: int, ids: np.ndarray):
+    """Brute-force L2 over just the given ids (exact vectors when available)."""
+    if isinstance(index, RescoredIndex):
+        candidates = np.asarray(index.vectors[ids])
+    else:
+        candidates = index.reconstruct_batch(ids)
+    distances = np.full((len(x), k), np.inf, dtype="float32")
+    labels = np.full((len(x), k), -1, dtype="int64")
+    for row, query in enumerate(x):
+        scores = ((candidates - query) ** 2).sum(axis=1)
+        order = np.argsort(scores)[:k]
+        distances[row, :len(order)] = scores[order]
+        labels[row, :len(order)] = ids[order]
+    return distances, labels
+
+
+def ensure_index_type(index: faiss.Index, config: dict, db_path: Optional[str] = None) -> faiss.Index:
+    """
+    Convert a flat index to the configured ANN type and compression once it
+    qualifies (e.g. the corpus crossed ann_promotion_threshold). With db_path,
+    writes the exact vectors file for compressed indexes and a recall/latency
+    report next to the index.
+    """
+    target = choose_index_type(index.ntotal, config)
+    target_compression = choose_compression(target, config)
+    current = (describe_index(index), describe_compression(index))
+    if current == (target, target_compression):
+        return index
+    if current != ("flat", "none"):
+        # Lossy/unordered storage can't be reconstructed exactly; needs a re-ingest
+        logger.info("Index is %s/%s, configured %s/%s: clear and re-ingest to convert",
+                    *current, target, target_compression)
+        return index
+
+    logger.info("Converting flat index with %d vectors to %s/%s", index.ntotal, target, target_compression)
+    vectors = index.reconstruct_n(0, index.ntotal)
+    new_index = build_faiss_index(vectors, target, config)
+    if db_path and describe_compression(new_index) != "none":
+        append_vectors(db_path, vectors, 0)
+    if db_path and (describe_index(new_index), describe_compression(new_index)) != ("flat", "none"):
+        save_ann_report(db_path, evaluate_ann_index(new_index, vectors, config))
+    return new_index
+
+
+def append_vectors(db_path: str, vectors: np.ndarray, start_row: int):
+    """
+    Write exact vectors for ids start_row.. to the vectors file.
+    Only the new rows are written; anything past start_row (left by a failed
+    ingest) is truncated first. Readers map a fixed row count, so appending
+    never disturbs them.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    os.makedirs(db_path, exist_ok=True)
+    path = os.path.join(db_path, VECTORS_FILE)
+    with open(path, "ab") as f:
+        f.truncate(start_row * vectors.shape[1] * vectors.itemsize)
+        f.seek(0, os.SEEK_END)
+        f.write(vectors.tobytes())
+
+
+def read_vectors(index: faiss.Index, db_path: str) -> np.ndarray:
+    """
+    All vectors of an index in id order, to rebuild it: exact from the
+    vectors file if a compressed index has one, otherwise reconstructed
+    (approximate for compressed indexes).
+    """
+    index = _unwrap(index)
+    path = os.path.join(db_path, VECTORS_FILE)
+    count = index.ntotal * index.d
+    if describe_compression(index) != "none" and os.path.exists(path) and os.path.getsize(path) >= count * 4:
+        return np.fromfile(path, dtype="float32", count=count).reshape(index.ntotal, index.d)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()  # IVF lists can't be reconstructed by id without it
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def wrap_for_search(index: faiss.Index, db_path: str, config: dict):
+    """Return a RescoredIndex for compressed indexes that have their exact vectors on disk."""
+    rerank_factor = config.get("rerank_factor", 4)
+    if rerank_factor < 1 or describe_compression(index) == "none":
+        return index
+    path = os.path.join(db_path, VECTORS_FILE)
+    row_bytes = index.d * 4
+    if not os.path.exists(path) or os.path.getsize(path) < index.ntotal * row_bytes:
+        logger.warning("Exact vectors missing for compressed index in %s; results are not re-scored", db_path)
+        return index
+    vectors = np.memmap(path, dtype="float32", mode="r", shape=(index.ntotal, index.d))
+    return RescoredIndex(index, vectors, rerank_factor)
+
+
+def index_memory_stats(index: faiss.Index, db_path: str) -> dict:
+    """Resident index size vs. the float32 equivalent, plus the on-demand vectors file."""
+    index = _unwrap(index)
+    index_path = os.path.join(db_path, "index.faiss")
+    vectors_path = os.path.join(db_path, VECTORS_FILE)
+    index_bytes = os.path.getsize(index_path) if os.path.exists(index_path) else 0
+    float32_bytes = index.ntotal * index.d * 4
+    return {
+        "index_type": describe_index(index),
+        "compression": describe_compression(index),
+        "vectors": int(index.ntotal),
+        "dimensions": int(index.d),
+        "index_bytes": index_bytes,
+        "float32_bytes": float32_bytes,
+        "compression_ratio": round(float32_bytes / index_bytes, 2) if index_bytes else None,
+        "exact_vectors_bytes": os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0,
+    }
+
+
+def _search_param_sweep(index: faiss.Index) -> List[tuple]:
+    if isinstance(index, faiss.IndexHNSW):
+        return [("efSearch", v) for v in (16, 32, 64, 128, 256)]
+    ivf = _extract_ivf(index)
+    if ivf is not None:
+        return [("nprobe", v) for v in (1, 4, 8, 16, 32, 64, 128) if v <= ivf.nlist]
+    return [(None, None)]  # Compressed flat index: nothing to tune
+
+
+def _set_param(index: faiss.Index, name: str, value: int):
+    if name == "efSearch":
+        index.hnsw.efSearch = value
+    elif name == "nprobe":
+        _extract_ivf(index).nprobe = value
+
+
+def evaluate_ann_index(index: faiss.Index, vectors: np.ndarray, config: dict,
+                       k: int = 10, n_queries: int = 200) -> dict:
+    """
+    Recall@k and latency of an ANN index against exact (flat) search.
+    Queries are a sample of the stored vectors; ground truth is brute force
+    over all vectors. Sweeps nprobe/efSearch so the trade-off can be tuned.
+    For compressed indexes, also measures recall after exact re-scoring.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), min(n_queries, len(vectors)), replace=False)]
+    k = min(k, len(vectors))
+
+    start = time.perf_counter()
+    _, truth = faiss.knn(queries, vectors, k)
+    flat_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    def measure(searcher):
+        start = time.perf_counter()
+        _, found = searcher.search(queries, k)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+        return round(hits / truth.size, 4), round(latency_ms, 4)
+
+    rerank_factor = config.get("rerank_factor", 4)
+    rescored = None
+    if describe_compression(index) != "none" and rerank_factor >= 1:
+        rescored = RescoredIndex(index, vectors, rerank_factor)
+
+    sweep = []
+    for name, value in _search_param_sweep(index):
+        _set_param(index, name, value)
+        row = {name: value} if name else {}
+        row["recall_at_k"], row["latency_ms"] = measure(index)
+        if rescored is not None:
+            row["rescored_recall_at_k"], row["rescored_latency_ms"] = measure(rescored)
+        sweep.append(row)
+    apply_search_params(index, config)
+
+    return {
+        "index_type": describe_index(index),
+        "compression": describe_compression(index),
+        "rerank_factor": rerank_factor if rescored is not None else None,
+        "vectors": int(index.ntotal),
+        "k": k,
+        "queries": len(queries),
+        "flat_latency_ms": round(flat_ms, 4),
+        "sweep": sweep,
+        "created_at": time.time(),
+    }
+
+
+def save_ann_report(db_path: str, report: dict):
+    os.makedirs(db_path, exist_ok=True)
+    with open(os.path.join(db_path, ANN_REPORT_FILE), "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_ann_report(db_path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(db_path, ANN_REPORT_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
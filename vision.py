@@ -0,0 +1,156 @@
+"""
+Image preparation for the vision model.
+
+Chat image attachments arrive at full resolution, while the vision model
+works at a small fixed input size (moondream: 378x378). Sending the original
+means megabytes of base64 per request and, for large photos, more refusals.
+The original is what gets saved; a downscaled JPEG (longest side
+"vision_image_size") is what the model gets. Prepared images are cached on disk by the SHA-256 of the original
+bytes, so a re-attached image is not processed again.
+
+Descriptions are cached too, in SQLite by image hash, vision model and
+prompt ("vision_cache_max_entries", least recently used evicted): a
+re-attached image or a replayed conversation skips the vision model. Image
+files are ingested through ImageLoader as their description plus any OCR
+text, so a described image becomes retrievable without a second vision call.
+"""
+
+import base64
+import hashlib
+import io
+import logging
+import os
+from typing import Iterator, NamedTuple
+
+from langchain_core.document_loaders import BaseLoader
+from langchain_core.documents import Document
+from langchain_core.messages import HumanMessage
+from langchain_ollama import ChatOllama
+
+import database
+from ocr import ocr_available, ocr_images
+
+logger = logging.getLogger("RAG_Agent.vision")
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".gif")
+
+VISION_PROMPT = "Describe this image. List prominent colors, objects, and any text visible."
+
+# Small vision models sometimes answer as if they had no image
+_REFUSAL_PATTERNS = [
+    "i don't have access",
+    "i can't view",
+    "i'm sorry, but i can't",
+    "i cannot assist with that",
+    "i'm unable to view",
+    "i'm unable to see",
+    "unfortunately, i don't have access"
+]
+
+
+class PreparedImage(NamedTuple):
+    data: bytes
+    mime_type: str
+    digest: str  # SHA-256 of the original image bytes
+
+
+def to_data_url(image: PreparedImage) -> str:
+    return f"data:{image.mime_type};base64,{base64.b64encode(image.data).decode('ascii')}"
+
+
+def _downscale(data: bytes, size: int, quality: int) -> bytes:
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            # Transparent areas become white, as they are usually displayed
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        image = image.convert("RGB")
+        image.thumbnail((size, size), Image.LANCZOS)  # Only ever shrinks
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+
+def prepare_image(data: bytes, config: dict) -> PreparedImage:
+    """
+    The image as the vision model should get it: downscaled and re-encoded as
+    JPEG, from the cache when the same image was prepared before. Images PIL
+    can't read are passed through unchanged.
+    """
+    size = config.get("vision_image_size", 378)
+    quality = config.get("vision_image_quality", 85)
+    digest = hashlib.sha256(data).hexdigest()
+    cache_dir = config.get("image_cache_dir", "image_cache")
+    path = os.path.join(cache_dir, f"{digest}-{size}-{quality}.jpg")
+    try:
+        with open(path, "rb") as f:
+            return PreparedImage(f.read(), "image/jpeg", digest)
+    except OSError:
+        pass
+    try:
+        prepared = _downscale(data, size, quality)
+    except Exception as e:
+        logger.debug("Could not downscale image %s (%s); sending it unchanged", digest[:12], e)
+        return PreparedImage(data, "image/png", digest)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(prepared)
+    os.replace(tmp_path, path)
+    logger.debug("Prepared image %s: %d -> %d bytes", digest[:12], len(data), len(prepared))
+    return PreparedImage(prepared, "image/jpeg", digest)
+
+
+def is_refusal(description: str) -> bool:
+    """True if the vision model refused, or answered (next to) nothing."""
+    text = description.lower().strip()
+    return len(text) < 10 or any(pattern in text for pattern in _REFUSAL_PATTERNS)
+
+
+def describe_image(image: PreparedImage, config: dict, prompt: str = VISION_PROMPT) -> str:
+    """The vision model's description of an image, from the cache if it was described before."""
+    model = config.get("vision_model", "moondream")
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    cached = database.get_vision_description(image.digest, model, prompt_hash)
+    if cached is not None:
+        logger.debug("Vision description of %s served from cache", image.digest[:12])
+        return cached
+    vision_llm = ChatOllama(model=model, base_url=config.get("ollama_host", "http://localhost:11434"))
+    message = HumanMessage(content=[
+        {"type": "text", "text": prompt},
+        {"type": "image_url", "image_url": {"url": to_data_url(image)}},
+    ])
+    description = vision_llm.invoke([message]).content
+    if not is_refusal(description):  # A refusal may not repeat: ask again next time
+        database.save_vision_description(image.digest, model, prompt_hash, description,
+                                         config.get("vision_cache_max_entries", 1000))
+    return description
+
+
+class ImageLoader(BaseLoader):
+    """An image file as one document: its vision description and any OCR'd text."""
+
+    def __init__(self, file_path: str, config: dict):
+        self.file_path = file_path
+        self.config = config
+        # Part of the parsed-text cache key
+        use_ocr = config.get("ocr_enabled", True) and ocr_available()
+        self.mode = f"{config.get('vision_model', 'moondream')}{'+ocr' if use_ocr else ''}"
+        self.use_ocr = use_ocr
+
+    def lazy_load(self) -> Iterator[Document]:
+        with open(self.file_path, "rb") as f:
+            data = f.read()
+        parts = []
+        description = describe_image(prepare_image(data, self.config), self.config)
+        if not is_refusal(description):
+            parts.append(f"Image description: {description}")
+        if self.use_ocr:
+            text = ocr_images([data], self.config)[0]
+            if text:
+                parts.append(f"Text in image:\n{text}")
+        yield Document(page_content="\n\n".join(parts), metadata={"source": self.file_path, "image": True})
@@ -0,0 +1,234 @@
+"""
+Watching the upload directory so the index follows it.
+
+Files copied into uploaded_files by other processes were never indexed, and
+edited files went stale until a manual re-ingest. DirectoryWatcher reports
+changed file names of a directory: through inotify on Linux (read with
+ctypes, no extra dependency), by comparing directory listings every
+"watch_poll_seconds" elsewhere.
+
+Events are debounced and coalesced: names collect until the directory has
+been quiet for "watch_debounce_seconds" (or "watch_max_delay_seconds" after
+the first event), then the whole set is handed over at once, so a burst of a
+thousand writes becomes one batched ingest (see backend.sync_directory).
+Files still being written when the batch is cut wait for the next one.
+
+With several server workers only one process watches: the one holding the
+watcher lock file next to the directory.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger("RAG_Agent.watcher")
+
+# inotify(7) event flags
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+               | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+# Temporary names of files being written (uploads.py, atomic saves)
+_IGNORED_SUFFIXES = (".part", ".tmp", ".swp", "~")
+
+
+def _ignored(name: str) -> bool:
+    return name.startswith(".") or name.endswith(_IGNORED_SUFFIXES)
+
+
+class _Inotify:
+    """A non-blocking inotify watch on one directory (Linux)."""
+
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), _WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def read(self, timeout: float) -> Tuple[Set[str], bool]:
+        """Names with events within timeout seconds, and whether events were lost (rescan needed)."""
+        names, overflow = set(), False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return names, overflow
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return names, overflow
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0")
+            offset += _EVENT.size + length
+            if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+                overflow = True
+            elif name and not mask & IN_ISDIR:
+                names.add(os.fsdecode(name))
+        return names, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poller:
+    """Listing comparison every interval seconds (no inotify)."""
+
+    def __init__(self, directory: str, interval: float):
+        self.directory = directory
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                    except OSError:
+                        continue  # Deleted while scanning
+        except OSError as e:
+            logger.warning("Could not list %s: %s", self.directory, e)
+        return snapshot
+
+    def read(self, timeout: float) -> Tuple[Set[str], bool]:
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._scan()
+        names = {name for name in snapshot.keys() | self.snapshot.keys()
+                 if snapshot.get(name) != self.snapshot.get(name)}
+        self.snapshot = snapshot
+        return names, False
+
+    def close(self):
+        pass
+
+
+class DirectoryWatcher:
+    """
+    Calls on_changes(names) on a background thread with the coalesced set of
+    file names that were created, modified or deleted in directory; names is
+    None when events were lost and the whole directory should be checked.
+    """
+
+    def __init__(self, directory: str, on_changes: Callable[[Optional[Set[str]]], None],
+                 debounce: float = 2.0, max_delay: float = 30.0, poll_interval: float = 2.0):
+        self.directory = os.path.abspath(directory)
+        self.on_changes = on_changes
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._source = None
+
+    def start(self, initial_scan: bool = False):
+        """Start watching; initial_scan reports the whole directory first (changes made while not watching)."""
+        if sys.platform.startswith("linux"):
+            try:
+                self._source = _Inotify(self.directory)
+            except OSError as e:
+                logger.warning("inotify unavailable (%s); polling %s every %ss", e, self.directory, self.poll_interval)
+        if self._source is None:
+            self._source = _Poller(self.directory, self.poll_interval)
+        self._thread = threading.Thread(target=self._run, args=(initial_scan,), name="upload-watcher", daemon=True)
+        self._thread.start()
+        logger.info("Watching %s (%s)", self.directory, type(self._source).__name__.strip("_").lower())
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._source is not None:
+            self._source.close()
+
+    def _settled(self, name: str) -> bool:
+        """False while a file is still being written (modified within the debounce time)."""
+        try:
+            return time.time() - os.path.getmtime(os.path.join(self.directory, name)) >= self.debounce
+        except OSError:
+            return True  # Deleted
+
+    def _run(self, rescan: bool):
+        pending: Set[str] = set()
+        first_event = last_event = time.monotonic()
+        while not self._stop.is_set():
+            waiting = bool(pending) or rescan
+            if waiting:
+                timeout = max(0.0, min(last_event + self.debounce, first_event + self.max_delay) - time.monotonic())
+            else:
+                timeout = 1.0  # Wake up regularly to notice stop()
+            names, overflow = self._source.read(timeout)
+            names = {name for name in names if not _ignored(name)}
+            now = time.monotonic()
+            if names or overflow:
+                if not waiting:
+                    first_event = now
+                last_event = now
+                pending |= names
+                rescan = rescan or overflow
+            if not (pending or rescan) or (now - last_event < self.debounce and now - first_event < self.max_delay):
+                continue
+            if rescan:
+                batch, pending, rescan = None, set(), False
+            else:
+                batch = {name for name in pending if self._settled(name)}
+                pending -= batch
+                if pending:  # Still being written: they wait another debounce
+                    first_event = last_event = now
+                if not batch:
+                    continue
+            logger.info("Upload dir changed: %s", "rescanning" if batch is None else f"{len(batch)} file(s)")
+            try:
+                self.on_changes(batch)
+            except Exception as e:
+                logger.error("Syncing changes of %s failed: %s", self.directory, e)
+
+
+_lock_files: Dict[str, object] = {}
+
+
+def acquire_watch_lock(directory: str) -> bool:
+    """
+    Take the (cross-process, non-blocking) watcher lock of a directory, held
+    until the process exits. False if another process watches it.
+    """
+    lock_path = f"{os.path.abspath(directory)}.watch.lock"
+    if lock_path in _lock_files:
+        return True
+    lock_file = open(lock_path, "a+")
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _lock_files[lock_path] = lock_file
+    return True